@@ -23,7 +23,11 @@ from server.game_service import GameService
 from server.ice_servers.nts import TwilioNTS
 from server.player_service import PlayerService
 from server.profiler import Profiler
-from server.protocol import SimpleJsonProtocol
+from server.protocol import (
+    CompressedJsonProtocol,
+    QDataStreamProtocol,
+    SimpleJsonProtocol
+)
 
 
 async def main():
@@ -80,7 +84,11 @@ async def main():
     config.register_callback("PROFILING_DURATION", profiler.refresh)
     config.register_callback("PROFILING_INTERVAL", profiler.refresh)
 
-    ctrl_server = await server.run_control_server(player_service, game_service)
+    ctrl_server = await server.run_control_server(
+        player_service,
+        game_service,
+        instance.contexts
+    )
 
     async def restart_control_server():
         nonlocal ctrl_server
@@ -88,12 +96,32 @@ async def main():
         await ctrl_server.shutdown()
         ctrl_server = await server.run_control_server(
             player_service,
-            game_service
+            game_service,
+            instance.contexts
         )
     config.register_callback("CONTROL_SERVER_PORT", restart_control_server)
 
-    await instance.listen(("", 8001))
-    await instance.listen(("", 8002), SimpleJsonProtocol)
+    addresses = [
+        ("", 8001, QDataStreamProtocol),
+        ("", 8002, SimpleJsonProtocol),
+        ("", 8003, CompressedJsonProtocol)
+    ]
+    worker_pool = None
+    if config.WORKER_PROCESSES > 0:
+        socket_path = (
+            config.WORKER_SOCKET_PATH or server.workers.private_socket_path()
+        )
+        await instance.listen_workers(socket_path)
+        worker_pool = server.workers.WorkerPool(
+            config.WORKER_PROCESSES,
+            socket_path,
+            addresses
+        )
+        worker_pool.start()
+        logger.info("Started %d worker processes", config.WORKER_PROCESSES)
+    else:
+        for host, port, protocol_class in addresses:
+            await instance.listen((host, port), protocol_class)
 
     server.metrics.info.info({
         "version": os.environ.get("VERSION") or "dev",
@@ -105,6 +133,8 @@ async def main():
     await done
 
     # Cleanup
+    if worker_pool is not None:
+        worker_pool.shutdown()
     await instance.shutdown()
     await ctrl_server.shutdown()
 
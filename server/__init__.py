@@ -8,6 +8,7 @@ Distributed under GPLv3, see license.txt
 """
 import asyncio
 import logging
+import time
 from typing import Dict, Optional, Set, Tuple, Type
 
 from prometheus_client import start_http_server
@@ -16,6 +17,7 @@ import server.metrics as metrics
 
 from .api.api_accessor import ApiAccessor
 from .asyncio_extensions import synchronizedmethod
+from .broadcast import BroadcastBatch
 from .config import TRACE, config
 from .configuration_service import ConfigurationService
 from .control import run_control_server
@@ -28,6 +30,7 @@ from .geoip_service import GeoIpService
 from .ice_servers.nts import TwilioNTS
 from .ladder_service import LadderService
 from .lobbyconnection import LobbyConnection
+from .login_admission import LoginAdmission
 from .message_queue_service import MessageQueueService
 from .party_service import PartyService
 from .player_service import PlayerService
@@ -36,6 +39,7 @@ from .rating_service.rating_service import RatingService
 from .servercontext import ServerContext
 from .stats.game_stats_service import GameStatsService
 from .timing import at_interval
+from .workers import CoordinatorContext
 
 __author__ = "Askaholic, Chris Kitching, Dragonfire, Gael Honorez, Jeroen De Dauw, Crotalus, Michael Søndergaard, Michel Jung"
 __contact__ = "admin@faforever.com"
@@ -59,6 +63,7 @@ __all__ = (
     "game_service",
     "protocol",
     "run_control_server",
+    "workers",
 )
 
 DIRTY_REPORT_INTERVAL = 1  # Seconds
@@ -103,6 +108,7 @@ class ServerInstance(object):
             "loop": self.loop,
         })
 
+        self.login_admission = LoginAdmission()
         self.connection_factory = lambda: LobbyConnection(
             database=database,
             geoip=self.services["geo_ip_service"],
@@ -110,7 +116,8 @@ class ServerInstance(object):
             nts_client=twilio_nts,
             players=self.services["player_service"],
             ladder_service=self.services["ladder_service"],
-            party_service=self.services["party_service"]
+            party_service=self.services["party_service"],
+            login_admission=self.login_admission
         )
 
     def write_broadcast(self, message, predicate=lambda conn: conn.authenticated):
@@ -126,6 +133,16 @@ class ServerInstance(object):
                     message.get("command", message)
                 )
 
+    def write_broadcast_batch(self, batch: BroadcastBatch):
+        self._logger.log(TRACE, "]]: %s", batch)
+        metrics.server_broadcasts.inc()
+
+        for ctx in self.contexts:
+            try:
+                ctx.write_broadcast_batch(batch)
+            except Exception:
+                self._logger.exception("Error writing broadcast batch")
+
     @synchronizedmethod
     async def _start_services(self) -> None:
         if self.started:
@@ -137,47 +154,76 @@ class ServerInstance(object):
 
         game_service: GameService = self.services["game_service"]
         player_service: PlayerService = self.services["player_service"]
+        last_report_time = time.monotonic()
 
         @at_interval(DIRTY_REPORT_INTERVAL, loop=self.loop)
         def do_report_dirties():
+            nonlocal last_report_time
+
             game_service.update_active_game_metrics()
             dirty_games = game_service.dirty_games
-            dirty_queues = game_service.dirty_queues
+            dirty_queues = game_service.pop_dirty_queues(time.monotonic())
             dirty_players = player_service.dirty_players
             game_service.clear_dirty()
             player_service.clear_dirty()
 
+            # Deltas are relative to the state that was broadcast in the
+            # previous report, so they can only be sent to connections that
+            # received their initial snapshot before that.
+            previous_report_time = last_report_time
+            last_report_time = time.monotonic()
+
+            def uses_deltas(conn):
+                return (
+                    conn.delta_updates_since is not None
+                    and conn.delta_updates_since < previous_report_time
+                )
+
+            def wants_boundaries(conn):
+                return conn.authenticated and not conn.compact_matchmaker_info
+
+            def wants_rating_bands(conn):
+                return conn.authenticated and conn.compact_matchmaker_info
+
+            batch = BroadcastBatch(uses_deltas)
             if dirty_queues:
-                self.write_broadcast({
+                batch.add_message({
                     "command": "matchmaker_info",
                     "queues": [queue.to_dict() for queue in dirty_queues]
-                })
+                }, wants_boundaries)
+                batch.add_message({
+                    "command": "matchmaker_info",
+                    "queues": [
+                        queue.to_dict(compact=True) for queue in dirty_queues
+                    ]
+                }, wants_rating_bands)
 
             if dirty_players:
-                self.write_broadcast(
-                    {
-                        "command": "player_info",
-                        "players": [player.to_dict() for player in dirty_players]
-                    },
-                    lambda lobby_conn: lobby_conn.authenticated
-                )
+                self._add_player_info(batch, dirty_players, uses_deltas)
 
-            # TODO: This spams squillions of messages: we should implement per-
-            # connection message aggregation at the next abstraction layer down :P
+            # Games are aggregated per connection so that every connection
+            # receives at most one `game_info` message per tick. Connections
+            # that can see the same games share the encoded message.
             for game in dirty_games:
+                info = game.to_dict()
+                delta = None
+                if game.state in (GameState.LOBBY, GameState.LIVE):
+                    game_service.snapshot.update(game.id, info)
+                else:
+                    game_service.snapshot.remove(game.id)
+
                 if game.state == GameState.ENDED:
                     game_service.remove_game(game)
+                else:
+                    # Connections that haven't seen the game in full yet
+                    # receive the full object instead
+                    delta = game_service.game_deltas.update(game, info)
 
                 # So we're going to be broadcasting this to _somebody_...
-                message = game.to_dict()
-
-                self.write_broadcast(
-                    message,
-                    lambda conn: (
-                        conn.authenticated
-                        and game.is_visible_to_player(conn.player)
-                    )
-                )
+                batch.add_game(game, delta, info)
+
+            if batch:
+                self.write_broadcast_batch(batch)
 
         @at_interval(45, loop=self.loop)
         def ping_broadcast():
@@ -185,6 +231,40 @@ class ServerInstance(object):
 
         self.started = True
 
+    def _add_player_info(self, batch, dirty_players, uses_deltas):
+        player_service = self.services["player_service"]
+        player_deltas = player_service.player_deltas
+
+        players = []
+        new_players = []
+        deltas = []
+        for player in dirty_players:
+            info = player.to_dict()
+            players.append(info)
+            if player_service[player.id] is player:
+                player_service.snapshot.update(player.id, info)
+
+            delta = player_deltas.update(player, info)
+            if delta is None:
+                new_players.append(info)
+            elif delta:
+                deltas.append(delta)
+
+        batch.add_message(
+            {"command": "player_info", "players": players},
+            lambda conn: conn.authenticated and not uses_deltas(conn)
+        )
+        if new_players:
+            batch.add_message(
+                {"command": "player_info", "players": new_players},
+                lambda conn: conn.authenticated and uses_deltas(conn)
+            )
+        if deltas:
+            batch.add_message(
+                {"command": "player_info_delta", "players": deltas},
+                lambda conn: conn.authenticated and uses_deltas(conn)
+            )
+
     async def listen(
         self,
         address: Tuple[str, int],
@@ -208,6 +288,24 @@ class ServerInstance(object):
 
         return ctx
 
+    async def listen_workers(self, path: str) -> CoordinatorContext:
+        """
+        Start accepting connections from worker processes on a unix socket.
+        """
+        if not self.started:
+            await self._start_services()
+
+        ctx = CoordinatorContext(
+            f"{self.name}[workers]",
+            self.connection_factory,
+            list(self.services.values())
+        )
+        self.contexts.add(ctx)
+
+        await ctx.listen(path)
+
+        return ctx
+
     async def shutdown(self):
         for ctx in self.contexts:
             ctx.close()
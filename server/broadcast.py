@@ -0,0 +1,714 @@
+"""
+Aggregation of broadcast messages.
+
+During a dirty report tick many small messages are generated which each
+connection may or may not be interested in. Instead of writing them to every
+connection one by one, they are collected into a `BroadcastBatch` which is
+then written to each connection in a single write call.
+
+Connections that should receive exactly the same messages are grouped
+together, and the bytes for each group are only encoded once per protocol
+class.
+"""
+
+import weakref
+from collections import defaultdict
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    KeysView,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Type,
+    Union
+)
+
+from .games import Game, GameState, VisibilityState
+from .protocol import Protocol
+from .protocol.codec import default_codec
+from .rating import InclusiveRange
+
+Predicate = Callable[[Any], bool]
+RangeKey = Tuple[str, Optional[float], Optional[float]]
+
+
+def is_authenticated(conn) -> bool:
+    return conn.authenticated
+
+
+class _Message:
+    """A message that is sent as is to all connections passing the predicate."""
+
+    def __init__(self, message: dict, predicate: Predicate):
+        self.command = message.get("command")
+        self.message = message
+        self.predicate = predicate
+
+    def group_key(self, conn) -> Hashable:
+        return bool(self.predicate(conn))
+
+    def encode(self, key: Hashable, protocol_class: Type[Protocol]) -> bytes:
+        if not key:
+            return b""
+
+        return protocol_class.encode_message(self.message)
+
+    def mark_sent(self, conn, key: Hashable) -> None:
+        pass
+
+    def encode_items(
+        self,
+        key: Hashable,
+        protocol_class: Type[Protocol]
+    ) -> List[Tuple[Optional[Hashable], bytes]]:
+        if not key:
+            return []
+
+        if self.command == "player_info":
+            return [
+                (
+                    ("player_info", player["id"]),
+                    protocol_class.encode_message({
+                        "command": "player_info",
+                        "players": [player]
+                    })
+                )
+                for player in self.message["players"]
+            ]
+
+        return [(None, self.encode(key, protocol_class))]
+
+
+class _AggregatedMessage:
+    """
+    A message whose `key` field is a list made up of all items that pass the
+    predicate for a particular connection.
+
+    Every item is serialized only once, and the message for a connection is
+    spliced together from the serialized items.
+    """
+
+    def __init__(self, command: str, key: str):
+        self.command = command
+        self.key = key
+        self.items: List[Tuple[dict, Optional[Predicate]]] = []
+        self._serialized: List[str] = []
+
+    def add(self, item: dict, predicate: Predicate) -> None:
+        self.items.append((item, predicate))
+
+    def group_key(self, conn) -> Hashable:
+        return tuple(
+            i for i, (_, predicate) in enumerate(self.items)
+            if predicate(conn)
+        )
+
+    def _serialize_items(self) -> List[str]:
+        serialized = self._serialized
+        for item, _ in self.items[len(serialized):]:
+            serialized.append(default_codec.encode(item))
+
+        return serialized
+
+    def encode(self, key: Hashable, protocol_class: Type[Protocol]) -> bytes:
+        return _splice(
+            self.command, self.key, self._serialize_items(), key, protocol_class
+        )
+
+    def mark_sent(self, conn, key: Hashable) -> None:
+        pass
+
+    def encode_items(
+        self,
+        key: Hashable,
+        protocol_class: Type[Protocol]
+    ) -> List[Tuple[Optional[Hashable], bytes]]:
+        data = self.encode(key, protocol_class)
+        return [(None, data)] if data else []
+
+
+def _splice(
+    command: str,
+    key: str,
+    serialized: Union[List[str], Dict[int, str]],
+    indices: Sequence[int],
+    protocol_class: Type[Protocol]
+) -> bytes:
+    """
+    Encode a message with a list of already serialized items without
+    serializing the items again.
+    """
+    if not indices:
+        return b""
+
+    return protocol_class.encode_json("".join((
+        "{\"command\":",
+        default_codec.encode(command),
+        ",",
+        default_codec.encode(key),
+        ":[",
+        ",".join(serialized[i] for i in indices),
+        "]}"
+    )))
+
+
+class _GameInfoMessage(_AggregatedMessage):
+    """
+    Aggregates games into one `game_info` message using `VisibilityClasses`
+    instead of calling `Game.is_visible_to_player` for every connection.
+
+    Connections passing the delta predicate receive a `game_info_delta`
+    message for all games that have a delta, and full objects only for the
+    rest. Games can become visible to a connection at any time, so deltas are
+    only sent for games that are in the connection's `seen_games`. Every
+    other game is sent as a full object the first time.
+    """
+
+    def __init__(self, delta_predicate: Predicate):
+        super().__init__("game_info", "games")
+        self.games: List[Game] = []
+        self.deltas: List[Optional[dict]] = []
+        self.delta_predicate = delta_predicate
+        self._serialized_deltas: Dict[int, str] = {}
+        self._classes: Optional[VisibilityClasses] = None
+        self._seen_changes: Dict[Hashable, Tuple[Set[int], Set[int]]] = {}
+
+    def add_game(self, game: Game, info: dict, delta: Optional[dict]) -> None:
+        self.items.append((info, None))
+        self.games.append(game)
+        self.deltas.append(delta)
+        self._classes = None
+        self._seen_changes.clear()
+
+    def group_key(self, conn) -> Hashable:
+        if not conn.authenticated:
+            return None
+
+        if self._classes is None:
+            self._classes = VisibilityClasses(self.games)
+
+        signature = self._classes.signature(conn.player)
+        if not self.delta_predicate(conn):
+            return (signature, False, ())
+
+        # Games that have a delta, but that the connection needs in full.
+        # Usually there are none, so the key is still shared.
+        unseen = tuple(
+            i for i in self._classes.visible_games(signature)
+            if self.deltas[i] is not None
+            and self.games[i].id not in conn.seen_games
+        )
+        return (signature, True, unseen)
+
+    def encode(self, key: Hashable, protocol_class: Type[Protocol]) -> bytes:
+        if key is None:
+            return b""
+
+        signature, use_deltas, unseen = key
+        visible = self._classes.visible_games(signature)
+        if not use_deltas:
+            return super().encode(visible, protocol_class)
+
+        full = tuple(
+            i for i in visible if self.deltas[i] is None or i in unseen
+        )
+        partial = tuple(
+            i for i in visible if self.deltas[i] and i not in unseen
+        )
+        for i in partial:
+            if i not in self._serialized_deltas:
+                self._serialized_deltas[i] = default_codec.encode(
+                    self.deltas[i]
+                )
+
+        return super().encode(full, protocol_class) + _splice(
+            "game_info_delta",
+            "games",
+            self._serialized_deltas,
+            partial,
+            protocol_class
+        )
+
+    def encode_items(
+        self,
+        key: Hashable,
+        protocol_class: Type[Protocol]
+    ) -> List[Tuple[Optional[Hashable], bytes]]:
+        """
+        Encode every game as a separate `game_info` message so that queued
+        messages can be replaced by newer ones. Deltas are not used, since
+        they depend on the previous message having been sent.
+        """
+        if key is None:
+            return []
+
+        signature, use_deltas, unseen = key
+        visible = self._classes.visible_games(signature)
+        if use_deltas:
+            visible = tuple(
+                i for i in visible if self.deltas[i] != {} or i in unseen
+            )
+
+        serialized = self._serialize_items()
+        return [
+            (
+                ("game_info", self.games[i].id),
+                protocol_class.encode_json(serialized[i])
+            )
+            for i in visible
+        ]
+
+    def mark_sent(self, conn, key: Hashable) -> None:
+        """
+        Update the connection's `seen_games`. It now has the current state of
+        every game that is visible to it. Games that it can't see are removed,
+        because it misses their changes.
+        """
+        if key is None:
+            return
+
+        signature = key[0]
+        changes = self._seen_changes.get(signature)
+        if changes is None:
+            visible = set(self._classes.visible_games(signature))
+            seen, missed = set(), set()
+            for i, game in enumerate(self.games):
+                if i in visible and game.state is not GameState.ENDED:
+                    seen.add(game.id)
+                else:
+                    missed.add(game.id)
+            changes = self._seen_changes[signature] = (seen, missed)
+
+        seen, missed = changes
+        conn.seen_games.update(seen)
+        conn.seen_games.difference_update(missed)
+
+
+class VisibilityClasses:
+    """
+    Groups games by who is allowed to see them, so that the games visible to a
+    player can be found with a few dictionary lookups.
+
+    The classes correspond to the rules in `Game.is_visible_to_player`:
+        - public games are visible to everyone except the host's foes
+        - friends only games are visible to the host's friends
+        - games with an enforced rating range are additionally only visible to
+          players whose displayed rating is within the range
+        - the host and the players in the game can always see it
+
+    Players are reduced to a `signature` containing only their exceptions to
+    the public set. Most players have no exceptions at all and therefore share
+    the same signature.
+    """
+
+    def __init__(self, games: List[Game]):
+        self._public: List[int] = []
+        self._ranged_public: Dict[RangeKey, List[int]] = defaultdict(list)
+        self._ranges: Dict[RangeKey, InclusiveRange] = {}
+        # Public games that are hidden from a player id
+        self._hidden: Dict[int, Set[int]] = defaultdict(set)
+        # Games that are shown to a player id if the range key is None or the
+        # player is within that range
+        self._shown: Dict[int, Set[Tuple[int, Optional[RangeKey]]]] = \
+            defaultdict(set)
+        self._visible_cache: Dict[Hashable, Tuple[int, ...]] = {}
+
+        for i, game in enumerate(games):
+            self._add_game(i, game)
+
+    def _add_game(self, index: int, game: Game) -> None:
+        if game.host is None:
+            return
+
+        participants = {game.host.id}
+        participants.update(player.id for player in game._connections)
+        for player_id in participants:
+            self._shown[player_id].add((index, None))
+
+        range_key = None
+        if game.enforce_rating_range:
+            rating_range = game.displayed_rating_range
+            range_key = (game.rating_type, rating_range.lo, rating_range.hi)
+            self._ranges[range_key] = rating_range
+
+        if game.visibility is VisibilityState.FRIENDS:
+            for player_id in game.host.friends - participants:
+                self._shown[player_id].add((index, range_key))
+            return
+
+        if range_key is None:
+            self._public.append(index)
+        else:
+            self._ranged_public[range_key].append(index)
+
+        for player_id in game.host.foes - participants:
+            self._hidden[player_id].add(index)
+
+    def signature(self, player) -> Hashable:
+        """
+        Return a hashable value which is equal for all players that can see
+        the same set of games.
+        """
+        in_range = frozenset(
+            key for key, rating_range in self._ranges.items()
+            if _displayed_rating(player, key[0]) in rating_range
+        )
+        shown = frozenset(
+            index for index, key in self._shown.get(player.id, ())
+            if key is None or key in in_range
+        )
+        return (
+            in_range.intersection(self._ranged_public),
+            frozenset(self._hidden.get(player.id, ())),
+            shown
+        )
+
+    def visible_games(self, signature: Hashable) -> Tuple[int, ...]:
+        """Return the sorted indices of all games visible with a signature."""
+        visible = self._visible_cache.get(signature)
+        if visible is not None:
+            return visible
+
+        in_range, hidden, shown = signature
+        indices = set(self._public)
+        for key in in_range:
+            indices.update(self._ranged_public[key])
+        indices -= hidden
+        indices |= shown
+
+        visible = tuple(sorted(indices))
+        self._visible_cache[signature] = visible
+        return visible
+
+
+class _TrackedState:
+    __slots__ = ("ref", "state", "version")
+
+    def __init__(self, ref: weakref.ref, state: dict):
+        self.ref = ref
+        self.state = state
+        self.version = 0
+
+
+class DeltaTracker:
+    """
+    Remembers the state of objects as it was last broadcast, so that clients
+    supporting delta updates only need to be sent the fields that changed
+    since then.
+
+    Every tracked object has a version which is increased whenever a delta
+    with changes is produced.
+    """
+
+    def __init__(self, key_field: str):
+        self.key_field = key_field
+        self._states: Dict[Hashable, _TrackedState] = {}
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._states
+
+    def update(self, obj: Any, state: dict) -> Optional[dict]:
+        """
+        Record the new state of an object that is about to be broadcast.
+
+        :return: A dict containing the key, the new version and all fields
+            that changed, an empty dict if nothing changed, or None if the
+            full state needs to be sent. This is the case for objects that
+            weren't tracked before and if a field was removed.
+        """
+        key = state[self.key_field]
+        tracked = self._states.get(key)
+        state = _snapshot(state)
+
+        if (
+            tracked is None
+            or tracked.ref() is not obj
+            or not state.keys() >= tracked.state.keys()
+        ):
+            self._states[key] = _TrackedState(
+                weakref.ref(obj, lambda ref: self._forget(key, ref)),
+                state
+            )
+            return None
+
+        old_state = tracked.state
+        changed = {
+            field: value for field, value in state.items()
+            if field not in old_state or old_state[field] != value
+        }
+        if not changed:
+            return {}
+
+        tracked.version += 1
+        tracked.state = state
+
+        return {self.key_field: key, "version": tracked.version, **changed}
+
+    def invalidate(self, key: Hashable) -> None:
+        """Send the full state the next time the object is updated"""
+        self._states.pop(key, None)
+
+    def _forget(self, key: Hashable, ref: weakref.ref) -> None:
+        tracked = self._states.get(key)
+        if tracked is not None and tracked.ref is ref:
+            del self._states[key]
+
+
+class SnapshotCache:
+    """
+    Keeps the encoded message listing all objects of one kind, for instance
+    all online players, which is sent to every client that logs in.
+
+    The objects are split into chunks which are sent as separate messages.
+    Every object is serialized once when it is updated, and only the chunks
+    that changed are encoded again, once per protocol class.
+    """
+
+    def __init__(self, command: str, key: str, chunk_size: int = 500):
+        self.command = command
+        self.key = key
+        self.chunk_size = chunk_size
+        self._chunks: List[Dict[Hashable, str]] = []
+        self._encoded: List[Dict[Type[Protocol], bytes]] = []
+        self._chunk_of: Dict[Hashable, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._chunk_of)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._chunk_of
+
+    def keys(self) -> KeysView[Hashable]:
+        return self._chunk_of.keys()
+
+    def update(self, key: Hashable, item: dict) -> None:
+        serialized = default_codec.encode(item)
+        index = self._chunk_of.get(key)
+        if index is None:
+            index = self._chunk_with_room()
+            self._chunk_of[key] = index
+        elif self._chunks[index][key] == serialized:
+            return
+
+        self._chunks[index][key] = serialized
+        self._encoded[index].clear()
+
+    def remove(self, key: Hashable) -> None:
+        index = self._chunk_of.pop(key, None)
+        if index is None:
+            return
+
+        del self._chunks[index][key]
+        self._encoded[index].clear()
+
+    def _chunk_with_room(self) -> int:
+        for index in reversed(range(len(self._chunks))):
+            if len(self._chunks[index]) < self.chunk_size:
+                return index
+
+        self._chunks.append({})
+        self._encoded.append({})
+        return len(self._chunks) - 1
+
+    def encode(self, protocol_class: Type[Protocol]) -> bytes:
+        """
+        Return the messages for all objects, or no bytes at all if there are
+        none.
+        """
+        return b"".join(
+            self._encode_chunk(index, protocol_class)
+            for index in range(len(self._chunks))
+        )
+
+    def _encode_chunk(self, index: int, protocol_class: Type[Protocol]) -> bytes:
+        encoded = self._encoded[index]
+        data = encoded.get(protocol_class)
+        if data is None:
+            serialized = list(self._chunks[index].values())
+            data = _splice(
+                self.command,
+                self.key,
+                serialized,
+                range(len(serialized)),
+                protocol_class
+            )
+            encoded[protocol_class] = data
+
+        return data
+
+
+def _snapshot(state: dict) -> dict:
+    # `to_dict` may return nested containers that are modified later
+    return {
+        field: value.copy() if isinstance(value, (dict, list)) else value
+        for field, value in state.items()
+    }
+
+
+def _displayed_rating(player, rating_type: str) -> float:
+    mean, dev = player.ratings[rating_type]
+    return mean - 3 * dev
+
+
+class BroadcastBatch:
+    """
+    Collects the messages that should be broadcast during one tick.
+
+    Messages added with `add_message` are sent as they are. Items added with
+    `add_item` or `add_game` are aggregated per connection, so for instance all
+    dirty games that are visible to a player will be sent in one `game_info`
+    message with a `games` list.
+
+    Connections are grouped by the messages they should receive, and the
+    encoded bytes are cached per group and protocol class so that every
+    distinct payload is only encoded once.
+
+    Messages are written in the order in which they were first added.
+    """
+
+    def __init__(self, delta_predicate: Predicate = lambda conn: False):
+        self.delta_predicate = delta_predicate
+        self._entries: List[Union[_Message, _AggregatedMessage]] = []
+        self._aggregated: Dict[Tuple[str, str], _AggregatedMessage] = {}
+        self._encoded_parts: Dict[Tuple[int, Hashable, Type[Protocol]], bytes] = {}
+        self._encoded: Dict[Tuple[Hashable, Type[Protocol]], bytes] = {}
+
+    def __bool__(self) -> bool:
+        return bool(self._entries)
+
+    def __repr__(self) -> str:
+        commands = ", ".join(str(entry.command) for entry in self._entries)
+        return f"BroadcastBatch({commands})"
+
+    def add_message(
+        self,
+        message: dict,
+        predicate: Predicate = is_authenticated
+    ) -> None:
+        self._entries.append(_Message(message, predicate))
+
+    def add_item(
+        self,
+        command: str,
+        key: str,
+        item: dict,
+        predicate: Predicate = is_authenticated
+    ) -> None:
+        aggregated = self._get_aggregated(
+            command, key, lambda: _AggregatedMessage(command, key)
+        )
+        aggregated.add(item, predicate)
+
+    def add_game(
+        self,
+        game: Game,
+        delta: Optional[dict] = None,
+        info: Optional[dict] = None
+    ) -> None:
+        """
+        Add a game to the `game_info` message of every authenticated
+        connection whose player is allowed to see it.
+
+        If a delta is given, it is sent in a `game_info_delta` message instead
+        to connections passing the delta predicate. An empty delta means that
+        nothing needs to be sent to them.
+        """
+        if info is None:
+            info = game.to_dict()
+
+        aggregated = self._get_aggregated(
+            "game_info",
+            "games",
+            lambda: _GameInfoMessage(self.delta_predicate)
+        )
+        aggregated.add_game(game, info, delta)
+
+    def _get_aggregated(
+        self,
+        command: str,
+        key: str,
+        factory: Callable[[], _AggregatedMessage]
+    ) -> Any:
+        aggregated = self._aggregated.get((command, key))
+        if aggregated is None:
+            aggregated = factory()
+            self._aggregated[(command, key)] = aggregated
+            self._entries.append(aggregated)
+
+        return aggregated
+
+    def group_key(self, conn) -> Hashable:
+        """
+        Return a hashable value which is equal for all connections that should
+        receive the same messages.
+        """
+        return tuple(entry.group_key(conn) for entry in self._entries)
+
+    def mark_sent(self, conn, group_key: Hashable) -> None:
+        """
+        Record which objects `conn` now knows about, after the messages for
+        `group_key` were written to it.
+        """
+        for entry, key in zip(self._entries, group_key):
+            entry.mark_sent(conn, key)
+
+    def encode_for(self, conn, protocol_class: Type[Protocol]) -> bytes:
+        """
+        Encode all messages that should be sent to `conn` as one chunk of raw
+        bytes.
+        """
+        return self.encode_group(self.group_key(conn), protocol_class)
+
+    def encode_items_for(
+        self,
+        conn,
+        protocol_class: Type[Protocol]
+    ) -> List[Tuple[Optional[Hashable], bytes]]:
+        """
+        Encode the messages for `conn` as separate chunks, each paired with a
+        key identifying the object it describes, or None. Used for
+        connections whose send queue is in use, where older messages for the
+        same object can be replaced.
+        """
+        return [
+            item
+            for entry in self._entries
+            for item in entry.encode_items(entry.group_key(conn), protocol_class)
+        ]
+
+    def encode_group(
+        self,
+        group_key: Hashable,
+        protocol_class: Type[Protocol]
+    ) -> bytes:
+        data = self._encoded.get((group_key, protocol_class))
+        if data is None:
+            data = b"".join(
+                self._encode_part(i, key, protocol_class)
+                for i, key in enumerate(group_key)
+            )
+            self._encoded[(group_key, protocol_class)] = data
+
+        return data
+
+    def _encode_part(
+        self,
+        index: int,
+        key: Hashable,
+        protocol_class: Type[Protocol]
+    ) -> bytes:
+        cache_key = (index, key, protocol_class)
+        data = self._encoded_parts.get(cache_key)
+        if data is None:
+            data = self._entries[index].encode(key, protocol_class)
+            self._encoded_parts[cache_key] = data
+
+        return data
@@ -39,6 +39,28 @@ class ConfigurationStore:
         self.METRICS_PORT = 8011
         self.ENABLE_METRICS = False
 
+        # Bytes that may be waiting in the socket buffer of a connection
+        # before further messages are held back and coalesced.
+        self.SEND_QUEUE_MAX_BYTES = 1024 * 1024
+        # Connections which can't empty their send queue for this long (in
+        # seconds) are disconnected.
+        self.SLOW_CONSUMER_TIMEOUT = 30
+        # Number of worker processes handling the client connections. With 0
+        # everything runs in a single process.
+        self.WORKER_PROCESSES = 0
+        # Unix socket the workers connect to. If empty, the socket is created
+        # in a new temporary directory that only the server user can access.
+        self.WORKER_SOCKET_PATH = ""
+        # Number of logins that are processed at the same time. Further logins
+        # wait in line and are told their position every
+        # LOGIN_QUEUE_UPDATE_INTERVAL seconds.
+        self.LOGIN_MAX_CONCURRENT = 8
+        self.LOGIN_QUEUE_UPDATE_INTERVAL = 5
+        # How long (in seconds) players that lost their connection during a
+        # live game are let in ahead of the others, if they reconnect from the
+        # same address.
+        self.LOGIN_PRIORITY_TIME = 600
+
         self.DB_SERVER = "127.0.0.1"
         self.DB_PORT = 3306
         self.DB_LOGIN = "root"
@@ -89,12 +111,55 @@ class ConfigurationStore:
         self.LADDER_SEARCH_EXPANSION_STEP = 0.05
         # The maximum amount of time in seconds) to wait between pops.
         self.QUEUE_POP_TIME_MAX = 180
+        # The minimum amount of time (in seconds) between pops. Queues pop as
+        # soon as this much time has passed if they already have the desired
+        # number of good matches. Set to QUEUE_POP_TIME_MAX to only pop on the
+        # timer.
+        self.QUEUE_POP_TIME_MIN = 15
         # The number of possible matches we would like to have when the queue
         # pops. The queue pop time will be adjusted based on the current rate of
         # players queuing to try and hit this number.
         self.QUEUE_POP_DESIRED_MATCHES = 4
         # How many previous queue sizes to consider
         self.QUEUE_POP_TIME_MOVING_AVG_SIZE = 5
+        # When a queue pops, other queues whose next pop is at most this many
+        # seconds away pop early, so that all of them are matched in one pass
+        # and players that are in several of them get their best match.
+        self.MATCHMAKER_POP_ALIGN_TIME = 10
+        # The longest time (in seconds) that a pass waits for the queues that
+        # are going to pop with it.
+        self.MATCHMAKER_POP_WINDOW = 1
+        # The minimum amount of time (in seconds) between broadcasts of the
+        # `matchmaker_info` of a queue. Changes in between are sent together.
+        self.MATCHMAKER_INFO_INTERVAL = 2
+        # File that the rates at which players join each queue during every
+        # hour of the week are saved to, so that the pop times are right as
+        # soon as the server restarts. If empty, the rates are only kept in
+        # memory.
+        self.QUEUE_POP_RATES_FILE = ""
+        # How many seconds of pops the usual rate for the hour of the week
+        # counts as when it is blended with the moving average.
+        self.QUEUE_POP_RATE_PRIOR_SECONDS = 300
+        # How many weeks it takes for the usual rates to move halfway to the
+        # rates that players queue at now.
+        self.QUEUE_POP_RATE_HALF_LIFE_WEEKS = 4
+        # Maps queue names to the policy used for matching searches in that
+        # queue, either "stable_marriage" or "max_weight". Queues that aren't
+        # listed use stable marriage.
+        self.QUEUE_MATCHING_POLICIES = {}
+        # Whether teams of solo players are split to minimize the difference
+        # in total rating between the two teams of each game, instead of the
+        # rotation based split.
+        self.MATCHMAKER_BALANCE_TEAMS = False
+        # Seconds that each queue pop may spend on finding the best teams out
+        # of parties of different sizes, before making them greedily. If 0,
+        # they are always made greedily. This runs in a thread, not on the
+        # event loop.
+        self.MATCHMAKER_TEAM_COMPOSITION_BUDGET = 0.05
+        # The number of processes that run the matchmaking algorithm. If 0, it
+        # runs in a thread of the server process, where it competes with the
+        # event loop for the GIL. Read at startup.
+        self.MATCHMAKER_PROCESSES = 0
 
         self._defaults = {
             key: value for key, value in vars(self).items() if key.isupper()
@@ -4,6 +4,7 @@ Tiny local-only http server for getting stats and performing various tasks
 
 import socket
 from json import dumps
+from typing import Iterable
 
 from aiohttp import web
 
@@ -11,6 +12,7 @@ from .config import config
 from .decorators import with_logger
 from .game_service import GameService
 from .player_service import PlayerService
+from .servercontext import ServerContext
 
 
 @with_logger
@@ -20,10 +22,12 @@ class ControlServer:
         game_service: GameService,
         player_service: PlayerService,
         host: str,
-        port: int
+        port: int,
+        contexts: Iterable[ServerContext] = ()
     ):
         self.game_service = game_service
         self.player_service = player_service
+        self.contexts = contexts
         self.host = host
         self.port = port
 
@@ -32,7 +36,8 @@ class ControlServer:
 
         self.app.add_routes([
             web.get("/games", self.games),
-            web.get("/players", self.players)
+            web.get("/players", self.players),
+            web.get("/connections", self.connections)
         ])
 
     async def start(self) -> None:
@@ -54,10 +59,27 @@ class ControlServer:
         body = dumps(to_dict_list(self.player_service.all_players))
         return web.Response(body=body.encode(), content_type="application/json")
 
+    async def connections(self, request):
+        """
+        Send queue usage of every connection, most congested first.
+        """
+        connections = [
+            connection_info(ctx, conn, proto)
+            for ctx in self.contexts
+            for conn, proto in ctx.connections.items()
+        ]
+        connections.sort(
+            key=lambda info: info["queued_bytes"] + info["transport_bytes"],
+            reverse=True
+        )
+        body = dumps(connections)
+        return web.Response(body=body.encode(), content_type="application/json")
+
 
 async def run_control_server(
     player_service: PlayerService,
-    game_service: GameService
+    game_service: GameService,
+    contexts: Iterable[ServerContext] = ()
 ) -> ControlServer:
     """
     Initialize the http control server
@@ -65,7 +87,9 @@ async def run_control_server(
     host = socket.gethostbyname(socket.gethostname())
     port = config.CONTROL_SERVER_PORT
 
-    ctrl_server = ControlServer(game_service, player_service, host, port)
+    ctrl_server = ControlServer(
+        game_service, player_service, host, port, contexts
+    )
     await ctrl_server.start()
 
     return ctrl_server
@@ -73,3 +97,17 @@ async def run_control_server(
 
 def to_dict_list(list_):
     return list(map(lambda p: p.to_dict(), list_))
+
+
+def connection_info(ctx, conn, proto):
+    player = conn.player
+    return {
+        "server": ctx.name,
+        "address": conn.peer_address and conn.peer_address.host,
+        "player_id": player and player.id,
+        "login": player and player.login,
+        "queued_bytes": proto.queued_bytes,
+        "queued_messages": proto.queued_messages,
+        "transport_bytes": proto.transport_bytes,
+        "congested_seconds": proto.congested_for()
+    }
@@ -0,0 +1,107 @@
+"""
+Lookup tables for the handlers of the commands that clients send, which keep
+metrics for every command.
+"""
+
+import inspect
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+import server.metrics as metrics
+
+from .exceptions import AuthenticationError, BanError, ClientError
+
+Handler = Callable[..., Awaitable[None]]
+
+# Raised by handlers to tell the client that it did something wrong. These are
+# not counted as errors.
+CLIENT_ERRORS = (AuthenticationError, BanError, ClientError)
+
+
+class Command:
+    """
+    A command handler that records how often and how long it runs.
+
+    If `method` is given, the handler is looked up as that attribute of the
+    connection object on every call, so that subclasses and instances can
+    replace it. Otherwise `handler` is called directly.
+    """
+
+    __slots__ = ("name", "handler", "method", "_calls", "_errors", "_duration")
+
+    def __init__(
+        self,
+        connection: str,
+        name: str,
+        handler: Handler,
+        method: Optional[str] = None
+    ):
+        self.name = name
+        self.handler = handler
+        self.method = method
+        # Resolving the labels is comparatively slow, so it's done only once
+        self._calls = metrics.command_calls.labels(connection, name)
+        self._errors = metrics.command_errors.labels(connection, name)
+        self._duration = metrics.command_duration.labels(connection, name)
+
+    async def __call__(self, connection, *args) -> None:
+        self._calls.inc()
+        start = time.perf_counter()
+        try:
+            if self.method is None:
+                await self.handler(connection, *args)
+            else:
+                await getattr(connection, self.method)(*args)
+        except CLIENT_ERRORS:
+            raise
+        except Exception:
+            self._errors.inc()
+            raise
+        finally:
+            self._duration.observe(time.perf_counter() - start)
+
+
+class DispatchTable:
+    """
+    Maps command names to their handlers for one kind of connection. The
+    handlers are called with the connection object as the first argument.
+    """
+
+    def __init__(self, connection: str, handlers: Dict[str, Handler]):
+        self.connection = connection
+        self.commands = {
+            name: Command(connection, name, handler)
+            for name, handler in handlers.items()
+        }
+        self._unknown = metrics.unknown_commands.labels(connection)
+
+    @classmethod
+    def from_class(cls, connection: str, klass: type, prefix: str) -> "DispatchTable":
+        """
+        Build the table from all methods of `klass` and its base classes whose
+        name starts with `prefix`. The rest of the method name is the command
+        name. The methods are looked up on the connection object when the
+        command is called, like `getattr(connection, method)` would.
+        """
+        table = cls(connection, {})
+        for method, handler in inspect.getmembers(klass, callable):
+            if method.startswith(prefix):
+                name = method[len(prefix):]
+                table.commands[name] = Command(
+                    connection, name, handler, method
+                )
+
+        return table
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.commands
+
+    def __len__(self) -> int:
+        return len(self.commands)
+
+    def lookup(self, name: str) -> Optional[Command]:
+        command = self.commands.get(name)
+        if command is None:
+            self._unknown.inc()
+
+        return command
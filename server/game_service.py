@@ -6,6 +6,7 @@ import aiocron
 from server.config import config
 
 from . import metrics
+from .broadcast import DeltaTracker, SnapshotCache
 from .core import Service
 from .db import FAFDatabase
 from .decorators import with_logger
@@ -24,6 +25,7 @@ from .games.typedefs import EndedGameInfo
 from .matchmaker import MatchmakerQueue
 from .message_queue_service import MessageQueueService
 from .players import Player
+from .protocol import Protocol
 from .rating_service import RatingService
 
 
@@ -43,6 +45,9 @@ class GameService(Service):
         self._db = database
         self._dirty_games = set()
         self._dirty_queues = set()
+        self.game_deltas = DeltaTracker("uid")
+        # All open games as sent to clients on login
+        self.snapshot = SnapshotCache("game_info", "games")
         self.player_service = player_service
         self.game_stats_service = game_stats_service
         self._rating_service = rating_service
@@ -117,9 +122,32 @@ class GameService(Service):
         elif isinstance(obj, MatchmakerQueue):
             self._dirty_queues.add(obj)
 
+    def pop_dirty_queues(self, now: float) -> List[MatchmakerQueue]:
+        """
+        Take the dirty queues whose info may be broadcast again. The other
+        queues stay dirty until `MATCHMAKER_INFO_INTERVAL` seconds have passed
+        since their info was last broadcast.
+
+        :param now: the current `time.monotonic`
+        """
+        due = [
+            queue for queue in self._dirty_queues
+            if queue.info_broadcast_due(now)
+        ]
+        for queue in due:
+            queue.last_info_broadcast = now
+        self._dirty_queues.difference_update(due)
+        return due
+
     def clear_dirty(self):
         self._dirty_games = set()
-        self._dirty_queues = set()
+
+    def encode_snapshot(self, protocol_class: Type[Protocol]) -> bytes:
+        """
+        Return the encoded `game_info` messages for all open games as of the
+        last dirty report.
+        """
+        return self.snapshot.encode(protocol_class)
 
     def create_uid(self) -> int:
         self.game_id_counter += 1
@@ -224,6 +252,8 @@ class GameService(Service):
     def remove_game(self, game: Game):
         if game.id in self._games:
             del self._games[game.id]
+        self.game_deltas.invalidate(game.id)
+        self.snapshot.remove(game.id)
 
     def __getitem__(self, item: int) -> Game:
         return self._games[item]
@@ -9,6 +9,7 @@ from .abc.base_game import GameConnectionState
 from .config import TRACE
 from .db.models import coop_leaderboard, coop_map, teamkills
 from .decorators import with_logger
+from .dispatch import DispatchTable
 from .game_service import GameService
 from .games import Game, GameError, GameState, ValidityState, Victory
 from .player_service import PlayerService
@@ -196,14 +197,17 @@ class GameConnection(GpgNetServerProtocol):
         :param args: command arguments
         :return: None
         """
-        try:
-            await COMMAND_HANDLERS[command](self, *args)
-        except KeyError:
+        handler = COMMAND_HANDLERS.lookup(command)
+        if handler is None:
             self._logger.warning(
                 "Unrecognized command %s: %s from player %s",
                 command, args, self.player
             )
-        except (TypeError, ValueError):
+            return
+
+        try:
+            await handler(self, *args)
+        except (KeyError, TypeError, ValueError):
             self._logger.exception("Bad command arguments")
         except ConnectionError as e:
             raise e
@@ -554,7 +558,7 @@ class GameConnection(GpgNetServerProtocol):
         return "GameConnection({}, {})".format(self.player, self.game)
 
 
-COMMAND_HANDLERS = {
+COMMAND_HANDLERS = DispatchTable("game", {
     "Desync":               GameConnection.handle_desync,
     "GameState":            GameConnection.handle_game_state,
     "GameOption":           GameConnection.handle_game_option,
@@ -576,4 +580,4 @@ COMMAND_HANDLERS = {
     "IceMsg":               GameConnection.handle_ice_message,
     "Chat":                 GameConnection.handle_chat,
     "GameFull":             GameConnection.handle_game_full
-}
+})
@@ -1,8 +1,11 @@
 import asyncio
 import json
+import multiprocessing
 import random
 import re
+import time
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from typing import Dict, List, Optional, Set, Tuple
 
 import aiocron
@@ -31,6 +34,10 @@ from .decorators import with_logger
 from .game_service import GameService
 from .games import LadderGame
 from .matchmaker import MapPool, MatchmakerQueue, OnMatchedCallback, Search
+from .matchmaker.algorithm import MATCHING_POLICIES
+from .matchmaker.arrival_rates import ArrivalRateStore
+from .matchmaker.coordinator import MatchmakingCoordinator
+from .matchmaker.map_history import MapHistory
 from .players import Player, PlayerState
 from .types import GameLaunchOptions, Map, NeroxisGeneratedMap
 
@@ -50,12 +57,32 @@ class LadderService(Service):
         self._informed_players: Set[Player] = set()
         self.game_service = game_service
         self.queues = {}
+        self._process_pool: Optional[ProcessPoolExecutor] = None
+        # Matches the queues that pop at the same time together
+        self._coordinator = MatchmakingCoordinator()
+        # How busy each queue usually is, for their pop timers
+        self._arrival_rates = ArrivalRateStore()
+        # The maps of the recent games of each player, so that choosing a map
+        # doesn't need to query the database
+        self._map_history = MapHistory()
 
         self._searches: Dict[Player, Dict[str, Search]] = defaultdict(dict)
 
     async def initialize(self) -> None:
+        if config.MATCHMAKER_PROCESSES > 0:
+            # Forking would copy the sockets and database connections of the
+            # server into the workers
+            self._process_pool = ProcessPoolExecutor(
+                max_workers=config.MATCHMAKER_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        if config.QUEUE_POP_RATES_FILE:
+            self._arrival_rates.load(config.QUEUE_POP_RATES_FILE)
         await self.update_data()
         self._update_cron = aiocron.crontab("*/10 * * * *", func=self.update_data)
+        self._save_arrival_rates_cron = aiocron.crontab(
+            "*/10 * * * *", func=self.save_arrival_rates
+        )
 
     async def update_data(self) -> None:
         async with self._db.acquire() as conn:
@@ -72,6 +99,10 @@ class LadderService(Service):
                     featured_mod=info["mod"],
                     rating_type=info["rating_type"],
                     team_size=info["team_size"],
+                    matching_policy=self._get_matching_policy(name),
+                    process_pool=self._process_pool,
+                    coordinator=self._coordinator,
+                    arrival_rates=self._arrival_rates.get(name),
                 )
                 self.queues[name] = queue
                 queue.initialize()
@@ -80,6 +111,7 @@ class LadderService(Service):
                 queue.featured_mod = info["mod"]
                 queue.rating_type = info["rating_type"]
                 queue.team_size = info["team_size"]
+                queue.matching_policy = self._get_matching_policy(name)
             queue.map_pools.clear()
             for map_pool_id, min_rating, max_rating in info["map_pools"]:
                 map_pool_name, map_list = map_pool_maps[map_pool_id]
@@ -101,6 +133,35 @@ class LadderService(Service):
                 self.queues[queue_name].shutdown()
                 del self.queues[queue_name]
 
+        self._map_history.prune(time.time())
+
+    async def save_arrival_rates(self) -> None:
+        if not config.QUEUE_POP_RATES_FILE:
+            return
+
+        try:
+            self._arrival_rates.save(config.QUEUE_POP_RATES_FILE)
+        except OSError:
+            self._logger.exception(
+                "Failed to save queue arrival rates to %s",
+                config.QUEUE_POP_RATES_FILE
+            )
+
+    def _get_matching_policy(self, queue_name: str) -> str:
+        policy = config.QUEUE_MATCHING_POLICIES.get(
+            queue_name, "stable_marriage"
+        )
+        if policy not in MATCHING_POLICIES:
+            self._logger.warning(
+                "Unknown matching policy '%s' for queue %s, using stable "
+                "marriage instead",
+                policy,
+                queue_name
+            )
+            return "stable_marriage"
+
+        return policy
+
     async def fetch_map_pools(self, conn) -> Dict[int, Tuple[str, List[Map]]]:
         result = await conn.execute(
             select([
@@ -464,6 +525,10 @@ class LadderService(Service):
                 ])
             await game.wait_launched(60 + 10 * len(all_guests))
             self._logger.debug("Ladder game launched successfully")
+            for player in game.players:
+                self._map_history.add(
+                    player.id, queue.id, (game.launched_at, game.id, game.map_id)
+                )
         except Exception:
             if game:
                 await game.on_game_end()
@@ -481,30 +546,63 @@ class LadderService(Service):
         queue_id: int,
         limit: int = 3
     ) -> List[int]:
+        """
+        The maps of the most recent games that each player played in the
+        queue during the last day, newest first for each player.
+
+        The games are remembered, so the database is only queried for players
+        whose games in the queue haven't been loaded yet.
+        """
+        missing = [
+            player.id for player in players
+            if not self._map_history.is_loaded(player.id, queue_id)
+        ]
+        if missing:
+            await self._load_game_history(missing, queue_id)
+
+        now = time.time()
+        return [
+            map_id
+            for player in players
+            for map_id in self._map_history.recent_maps(
+                player.id, queue_id, limit, now
+            )
+        ]
+
+    async def _load_game_history(
+        self,
+        player_ids: List[int],
+        queue_id: int
+    ) -> None:
+        query = select([
+            game_player_stats.c.playerId,
+            game_stats.c.id,
+            game_stats.c.mapId,
+            func.UNIX_TIMESTAMP(game_stats.c.startTime).label("start_time"),
+        ]).select_from(
+            game_player_stats
+            .join(game_stats)
+            .join(matchmaker_queue_game)
+        ).where(
+            and_(
+                game_player_stats.c.playerId.in_(player_ids),
+                game_stats.c.startTime >= func.DATE_SUB(
+                    func.now(),
+                    text("interval 1 day")
+                ),
+                matchmaker_queue_game.c.matchmaker_queue_id == queue_id
+            )
+        )
+
+        entries = defaultdict(list)
         async with self._db.acquire() as conn:
-            result = []
-            for player in players:
-                query = select([
-                    game_stats.c.mapId,
-                ]).select_from(
-                    game_player_stats
-                    .join(game_stats)
-                    .join(matchmaker_queue_game)
-                ).where(
-                    and_(
-                        game_player_stats.c.playerId == player.id,
-                        game_stats.c.startTime >= func.DATE_SUB(
-                            func.now(),
-                            text("interval 1 day")
-                        ),
-                        matchmaker_queue_game.c.matchmaker_queue_id == queue_id
-                    )
-                ).order_by(game_stats.c.startTime.desc()).limit(limit)
+            async for row in await conn.execute(query):
+                entries[row.playerId].append(
+                    (float(row.start_time), row.id, row.mapId)
+                )
 
-                result.extend([
-                    row.mapId async for row in await conn.execute(query)
-                ])
-        return result
+        for player_id in player_ids:
+            self._map_history.load(player_id, queue_id, entries[player_id])
 
     def on_connection_lost(self, conn: "LobbyConnection") -> None:
         if not conn.player:
@@ -520,6 +618,11 @@ class LadderService(Service):
         for queue in self.queues.values():
             queue.shutdown()
 
+        await self.save_arrival_rates()
+
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=False)
+
 
 def game_name(*teams: List[Player]) -> str:
     """
@@ -3,11 +3,12 @@ import contextlib
 import hashlib
 import json
 import random
+import time
 import urllib.parse
 import urllib.request
 from datetime import datetime
 from functools import wraps
-from typing import Optional
+from typing import Optional, Set
 
 import aiohttp
 import pymysql
@@ -28,6 +29,7 @@ from .db.models import (
 )
 from .db.models import login as t_login
 from .decorators import timed, with_logger
+from .dispatch import DispatchTable
 from .exceptions import AuthenticationError, BanError, ClientError
 from .factions import Faction
 from .game_service import GameService
@@ -37,6 +39,7 @@ from .geoip_service import GeoIpService
 from .ice_servers.coturn import CoturnHMAC
 from .ice_servers.nts import TwilioNTS
 from .ladder_service import LadderService
+from .login_admission import LoginAdmission
 from .party_service import PartyService
 from .player_service import PlayerService
 from .players import Player, PlayerState
@@ -56,7 +59,8 @@ class LobbyConnection:
         nts_client: Optional[TwilioNTS],
         geoip: GeoIpService,
         ladder_service: LadderService,
-        party_service: PartyService
+        party_service: PartyService,
+        login_admission: Optional[LoginAdmission] = None
     ):
         self._db = database
         self.geoip_service = geoip
@@ -66,6 +70,7 @@ class LobbyConnection:
         self.coturn_generator = CoturnHMAC(config.COTURN_HOSTS, config.COTURN_KEYS)
         self.ladder_service = ladder_service
         self.party_service = party_service
+        self.login_admission = login_admission
         self._authenticated = False
         self.player = None  # type: Player
         self.game_connection = None  # type: GameConnection
@@ -74,6 +79,15 @@ class LobbyConnection:
         self.protocol: Protocol = None
         self.user_agent = None
         self.version = None
+        # Time at which the client received its initial `player_info` and
+        # `game_info` snapshot, if it supports delta updates
+        self.delta_updates_since: Optional[float] = None
+        # Ids of the games whose current state the client has received in
+        # full, which it can receive deltas for
+        self.seen_games: Set[int] = set()
+        # Whether the client wants `matchmaker_info` with the number of
+        # searches per rating band instead of the boundaries of every search
+        self.compact_matchmaker_info = False
 
         self._attempted_connectivity_test = False
 
@@ -138,8 +152,14 @@ class LobbyConnection:
                 self._attempted_connectivity_test = True
                 raise ClientError("Your client version is no longer supported. Please update to the newest version: https://faforever.com")
 
-            handler = getattr(self, "command_{}".format(cmd))
-            await handler(message)
+            handler = COMMAND_HANDLERS.lookup(cmd)
+            if handler is None:
+                self._logger.warning("Unrecognized command %s", cmd)
+                await self.send({"command": "invalid"})
+                await self.abort("Error processing command")
+                return
+
+            await handler(self, message)
 
         except AuthenticationError as ex:
             await self.send({
@@ -217,14 +237,19 @@ class LobbyConnection:
     async def command_matchmaker_info(self, message):
         await self.send({
             "command": "matchmaker_info",
-            "queues": [queue.to_dict() for queue in self.ladder_service.queues.values()]
+            "queues": [
+                queue.to_dict(compact=self.compact_matchmaker_info)
+                for queue in self.ladder_service.queues.values()
+            ]
         })
 
     async def send_game_list(self):
-        await self.send({
-            "command": "game_info",
-            "games": [game.to_dict() for game in self.game_service.open_games]
-        })
+        data = self.game_service.encode_snapshot(type(self.protocol))
+        self.seen_games = set(self.game_service.snapshot.keys())
+        if data:
+            await self.send_raw(data)
+        else:
+            await self.send({"command": "game_info", "games": []})
 
     async def command_social_remove(self, message):
         if "friend" in message:
@@ -246,6 +271,8 @@ class LobbyConnection:
         with contextlib.suppress(KeyError):
             player_attr.remove(subject_id)
 
+        self._resend_hosted_game()
+
     async def command_social_add(self, message):
         if "friend" in message:
             status = "FRIEND"
@@ -267,6 +294,18 @@ class LobbyConnection:
 
         player_attr.add(subject_id)
 
+        self._resend_hosted_game()
+
+    def _resend_hosted_game(self):
+        """
+        Changes to the host's friends and foes change who can see their game.
+        Players who haven't seen the game receive the full object with the
+        next broadcast.
+        """
+        game = self.game_connection and self.game_connection.game
+        if game is not None and game.host == self.player:
+            self.game_service.mark_dirty(game)
+
     async def kick(self):
         await self.send({
             "command": "notice",
@@ -495,6 +534,28 @@ class LobbyConnection:
         return response.get("result", "") == "honest"
 
     async def command_hello(self, message):
+        if self.login_admission is None:
+            await self._login(message)
+            return
+
+        async with self.login_admission.admit(
+            message["login"].strip(),
+            self.peer_address.host,
+            self.send_login_queue_position
+        ):
+            # Don't waste a slot on clients that gave up while waiting
+            if not self.protocol.is_connected():
+                raise DisconnectedError("Disconnected while waiting to log in")
+
+            await self._login(message)
+
+    async def send_login_queue_position(self, position: int):
+        await self.send({
+            "command": "login_queue",
+            "position": position
+        })
+
+    async def _login(self, message):
         login = message["login"].strip()
         password = message["password"]
 
@@ -561,6 +622,9 @@ class LobbyConnection:
         await self.player_service.fetch_player_data(self.player)
 
         self.player_service[self.player.id] = self.player
+        self.compact_matchmaker_info = bool(
+            message.get("compact_matchmaker_info")
+        )
         self._authenticated = True
 
         # Country
@@ -578,9 +642,14 @@ class LobbyConnection:
         })
 
         # Tell player about everybody online. This must happen after "welcome".
+        # The snapshot is from the last dirty report, so it might not contain
+        # us yet.
+        snapshot = self.player_service.encode_snapshot(type(self.protocol))
+        if snapshot:
+            self.protocol.write_raw(snapshot)
         await self.send({
             "command": "player_info",
-            "players": [player.to_dict() for player in self.player_service]
+            "players": [self.player.to_dict()]
         })
 
         # Tell everyone else online about us. This must happen after all the player_info messages.
@@ -631,6 +700,9 @@ class LobbyConnection:
 
         await self.send_game_list()
 
+        if message.get("delta_updates"):
+            self.delta_updates_since = time.monotonic()
+
     async def command_restore_game_session(self, message):
         assert self.player is not None
 
@@ -970,10 +1042,12 @@ class LobbyConnection:
                                    comments=[], description=description, played=played, likes=likes,
                                    downloads=downloads, date=int(date.timestamp()), uid=uid, name=name, version=version, author=author,
                                    ui=ui)
-                        await self.send(out)
+                        self.write(out)
                     except:
                         self._logger.error("Error handling table_mod row (uid: {})".format(uid), exc_info=True)
 
+                await self.protocol.flush()
+
             elif type == "like":
                 canLike = True
                 uid = message["uid"]
@@ -1112,9 +1186,20 @@ class LobbyConnection:
             asyncio.create_task(self.abort(message))
 
     async def send(self, message):
-        """Send a message and wait for it to be sent."""
+        """
+        Send a message and wait for it to be flushed. Messages sent during the
+        same event loop iteration are flushed together.
+        """
         self.write(message)
-        await self.protocol.drain()
+        await self.protocol.flush()
+
+    async def send_raw(self, data: bytes):
+        """
+        Send data that was already encoded for our protocol and wait for it to
+        be flushed.
+        """
+        self.protocol.write_raw(data)
+        await self.protocol.flush()
 
     def write(self, message):
         """Write a message into the send buffer."""
@@ -1126,6 +1211,18 @@ class LobbyConnection:
             return
         self.send = nop
 
+        if (
+            self.login_admission is not None
+            and self.player is not None
+            and self.player.game is not None
+            and self.player.game.state is GameState.LIVE
+        ):
+            # Let them back in quickly to restore their game session
+            self.login_admission.grant_priority(
+                self.player.login,
+                self.peer_address.host
+            )
+
         if self.game_connection:
             self._logger.debug(
                 "Lost lobby connection killing game connection for player %s",
@@ -1152,3 +1249,8 @@ class LobbyConnection:
                 self._logger.debug("Aborting connection of banned user: %s, %s, %s",
                                    self.player.id, self.player.login, self.session)
                 raise BanError(ban_expiry, ban_reason)
+
+
+COMMAND_HANDLERS = DispatchTable.from_class(
+    "lobby", LobbyConnection, "command_"
+)
@@ -0,0 +1,213 @@
+"""
+Admission control for logins.
+
+Every login runs a number of database queries and a request to the policy
+server, and ends with sending the lists of online players and games. When the
+server restarts, all clients reconnect at the same time. So only a limited
+number of logins is processed at once and the others wait in line. Players
+whose connection dropped while they were in a live game are let in first, so
+that they can restore their game session.
+
+Logins wait in line before they are authenticated, so the login name alone
+can't be trusted to decide who goes first. Priority is therefore given to a
+login name together with the address that the player was connected from. A
+player whose address changed while reconnecting waits in the normal line.
+"""
+
+import asyncio
+import contextlib
+import time
+from collections import OrderedDict, deque
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Optional,
+    Tuple
+)
+
+import server.metrics as metrics
+
+from .config import config
+
+# Called with the position of a waiting login, starting at 1
+PositionCallback = Callable[[int], Awaitable[None]]
+# Login name and host address
+PriorityKey = Tuple[str, str]
+
+
+class _Line:
+    """Logins of one priority waiting in order of arrival"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.waiting = 0
+        # Futures of logins that gave up stay in here until they are popped
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._joined = 0
+        self._left = 0
+
+    def join(self) -> Tuple[int, asyncio.Future]:
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        ticket = self._joined
+        self._joined += 1
+        self.waiting += 1
+
+        return ticket, waiter
+
+    def give_up(self, waiter: asyncio.Future) -> None:
+        waiter.cancel()
+        self.waiting -= 1
+
+    def pop(self) -> Optional[asyncio.Future]:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            self._left += 1
+            if not waiter.done():
+                self.waiting -= 1
+                return waiter
+
+        return None
+
+    def ahead_of(self, ticket: int) -> int:
+        """
+        Number of logins that are in line before `ticket`. Logins that gave up
+        are still counted until their turn would have come.
+        """
+        return ticket - self._left
+
+
+class LoginAdmission:
+    """
+    Limits the number of logins that are processed concurrently to
+    `config.LOGIN_MAX_CONCURRENT`.
+    """
+
+    def __init__(self):
+        self.active = 0
+        self._priority = _Line("priority")
+        self._normal = _Line("normal")
+        # Login names and addresses mapped to the time until which they have
+        # priority
+        self._priority_logins: Dict[PriorityKey, float] = OrderedDict()
+
+    @property
+    def waiting(self) -> int:
+        return self._priority.waiting + self._normal.waiting
+
+    def grant_priority(self, login: str, host: str) -> None:
+        """
+        Let the next logins of `login` from `host` skip the normal line for
+        `config.LOGIN_PRIORITY_TIME` seconds.
+        """
+        now = time.monotonic()
+        key = (login, host)
+        self._priority_logins.pop(key, None)
+        self._priority_logins[key] = now + config.LOGIN_PRIORITY_TIME
+
+        # Entries are in order of expiry
+        while self._priority_logins:
+            key, expires = next(iter(self._priority_logins.items()))
+            if expires >= now:
+                break
+            del self._priority_logins[key]
+
+    def has_priority(self, login: str, host: str) -> bool:
+        key = (login, host)
+        expires = self._priority_logins.get(key)
+        if expires is None:
+            return False
+        if expires < time.monotonic():
+            del self._priority_logins[key]
+            return False
+
+        return True
+
+    @contextlib.asynccontextmanager
+    async def admit(
+        self,
+        login: str,
+        host: str,
+        on_position: Optional[PositionCallback] = None
+    ) -> AsyncIterator[None]:
+        """
+        Wait until the login may be processed. While waiting, `on_position`
+        is called with the position in line every
+        `config.LOGIN_QUEUE_UPDATE_INTERVAL` seconds.
+        """
+        start = time.monotonic()
+        if self.has_priority(login, host):
+            line = self._priority
+        else:
+            line = self._normal
+
+        if self.waiting or self.active >= config.LOGIN_MAX_CONCURRENT:
+            await self._wait(line, on_position)
+        else:
+            self.active += 1
+            self._update_metrics()
+
+        metrics.login_queue_wait.labels(line.name).observe(
+            time.monotonic() - start
+        )
+        try:
+            yield
+        finally:
+            self._release()
+            metrics.login_duration.observe(time.monotonic() - start)
+
+    async def _wait(
+        self,
+        line: _Line,
+        on_position: Optional[PositionCallback]
+    ) -> None:
+        ticket, waiter = line.join()
+        # The limit might have been raised
+        self._admit_waiters()
+        try:
+            while not waiter.done():
+                if on_position is not None:
+                    await on_position(self._position(line, ticket))
+
+                await asyncio.wait(
+                    (waiter, ),
+                    timeout=config.LOGIN_QUEUE_UPDATE_INTERVAL
+                )
+        except BaseException:
+            if waiter.done():
+                # We were already given a slot
+                self._release()
+            else:
+                line.give_up(waiter)
+                self._update_metrics()
+            raise
+
+    def _position(self, line: _Line, ticket: int) -> int:
+        position = line.ahead_of(ticket) + 1
+        if line is self._normal:
+            position += self._priority.waiting
+
+        return position
+
+    def _release(self) -> None:
+        self.active -= 1
+        self._admit_waiters()
+
+    def _admit_waiters(self) -> None:
+        while self.active < config.LOGIN_MAX_CONCURRENT:
+            waiter = self._priority.pop() or self._normal.pop()
+            if waiter is None:
+                break
+
+            self.active += 1
+            waiter.set_result(None)
+
+        self._update_metrics()
+
+    def _update_metrics(self) -> None:
+        metrics.logins_in_progress.set(self.active)
+        for line in (self._priority, self._normal):
+            metrics.login_queue_depth.labels(line.name).set(line.waiting)
@@ -1,32 +1,65 @@
+import bisect
+import heapq
 import itertools
+import logging
 import math
 import random
-import statistics as stats
+import time
 from collections import OrderedDict
 from typing import (
     Dict,
+    Hashable,
     Iterable,
     Iterator,
     List,
     Optional,
     Set,
     Tuple,
+    Type,
     TypeVar
 )
 
 from ..decorators import with_logger
-from .search import CombinedSearch, Match, Search
+from .max_weight_matching import (
+    banded_max_weight_matching,
+    bandwidth,
+    max_weight_matching
+)
+from .quality import pair_qualities, quality_matrix, team_quality
+from .search import CombinedSearch, Match, RatingSnapshot, Search
+from .team_composition import TimeBudgetExceeded, compose_teams
+
+logger = logging.getLogger(__name__)
 
 T = TypeVar("T")
 WeightedGraph = Dict[Search, List[Tuple[Search, float]]]
 Buckets = Dict[Search, List[Tuple[Search, float]]]
 
 
-def make_matches(searches: Iterable[Search]) -> List[Match]:
+# Qualities are scaled to integers for the maximum weight matching, which
+# is exact with integer weights
+QUALITY_SCALE = 10 ** 9
+# Fewer searches than this are matched by checking every possible edge,
+# instead of only the edges between searches close in `avg_mean`
+FULL_GRAPH_SEARCHES = 30
+# Graphs where no search has an edge to a search more than this many places
+# away in the order of `avg_mean` are matched with the faster algorithm
+MAX_BANDWIDTH = 8
+
+
+def make_matches(
+    searches: Iterable[Search],
+    policy: str = "stable_marriage",
+    graph: Optional["IncrementalMatchingGraph"] = None
+) -> List[Match]:
     """
     Main entrypoint for the matchmaker algorithm.
+
+    :param policy: the name of one of the `MATCHING_POLICIES`
+    :param graph: a graph that is kept between calls, to only recompute the
+        parts that changed since the last call
     """
-    return Matchmaker(searches).find()
+    return Matchmaker(searches, policy, graph).find()
 
 
 @with_logger
@@ -106,6 +139,45 @@ class StableMarriage(MatchmakingPolicy):
             self._match(search, preferred)
 
 
+class MaximumWeightMatching(MatchmakingPolicy):
+    def find(self, ranks: WeightedGraph) -> Dict[Search, Search]:
+        """ Find the matching with the highest total quality. Unlike stable
+        marriage this considers all possible matchings at once, so a search
+        may be matched with an opponent other than its favorite if that allows
+        better games for everyone else.
+        """
+        self.matches.clear()
+
+        # `build_fast` only adds edges between searches that are close in
+        # this order
+        searches = sorted(ranks, key=avg_mean)
+        index = {search: i for i, search in enumerate(searches)}
+        edges = [
+            (i, index[other], round(quality * QUALITY_SCALE))
+            for i, search in enumerate(searches)
+            for other, quality in ranks[search]
+            if i < index[other]
+        ]
+
+        if bandwidth(edges) <= MAX_BANDWIDTH:
+            mates = banded_max_weight_matching(edges)
+        else:
+            mates = max_weight_matching(edges)
+
+        for i, j in enumerate(mates):
+            if i < j:
+                self._match(searches[i], searches[j])
+
+        return self.matches
+
+
+# Policies for matching searches based on the quality graph
+MATCHING_POLICIES: Dict[str, Type[MatchmakingPolicy]] = {
+    "stable_marriage": StableMarriage,
+    "max_weight": MaximumWeightMatching
+}
+
+
 class RandomlyMatchNewbies(MatchmakingPolicy):
     def find(self, searches: Iterable[Search]) -> Dict[Search, Search]:
         self.matches.clear()
@@ -135,19 +207,28 @@ class RandomlyMatchNewbies(MatchmakingPolicy):
 
 @with_logger
 class Matchmaker(object):
-    def __init__(self, searches: Iterable[Search]):
+    def __init__(
+        self,
+        searches: Iterable[Search],
+        policy: str = "stable_marriage",
+        graph: Optional["IncrementalMatchingGraph"] = None
+    ):
         self.searches = searches
+        self.policy = MATCHING_POLICIES[policy]
+        self.graph = graph
         self.matches: Dict[Search, Search] = {}
 
     def find(self) -> List[Match]:
-        self._logger.debug("Matching with stable marriage...")
+        self._logger.debug("Matching with %s...", self.policy.__name__)
         searches = list(self.searches)
-        if len(searches) < 30:
+        if len(searches) < FULL_GRAPH_SEARCHES:
             ranks = _MatchingGraph.build_full(searches)
+        elif self.graph is not None:
+            ranks = self.graph.build(searches)
         else:
             ranks = _MatchingGraph.build_fast(searches)
         _MatchingGraph.remove_isolated(ranks)
-        self.matches.update(StableMarriage().find(ranks))
+        self.matches.update(self.policy().find(ranks))
 
         remaining_searches = [
             search for search in self.searches if search not in self.matches
@@ -197,10 +278,12 @@ class _MatchingGraph:
         Time complexity: O(n^2)
         """
         adj_list = {search: [] for search in searches}
+        qualities = quality_matrix(searches)
 
         # Generate every edge. There are 'len(searches) choose 2' of these.
-        for search, other in itertools.combinations(searches, 2):
-            quality = search.quality_with(other)
+        for i, j in itertools.combinations(range(len(searches)), 2):
+            search, other = searches[i], searches[j]
+            quality = float(qualities[i][j])
             if not _MatchingGraph.is_possible_match(search, other, quality):
                 continue
 
@@ -226,15 +309,19 @@ class _MatchingGraph:
         searches = sorted(searches, key=avg_mean)
         # Now compute quality with `num_to_check` nearby searches on either side
         num_to_check = int(math.log(max(16, len(searches)), 2)) // 2
-        for i, search in enumerate(searches):
-            for other in searches[i+1:i+1+num_to_check]:
-                quality = search.quality_with(other)
-                if not _MatchingGraph.is_possible_match(search, other, quality):
-                    continue
+        pairs = [
+            (i, j)
+            for i in range(len(searches))
+            for j in range(i + 1, min(i + 1 + num_to_check, len(searches)))
+        ]
+        for (i, j), quality in zip(pairs, pair_qualities(searches, pairs)):
+            search, other = searches[i], searches[j]
+            if not _MatchingGraph.is_possible_match(search, other, quality):
+                continue
 
-                # Add the edge in both directions
-                adj_list[search].append((other, quality))
-                adj_list[other].append((search, quality))
+            # Add the edge in both directions
+            adj_list[search].append((other, quality))
+            adj_list[other].append((search, quality))
 
         # Sort edges by their weights i.e. match quality
         for search, neighbors in adj_list.items():
@@ -274,12 +361,281 @@ class _MatchingGraph:
                 del graph[search]
 
 
+# A node of the `IncrementalMatchingGraph`
+Node = Hashable
+
+
+def graph_node(search: Search) -> Node:
+    """
+    The node of a search in the `IncrementalMatchingGraph`. Teams are built
+    from parties again on every pop, so their node is the set of parties in
+    them. A team that is put together from the same parties again is then the
+    same node.
+    """
+    if isinstance(search, CombinedSearch):
+        return frozenset(search.searches)
+    return search
+
+
+class _SortedNodes:
+    """ Nodes sorted by a key, kept in blocks of at most `2 * BLOCK_SIZE`
+    nodes. Adding or removing a node only moves the nodes of its block, and the
+    block is found by bisecting the largest key of every block.
+
+    Time complexity: O(log(n) + BLOCK_SIZE + n / BLOCK_SIZE) for adding,
+    removing and finding a node.
+    """
+
+    BLOCK_SIZE = 64
+
+    def __init__(self):
+        self._keys: List[List[float]] = []
+        self._nodes: List[List[Node]] = []
+        # The largest key of every block
+        self._maxes: List[float] = []
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self) -> Iterator[Node]:
+        return itertools.chain.from_iterable(self._nodes)
+
+    def add(self, key: float, node: Node) -> None:
+        self._len += 1
+        if not self._maxes:
+            self._keys.append([key])
+            self._nodes.append([node])
+            self._maxes.append(key)
+            return
+
+        block = min(
+            bisect.bisect_right(self._maxes, key), len(self._maxes) - 1
+        )
+        keys, nodes = self._keys[block], self._nodes[block]
+        index = bisect.bisect_right(keys, key)
+        keys.insert(index, key)
+        nodes.insert(index, node)
+        self._maxes[block] = keys[-1]
+
+        if len(keys) > 2 * self.BLOCK_SIZE:
+            self._keys.insert(block + 1, keys[self.BLOCK_SIZE:])
+            self._nodes.insert(block + 1, nodes[self.BLOCK_SIZE:])
+            del keys[self.BLOCK_SIZE:]
+            del nodes[self.BLOCK_SIZE:]
+            self._maxes[block] = keys[-1]
+            self._maxes.insert(block + 1, self._keys[block + 1][-1])
+
+    def remove(self, key: float, node: Node) -> None:
+        block, index = self._locate(key, node)
+        keys, nodes = self._keys[block], self._nodes[block]
+        del keys[index]
+        del nodes[index]
+        self._len -= 1
+        if keys:
+            self._maxes[block] = keys[-1]
+        else:
+            del self._keys[block]
+            del self._nodes[block]
+            del self._maxes[block]
+
+    def neighbors(
+        self,
+        key: float,
+        node: Node,
+        count: int
+    ) -> Tuple[List[Node], List[Node]]:
+        """ Return up to `count` nodes before and after the node. """
+        block, index = self._locate(key, node)
+
+        before: List[Node] = []
+        end = index
+        for nodes in reversed(self._nodes[:block + 1]):
+            if end is None:
+                end = len(nodes)
+            before[:0] = nodes[max(0, end - (count - len(before))):end]
+            end = None
+            if len(before) == count:
+                break
+
+        after: List[Node] = []
+        start = index + 1
+        for nodes in itertools.islice(self._nodes, block, None):
+            after.extend(nodes[start:start + count - len(after)])
+            start = 0
+            if len(after) == count:
+                break
+
+        return before, after
+
+    def _locate(self, key: float, node: Node) -> Tuple[int, int]:
+        block = bisect.bisect_left(self._maxes, key)
+        index = bisect.bisect_left(self._keys[block], key)
+        # Nodes with the same key may continue in the next block
+        while self._nodes[block][index] != node:
+            index += 1
+            if index == len(self._nodes[block]):
+                block += 1
+                index = 0
+        return block, index
+
+
+@with_logger
+class IncrementalMatchingGraph:
+    """ Builds the same graph as `_MatchingGraph.build_fast`, but keeps the
+    searches ordered by `avg_mean` and the qualities and edges between them
+    from one call to the next. Only the edges of searches that were added or
+    removed since the last call, whose ratings changed or whose threshold
+    changed, and of their neighbors, are computed again. So the cost depends
+    on how much the queue changed rather than on its size.
+
+    Searches are identified by their `graph_node`, so teams that are put
+    together from the same parties on the next pop keep their edges. The
+    threshold of a search changes whenever it fails to be matched, until its
+    search range stops widening after a few pops.
+
+    Time complexity: O(c*(log(n) + n/BLOCK_SIZE)) for `c` changed searches.
+    Finding the changes and copying the graph is linear, but cheap in
+    comparison.
+    """
+
+    def __init__(self):
+        # The nodes sorted by `avg_mean`
+        self._order = _SortedNodes()
+        self._snapshots: Dict[Node, RatingSnapshot] = {}
+        self._thresholds: Dict[Node, float] = {}
+        self._num_to_check = 0
+        # The qualities with all nodes that are close in the order
+        self._qualities: Dict[Node, Dict[Node, float]] = {}
+        # The acceptable edges of every node, sorted by quality
+        self._edges: Dict[Node, List[Tuple[Node, float]]] = {}
+        # Nodes whose edges need to be computed again
+        self._dirty: Set[Node] = set()
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def __contains__(self, search: Search) -> bool:
+        return graph_node(search) in self._snapshots
+
+    def build(self, searches: List[Search]) -> WeightedGraph:
+        """ Update the graph to contain exactly `searches` and return it.
+        Searches without any edges are left out.
+
+        The returned adjacency lists are copies, so they can be modified.
+        """
+        nodes = {graph_node(search): search for search in searches}
+        for node in list(self._snapshots):
+            search = nodes.get(node)
+            if search is None or _snapshot_changed(
+                search.rating_snapshot, self._snapshots[node]
+            ):
+                self._remove(node)
+        for node, search in nodes.items():
+            if node not in self._snapshots:
+                self._add(node, search.rating_snapshot)
+
+        num_to_check = int(math.log(max(16, len(self._order)), 2)) // 2
+        if num_to_check != self._num_to_check:
+            self._num_to_check = num_to_check
+            self._dirty.update(self._order)
+
+        for node, search in nodes.items():
+            threshold = search.match_threshold
+            if threshold != self._thresholds.get(node):
+                self._thresholds[node] = threshold
+                self._mark_dirty(node)
+
+        self._logger.debug(
+            "Updating edges of %d out of %d searches",
+            len(self._dirty), len(self._order)
+        )
+        for node in self._dirty:
+            self._update_edges(node)
+        self._dirty.clear()
+
+        return {
+            search: [
+                (nodes[other], quality)
+                for other, quality in self._edges[node]
+            ]
+            for node, search in nodes.items()
+            if self._edges[node]
+        }
+
+    def _add(self, node: Node, snapshot: RatingSnapshot) -> None:
+        self._order.add(snapshot.avg_mean, node)
+        self._snapshots[node] = snapshot
+        self._qualities[node] = {}
+        self._edges[node] = []
+        # The new node takes a place in the windows of its neighbors
+        self._mark_dirty(node)
+
+    def _remove(self, node: Node) -> None:
+        # The windows of the neighbors move over the gap
+        self._mark_dirty(node)
+        self._dirty.discard(node)
+        self._order.remove(self._snapshots[node].avg_mean, node)
+        del self._snapshots[node]
+        self._thresholds.pop(node, None)
+        del self._edges[node]
+        for other in self._qualities.pop(node):
+            self._qualities[other].pop(node, None)
+
+    def _neighbors(self, node: Node) -> Tuple[List[Node], List[Node]]:
+        return self._order.neighbors(
+            self._snapshots[node].avg_mean, node, self._num_to_check
+        )
+
+    def _mark_dirty(self, node: Node) -> None:
+        """ Mark the node and all nodes within the window to each side of it
+        as dirty.
+        """
+        # Windows grow when `num_to_check` changes, but then all nodes are
+        # marked dirty anyway
+        before, after = self._neighbors(node)
+        self._dirty.add(node)
+        self._dirty.update(before)
+        self._dirty.update(after)
+
+    def _update_edges(self, node: Node) -> None:
+        before, after = self._neighbors(node)
+        stats = self._snapshots[node].stats
+        old_qualities = self._qualities[node]
+        qualities = {}
+        for other in itertools.chain(before, after):
+            quality = old_qualities.pop(other, None)
+            if quality is None:
+                quality = team_quality(stats, self._snapshots[other].stats)
+                self._qualities[other][node] = quality
+            qualities[other] = quality
+        # Keep the qualities symmetric, so that a node that is removed can be
+        # dropped from the qualities of all others
+        for other in old_qualities:
+            self._qualities[other].pop(node, None)
+        self._qualities[node] = qualities
+
+        threshold = self._thresholds[node]
+        edges = [
+            (other, quality)
+            for other, quality in qualities.items()
+            if quality >= threshold and quality >= self._thresholds[other]
+        ]
+        edges.sort(key=lambda edge: edge[1])
+        self._edges[node] = edges
+
+
+def _snapshot_changed(new: RatingSnapshot, old: RatingSnapshot) -> bool:
+    # Teams get a new snapshot on every pop, even if their ratings are the same
+    return new is not old and new != old
+
+
 def avg_mean(search: Search) -> float:
     """
     Get the average of all trueskill means for a search counting means with
     high deviation as 0.
     """
-    return stats.mean(mean if dev < 250 else 0 for mean, dev in search.ratings)
+    return search.avg_mean
 
 
 def rotate(list_: List[T], amount: int) -> List[T]:
@@ -288,7 +644,8 @@ def rotate(list_: List[T], amount: int) -> List[T]:
 
 def make_teams_from_single(
     searches: List[Search],
-    size: int
+    size: int,
+    balance: bool = False
 ) -> Tuple[List[Search], List[Search]]:
     """
     Make teams in the special case where all players are solo queued (no
@@ -305,9 +662,14 @@ def make_teams_from_single(
     2. Create as many games as possible within each bucket.
     3. Create games from remaining players by balancing teams with players from
         different buckets.
+
+    :param balance: split the players of each game into two teams with as close
+        to the same total rating as possible, instead of using `_distribute`
     """
     assert all(len(s.players) == 1 for s in searches)
 
+    distribute = _balance if balance else _distribute
+
     # Make buckets
     buckets = _make_buckets(searches)
     remaining: List[Tuple[Search, float]] = []
@@ -320,27 +682,32 @@ def make_teams_from_single(
         num_teams = num_groups * 2
         num_players = num_teams * size
 
-        selected = random.sample(bucket, num_players)
-        # TODO: Optimize?
-        remaining.extend(s for s in bucket if s not in selected)
+        selected_indices = set(random.sample(range(len(bucket)), num_players))
+        selected = []
+        for i, item in enumerate(bucket):
+            if i in selected_indices:
+                selected.append(item)
+            else:
+                remaining.append(item)
         # Sort by trueskill mean
         selected.sort(key=lambda item: item[1])
-        new_searches.extend(_distribute(selected, size))
+        new_searches.extend(distribute(selected, size))
 
     # Match up players accross buckets
     remaining.sort(key=lambda item: item[1])
-    while len(remaining) >= size:
-        if len(remaining) >= 2 * size:
+    start = 0
+    while len(remaining) - start >= size:
+        if len(remaining) - start >= 2 * size:
             # enough for at least 2 teams
-            selected = remaining[:2 * size]
-            new_searches.extend(_distribute(selected, size))
+            selected = remaining[start:start + 2 * size]
+            new_searches.extend(distribute(selected, size))
+            start += 2 * size
         else:
-            selected = remaining[:size]
+            selected = remaining[start:start + size]
             new_searches.append(CombinedSearch(*[s for s, m in selected]))
+            start += size
 
-        remaining = [item for item in remaining if item not in selected]
-
-    return new_searches, [search for search, _ in remaining]
+    return new_searches, [search for search, _ in remaining[start:]]
 
 
 def _make_buckets(searches: List[Search]) -> Buckets:
@@ -352,26 +719,44 @@ def _make_buckets(searches: List[Search]) -> Buckets:
     2. Find all players with rating within 100 pts of this player and place
         them in a bucket.
     3. Repeat with remaining players.
+
+    The players are sorted by rating so that step 2 only needs to look at the
+    players that are within range.
     """
-    remaining = list(map(lambda s: (s, avg_mean(s)), searches))
+    items = sorted(
+        ((search, avg_mean(search)) for search in searches),
+        key=lambda item: item[1]
+    )
+    means = [mean for _, mean in items]
+    # Indices of the items that are not in a bucket yet, and the position of
+    # each index in that list (or -1), so that a random one can be chosen and
+    # any of them can be removed in constant time.
+    remaining = list(range(len(items)))
+    positions = list(range(len(items)))
     buckets: Buckets = {}
 
     while remaining:
         # Choose a pivot
-        pivot, mean = random.choice(remaining)
-        low, high = mean - 100, mean + 100
-
-        # Partition remaining based on how close their means are
-        bucket, not_bucket = [], []
-        for item in remaining:
-            (_, other_mean) = item
-            if low <= other_mean <= high:
-                bucket.append(item)
-            else:
-                not_bucket.append(item)
+        pivot = random.choice(remaining)
+        mean = means[pivot]
+        low = bisect.bisect_left(means, mean - 100)
+        high = bisect.bisect_right(means, mean + 100)
+
+        bucket = []
+        for i in range(low, high):
+            position = positions[i]
+            if position < 0:
+                continue
+            bucket.append(items[i])
+
+            # Swap with the last one and remove
+            last = remaining.pop()
+            if last != i:
+                remaining[position] = last
+                positions[last] = position
+            positions[i] = -1
 
-        buckets[pivot] = bucket
-        remaining = not_bucket
+        buckets[items[pivot][0]] = bucket
 
     return buckets
 
@@ -405,17 +790,109 @@ def _distribute(
     return (CombinedSearch(*team) for team in teams)
 
 
+def _balance(
+    items: List[Tuple[Search, float]],
+    team_size: int
+) -> Iterator[CombinedSearch]:
+    """
+    Distributes a sorted list into teams of a given size such that each
+    consecutive group of `2 * team_size` players is split into two teams with
+    as close to the same total rating as possible. The two teams of a group
+    are then each others best match.
+
+    Groups of up to 8 players are split optimally by trying all ways of
+    splitting them. Larger groups use `_difference_split`.
+    """
+    group_size = 2 * team_size
+    for start in range(0, len(items), group_size):
+        group = [search for search, _ in items[start:start + group_size]]
+        means = [search.team_stats.mu for search in group]
+        if team_size <= 4:
+            team = _exact_split(means)
+        else:
+            team = _difference_split(means)
+
+        yield CombinedSearch(*[group[i] for i in team])
+        yield CombinedSearch(*[
+            search for i, search in enumerate(group) if i not in team
+        ])
+
+
+def _exact_split(values: List[float]) -> Set[int]:
+    """
+    Return the indices of half of the values such that their sum is as close
+    as possible to the sum of the other half.
+    """
+    total = math.fsum(values)
+    # The first value can always be on the returned team
+    best = min(
+        itertools.combinations(range(1, len(values)), len(values) // 2 - 1),
+        key=lambda rest: abs(
+            2 * (values[0] + math.fsum(values[i] for i in rest)) - total
+        )
+    )
+    return {0, *best}
+
+
+def _difference_split(values: List[float]) -> Set[int]:
+    """
+    Return the indices of half of the values such that their sum is close to
+    the sum of the other half, using the balanced largest differencing method
+    (the Karmarkar-Karp heuristic restricted to teams of equal size).
+
+    The values are paired up in sorted order, and each pair is a partial split
+    with one value on each side. The two partial splits with the largest
+    difference between their sides are then repeatedly combined by putting
+    the larger side of one with the smaller side of the other.
+    """
+    order = sorted(range(len(values)), key=lambda i: values[i])
+    # Entries are (-difference, tiebreaker, larger side, smaller side)
+    heap = [
+        (-(values[high] - values[low]), n, [high], [low])
+        for n, (low, high) in enumerate(zip(order[::2], order[1::2]))
+    ]
+    heapq.heapify(heap)
+    counter = len(heap)
+    while len(heap) > 1:
+        diff1, _, large1, small1 = heapq.heappop(heap)
+        diff2, _, large2, small2 = heapq.heappop(heap)
+        # diff1 <= diff2, so the first one stays larger
+        heapq.heappush(
+            heap, (diff1 - diff2, counter, large1 + small2, small1 + large2)
+        )
+        counter += 1
+
+    _, _, large, _ = heap[0]
+    return set(large)
+
+
 def make_teams(
     searches: List[Search],
-    size: int
+    size: int,
+    time_budget: Optional[float] = None
 ) -> Tuple[List[Search], List[Search]]:
     """
     Tries to group as many searches together into teams of the given size as
     possible. Returns the new grouped searches, and the remaining searches that
     were not succesfully grouped.
 
-    Does not try to balance teams so it should be used only as a last resort.
+    :param time_budget: seconds to spend on finding the most teams with
+        `compose_teams`, which also puts parties of similar rating together.
+        If it takes longer or no budget is given, the teams are made greedily.
+        That does not try to balance teams so it should be used only as a last
+        resort.
     """
+    if time_budget:
+        try:
+            return compose_teams(
+                searches, size, time.perf_counter() + time_budget
+            )
+        except TimeBudgetExceeded:
+            logger.warning(
+                "Composing teams of %d out of %d searches took longer than "
+                "%.3fs, making them greedily",
+                size, len(searches), time_budget
+            )
 
     searches_by_size = _make_searches_by_size(searches)
 
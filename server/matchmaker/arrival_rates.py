@@ -0,0 +1,126 @@
+"""
+Long term rates at which players join the matchmaker queues.
+
+The rate of each queue is kept for every hour of the week, so that the pop
+timer of a queue knows how busy it usually is at this time even when it only
+just started. The rates can be saved to a file and loaded again after a
+restart.
+"""
+
+import json
+import os
+from typing import Dict, List, Optional
+
+from ..config import config
+from ..decorators import with_logger
+
+HOURS_PER_WEEK = 7 * 24
+
+# The epoch was a Thursday
+_EPOCH_HOUR_OF_WEEK = 3 * 24
+
+
+def hour_of_week(timestamp: float) -> int:
+    """ Hours since the start of the week (Monday, 00:00 UTC) """
+    return (int(timestamp // 3600) + _EPOCH_HOUR_OF_WEEK) % HOURS_PER_WEEK
+
+
+class ArrivalRateModel:
+    """ The rate at which players join a queue during each hour of the week.
+
+    For every hour it keeps the number of players that were in the queue when
+    it popped and the time that they were queueing for, the same numbers that
+    `PopTimer` uses for its moving average. Older samples count for less, so
+    that the rate halves its distance to a new rate after
+    `QUEUE_POP_RATE_HALF_LIFE_WEEKS` weeks of pops in the same hour.
+    """
+
+    # The rate of an hour is not used before it has seen this many seconds
+    MIN_SECONDS = 600
+
+    def __init__(
+        self,
+        players: Optional[List[float]] = None,
+        seconds: Optional[List[float]] = None
+    ):
+        self.players = players or [0.] * HOURS_PER_WEEK
+        self.seconds = seconds or [0.] * HOURS_PER_WEEK
+
+    def record(self, timestamp: float, num_queued: int, time_queued: float) -> None:
+        hour = hour_of_week(timestamp)
+        # An hour of the week is 3600 seconds long, once a week
+        half_life = config.QUEUE_POP_RATE_HALF_LIFE_WEEKS * 3600
+        decay = 0.5 ** (time_queued / half_life) if half_life > 0 else 0
+
+        self.players[hour] = self.players[hour] * decay + num_queued
+        self.seconds[hour] = self.seconds[hour] * decay + time_queued
+
+    def rate(self, timestamp: float) -> Optional[float]:
+        """ Players per second at the given time, if it is known """
+        hour = hour_of_week(timestamp)
+        if self.seconds[hour] < self.MIN_SECONDS:
+            return None
+        return self.players[hour] / self.seconds[hour]
+
+    def to_dict(self) -> Dict[str, List[float]]:
+        return {"players": self.players, "seconds": self.seconds}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, List[float]]) -> "ArrivalRateModel":
+        players = [float(value) for value in data["players"]]
+        seconds = [float(value) for value in data["seconds"]]
+        if len(players) != HOURS_PER_WEEK or len(seconds) != HOURS_PER_WEEK:
+            raise ValueError("Expected a value for every hour of the week")
+        return cls(players, seconds)
+
+
+@with_logger
+class ArrivalRateStore:
+    """ The `ArrivalRateModel`s of all queues, by queue name """
+
+    def __init__(self):
+        self.models: Dict[str, ArrivalRateModel] = {}
+
+    def get(self, queue_name: str) -> ArrivalRateModel:
+        model = self.models.get(queue_name)
+        if model is None:
+            model = self.models[queue_name] = ArrivalRateModel()
+        return model
+
+    def load(self, path: str) -> None:
+        """ Load the models that were saved to `path`, if there are any. """
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            models = {
+                name: ArrivalRateModel.from_dict(model)
+                for name, model in data["queues"].items()
+            }
+        except FileNotFoundError:
+            self._logger.info("No queue arrival rates found at %s", path)
+            return
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self._logger.exception(
+                "Failed to load queue arrival rates from %s", path
+            )
+            return
+
+        # Update the models in place, since the queues hold on to them
+        for name, model in models.items():
+            current = self.get(name)
+            current.players, current.seconds = model.players, model.seconds
+        self._logger.info("Loaded arrival rates of %d queues", len(models))
+
+    def save(self, path: str) -> None:
+        """ Save the models to `path`, replacing the file all at once so that
+        it is never left half written.
+        """
+        data = {
+            "queues": {
+                name: model.to_dict() for name, model in self.models.items()
+            }
+        }
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
@@ -0,0 +1,301 @@
+"""
+Pops several matchmaker queues in one pass.
+
+Queues register with the coordinator when they start. When one of them
+pops, the others whose next pop is at most `MATCHMAKER_POP_ALIGN_TIME`
+seconds away are asked to pop early, and the pass waits up to
+`MATCHMAKER_POP_WINDOW` seconds for them and for the queues that pop on their
+own in that time. All of them are then matched in a single pass. Queues that
+pop while a pass is running are handed the next pass as soon as it finishes.
+
+The design is per-queue matching followed by conflict resolution, not a
+single candidate set across all queues: the matching algorithm runs
+separately on the searches of each queue, and players that were matched in
+more than one queue are then given only one of their matches, see
+`MatchmakingCoordinator._resolve`. That keeps every queue on its own matching
+policy, its incremental matching graph and its process pool.
+"""
+
+import asyncio
+import weakref
+from concurrent.futures.process import BrokenProcessPool
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple
+)
+
+from ..config import config
+from ..decorators import with_logger
+from ..players import Player
+from .algorithm import IncrementalMatchingGraph, make_matches
+from .quality import per_player_quality
+from .search import Match, Search
+from .snapshot import SearchSnapshot, match_snapshot
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .matchmaker_queue import MatchmakerQueue
+
+MatchingJob = Tuple[List[Search], str, Optional[IncrementalMatchingGraph]]
+
+
+def match_queues(jobs: Sequence[MatchingJob]) -> List[List[Match]]:
+    """Run the matching algorithm for the searches of each queue"""
+    return [make_matches(searches, policy, graph) for searches, policy, graph in jobs]
+
+
+@with_logger
+class MatchmakingCoordinator:
+    def __init__(self):
+        # Queues whose pops are aligned with each other
+        self._queues: Set["MatchmakerQueue"] = weakref.WeakSet()
+        # Queues waiting for the next pass
+        self._pending: Dict["MatchmakerQueue", asyncio.Future] = {}
+        self._runner: Optional[asyncio.Task] = None
+        # Set whenever a queue joins `_pending`. Created with the runner so
+        # that it belongs to the running loop.
+        self._joined: Optional[asyncio.Event] = None
+
+    def register(self, queue: "MatchmakerQueue") -> None:
+        """Pop the queue early to join the passes of other queues"""
+        self._queues.add(queue)
+
+    def unregister(self, queue: "MatchmakerQueue") -> None:
+        self._queues.discard(queue)
+
+    async def pop(self, queue: "MatchmakerQueue") -> None:
+        """
+        Find matches for the queue in the next pass. Returns when the matches
+        have been applied.
+        """
+        loop = asyncio.get_running_loop()
+        if self._runner is None or self._runner.done():
+            # Forget about pops that were left waiting on a different loop
+            self._pending = {
+                queue: future for queue, future in self._pending.items()
+                if future.get_loop() is loop and not future.done()
+            }
+            self._joined = asyncio.Event()
+            self._runner = asyncio.create_task(self._run())
+
+        future = self._pending.get(queue)
+        if future is None:
+            future = loop.create_future()
+            self._pending[queue] = future
+            self._joined.set()
+
+        await asyncio.shield(future)
+
+    async def _run(self) -> None:
+        try:
+            while True:
+                # Give the queues that pop at the same time a chance to join
+                await asyncio.sleep(0)
+                if not self._pending:
+                    return
+
+                await self._wait_for_queues(self._align_pops())
+                batch, self._pending = self._pending, {}
+                try:
+                    await self._pass(list(batch))
+                except BaseException as e:
+                    _fail_all(batch.values(), e)
+                    # Only errors of the pass itself are survived.
+                    # CancelledError is an Exception before Python 3.8.
+                    if (
+                        isinstance(e, asyncio.CancelledError)
+                        or not isinstance(e, Exception)
+                    ):
+                        raise
+                else:
+                    for future in batch.values():
+                        if not future.done():
+                            future.set_result(None)
+        except BaseException as e:
+            # Nobody is left to hand the next pass to the queues that popped
+            # in the meantime
+            pending, self._pending = self._pending, {}
+            _fail_all(pending.values(), e)
+            raise
+
+    def _align_pops(self) -> Set["MatchmakerQueue"]:
+        """
+        Ask the registered queues that are going to pop soon to pop now.
+
+        :return: the queues that are going to pop within the window
+        """
+        return {
+            queue for queue in self._queues
+            if queue not in self._pending and queue.timer.join_pop(
+                config.MATCHMAKER_POP_ALIGN_TIME,
+                config.MATCHMAKER_POP_WINDOW
+            )
+        }
+
+    async def _wait_for_queues(self, queues: Set["MatchmakerQueue"]) -> None:
+        """
+        Wait until the queues have joined the next pass, but at most
+        `MATCHMAKER_POP_WINDOW` seconds.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + config.MATCHMAKER_POP_WINDOW
+        while not queues <= self._pending.keys():
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+            self._joined.clear()
+            try:
+                await asyncio.wait_for(self._joined.wait(), remaining)
+            except asyncio.TimeoutError:
+                return
+
+    async def _pass(self, queues: List["MatchmakerQueue"]) -> None:
+        prepared = {
+            queue: searches
+            for queue, searches in zip(queues, await asyncio.gather(*(
+                queue.prepare_searches() for queue in queues
+            )))
+            if searches is not None
+        }
+        if not prepared:
+            return
+
+        in_process = [q for q in prepared if q.process_pool is not None]
+        in_thread = [q for q in prepared if q.process_pool is None]
+        matches: Dict["MatchmakerQueue", List[Match]] = {}
+
+        results = await asyncio.gather(
+            self._match_in_thread(in_thread, prepared),
+            *(self._match_in_process(q, prepared[q]) for q in in_process),
+            return_exceptions=True
+        )
+        thread_result, *process_results = results
+        if isinstance(thread_result, BaseException):
+            raise thread_result
+        matches.update(thread_result)
+
+        broken = []
+        for queue, result in zip(in_process, process_results):
+            if isinstance(result, BrokenProcessPool):
+                self._logger.error(
+                    "Matchmaker process pool is broken, matching %s in a "
+                    "thread from now on", queue.name,
+                    exc_info=result
+                )
+                queue.process_pool = None
+                broken.append(queue)
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                matches[queue] = result
+        if broken:
+            matches.update(await self._match_in_thread(broken, prepared))
+
+        for queue, queue_matches in self._resolve(matches).items():
+            queue.apply_matches(queue_matches)
+
+    async def _match_in_thread(
+        self,
+        queues: List["MatchmakerQueue"],
+        prepared: Dict["MatchmakerQueue", List[Search]]
+    ) -> Dict["MatchmakerQueue", List[Match]]:
+        if not queues:
+            return {}
+
+        # All queues in one job, so that passes never compete for the GIL
+        loop = asyncio.get_running_loop()
+        results = await loop.run_in_executor(None, match_queues, [
+            (prepared[queue], queue.matching_policy, queue.graph)
+            for queue in queues
+        ])
+        return dict(zip(queues, results))
+
+    async def _match_in_process(
+        self,
+        queue: "MatchmakerQueue",
+        searches: List[Search]
+    ) -> List[Match]:
+        # The graph is only updated with what changed since the last pass, so
+        # this is cheap enough for the event loop
+        snapshot = SearchSnapshot.from_searches(
+            searches, queue.rating_type, queue.graph
+        )
+        loop = asyncio.get_running_loop()
+        pairs = await loop.run_in_executor(
+            queue.process_pool, match_snapshot, snapshot, queue.matching_policy
+        )
+        matches = [(searches[i], searches[j]) for i, j in pairs]
+
+        # The algorithm only changed the copies of the searches
+        matched = {search for match in matches for search in match}
+        for search in searches:
+            if search not in matched:
+                search.register_failed_matching_attempt()
+
+        return matches
+
+    def _resolve(
+        self,
+        matches: Dict["MatchmakerQueue", List[Match]]
+    ) -> Dict["MatchmakerQueue", List[Match]]:
+        """
+        Make sure that no player is in more than one match. The searches of
+        the matches that are dropped stay in their queues, and count this pass
+        as a failed matching attempt.
+
+        The matches with the highest `per_player_quality` are kept, since the
+        match quality itself is lower for larger teams with the same rating
+        difference per player. Of matches with the same quality, the ones with
+        larger teams are kept, as those are harder to put together again.
+        """
+        if sum(1 for queue_matches in matches.values() if queue_matches) < 2:
+            return matches
+
+        candidates = sorted(
+            (
+                (
+                    per_player_quality(search1.team_stats, search2.team_stats),
+                    queue,
+                    (search1, search2)
+                )
+                for queue, queue_matches in matches.items()
+                for search1, search2 in queue_matches
+            ),
+            key=lambda candidate: (candidate[0], candidate[1].team_size),
+            reverse=True
+        )
+        taken: Set[Player] = set()
+        accepted: Set[Tuple[Search, Search]] = set()
+        for quality, queue, (search1, search2) in candidates:
+            players = search1.players + search2.players
+            if any(player in taken for player in players):
+                self._logger.debug(
+                    "Dropping match between %s and %s in %s (quality %f) "
+                    "because some players were matched in another queue",
+                    search1, search2, queue.name, quality
+                )
+                search1.register_failed_matching_attempt()
+                search2.register_failed_matching_attempt()
+                continue
+            taken.update(players)
+            accepted.add((search1, search2))
+
+        return {
+            queue: [match for match in queue_matches if match in accepted]
+            for queue, queue_matches in matches.items()
+        }
+
+
+def _fail_all(futures: Iterable[asyncio.Future], exc: BaseException) -> None:
+    for future in futures:
+        if future.done():
+            continue
+        if isinstance(exc, asyncio.CancelledError):
+            future.cancel()
+        else:
+            future.set_exception(exc)
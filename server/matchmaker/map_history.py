@@ -0,0 +1,84 @@
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# Start time, game id and map id of a game
+HistoryEntry = Tuple[float, int, Optional[int]]
+HistoryKey = Tuple[int, int]
+
+
+class MapHistory:
+    """ The maps of the recent matchmaker games of each player, per queue.
+
+    The history of a player in a queue is `loaded` from the database the first
+    time that it is needed, and after that it is kept up to date by adding the
+    games that are launched. Games may be added before the history is loaded,
+    for instance while it is being loaded. They are merged with the loaded
+    games.
+    """
+
+    def __init__(self, max_age: float = 24 * 60 * 60):
+        # Games that are older than this many seconds are forgotten
+        self.max_age = max_age
+        # The games of each (player id, queue id), newest first
+        self._entries: Dict[HistoryKey, List[HistoryEntry]] = defaultdict(list)
+        self._loaded: Set[HistoryKey] = set()
+
+    def is_loaded(self, player_id: int, queue_id: int) -> bool:
+        return (player_id, queue_id) in self._loaded
+
+    def add(
+        self,
+        player_id: int,
+        queue_id: int,
+        entry: HistoryEntry
+    ) -> None:
+        self._merge((player_id, queue_id), (entry, ))
+
+    def load(
+        self,
+        player_id: int,
+        queue_id: int,
+        entries: Iterable[HistoryEntry]
+    ) -> None:
+        """ Set the games that the player played in the queue recently, as
+        they were read from the database.
+        """
+        key = (player_id, queue_id)
+        self._merge(key, entries)
+        self._loaded.add(key)
+
+    def recent_maps(
+        self,
+        player_id: int,
+        queue_id: int,
+        limit: int,
+        now: float
+    ) -> List[Optional[int]]:
+        """ The maps of the `limit` most recent games of the player in the
+        queue, newest first. The history must be loaded.
+        """
+        assert self.is_loaded(player_id, queue_id)
+
+        entries = self._entries.get((player_id, queue_id), ())
+        return [
+            map_id for start_time, _, map_id in entries[:limit]
+            if now - start_time <= self.max_age
+        ]
+
+    def prune(self, now: float) -> None:
+        """ Forget the games that are too old to be needed anymore. """
+        for key, entries in list(self._entries.items()):
+            entries[:] = [
+                entry for entry in entries if now - entry[0] <= self.max_age
+            ]
+            if not entries:
+                del self._entries[key]
+                self._loaded.discard(key)
+
+    def _merge(self, key: HistoryKey, new_entries: Iterable[HistoryEntry]) -> None:
+        entries = self._entries[key]
+        game_ids = {game_id for _, game_id, _ in entries}
+        entries.extend(
+            entry for entry in new_entries if entry[1] not in game_ids
+        )
+        entries.sort(key=lambda entry: (entry[0], entry[1]), reverse=True)
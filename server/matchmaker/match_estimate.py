@@ -0,0 +1,184 @@
+import bisect
+from typing import Dict, List, Optional, Set
+
+from .quality import per_player_quality
+from .search import Search
+
+
+class MatchEstimate:
+    """ Keeps a running estimate of how many good matches a queue could make
+    if it popped now, cheap enough to update on every push.
+
+    Searches that are full teams are kept ordered by `avg_mean`, and each one
+    is paired with the closest unpaired search among its `NUM_TO_CHECK`
+    neighbours to each side whose match quality is acceptable to both of them.
+    The number of pairs is roughly the number of matches that the matching
+    algorithm would find between the same searches.
+    Parties that still need teammates are only counted by their players, since
+    their teams aren't known before the pop. They are kept in their own order,
+    and a party is only counted if one of its `NUM_TO_CHECK` neighbours to
+    each side would be an acceptable teammate or opponent for an average
+    player of the party.
+
+    Time complexity: O(log(n)) comparisons and at most `2 * NUM_TO_CHECK`
+    quality computations for each added or removed full team, and at most
+    `(2 * NUM_TO_CHECK + 1) * 2 * NUM_TO_CHECK` for each party.
+    """
+
+    # How many searches to each side of a new search are considered, whether
+    # they are paired already or not
+    NUM_TO_CHECK = 3
+
+    def __init__(self, team_size: int):
+        self.team_size = team_size
+        # The full teams sorted by `avg_mean`, and the means themselves
+        self._order: List[Search] = []
+        self._keys: List[float] = []
+        self._means: Dict[Search, float] = {}
+        self._partner: Dict[Search, Search] = {}
+        # Parties that need teammates sorted by `avg_mean`, the ones added
+        # since the last reset and the ones with a compatible neighbour
+        self._partial_order: List[Search] = []
+        self._partial_keys: List[float] = []
+        self._partial: Set[Search] = set()
+        self._new_partial: Set[Search] = set()
+        self._compatible: Set[Search] = set()
+        # The players of the new parties that have a compatible neighbour
+        self._partial_players = 0
+
+    def __len__(self) -> int:
+        """ The estimated number of matches """
+        partial_teams = self._partial_players // (2 * self.team_size)
+        return len(self._partner) // 2 + partial_teams
+
+    def __contains__(self, search: Search) -> bool:
+        return search in self._means or search in self._partial
+
+    def add(self, search: Search) -> None:
+        if search in self:
+            return
+        mean = search.avg_mean
+        self._means[search] = mean
+        if len(search.players) != self.team_size:
+            index = bisect.bisect_right(self._partial_keys, mean)
+            self._partial_keys.insert(index, mean)
+            self._partial_order.insert(index, search)
+            self._partial.add(search)
+            self._new_partial.add(search)
+            self._check_partial(index)
+            return
+
+        index = bisect.bisect_right(self._keys, mean)
+        self._keys.insert(index, mean)
+        self._order.insert(index, search)
+        self._pair(search, index)
+
+    def remove(self, search: Search) -> None:
+        if search in self._partial:
+            index = self._index(
+                search, self._partial_keys, self._partial_order
+            )
+            self._set_compatible(search, False)
+            del self._partial_keys[index]
+            del self._partial_order[index]
+            del self._means[search]
+            self._partial.remove(search)
+            self._new_partial.discard(search)
+            # The neighbours might have lost their only compatible neighbour
+            self._check_partial(index, removed=True)
+            return
+        if search not in self._means:
+            return
+
+        index = self._index(search)
+        del self._keys[index]
+        del self._order[index]
+        del self._means[search]
+        partner = self._partner.pop(search, None)
+        if partner is not None:
+            del self._partner[partner]
+            self._pair(partner, self._index(partner))
+
+    def reset(self) -> None:
+        """ Forget about the pairs, for instance because the queue popped and
+        the remaining searches couldn't be matched with each other. Searches
+        that are added later can still be paired with them.
+        """
+        self._partner.clear()
+        self._new_partial.clear()
+        self._partial_players = 0
+
+    def _pair(self, search: Search, index: int) -> None:
+        partner = self._find_partner(search, index)
+        if partner is not None:
+            self._partner[search] = partner
+            self._partner[partner] = search
+
+    def _find_partner(self, search: Search, index: int) -> Optional[Search]:
+        mean = self._keys[index]
+        neighbours = (
+            self._order[max(0, index - self.NUM_TO_CHECK):index] +
+            self._order[index + 1:index + 1 + self.NUM_TO_CHECK]
+        )
+        candidates = [
+            other for other in neighbours if other not in self._partner
+        ]
+
+        candidates.sort(key=lambda other: abs(self._means[other] - mean))
+        for other in candidates:
+            if search.matches_with(other):
+                return other
+        return None
+
+    def _check_partial(self, index: int, removed: bool = False) -> None:
+        """ Check again which parties within the window to each side of
+        `index` have a compatible neighbour, since their windows changed.
+        """
+        order = self._partial_order
+        start = max(0, index - self.NUM_TO_CHECK)
+        end = index + self.NUM_TO_CHECK + (0 if removed else 1)
+        for i in range(start, min(end, len(order))):
+            neighbours = (
+                order[max(0, i - self.NUM_TO_CHECK):i] +
+                order[i + 1:i + 1 + self.NUM_TO_CHECK]
+            )
+            search = order[i]
+            self._set_compatible(search, any(
+                _compatible(search, other) for other in neighbours
+            ))
+
+    def _set_compatible(self, search: Search, compatible: bool) -> None:
+        if compatible == (search in self._compatible):
+            return
+        if compatible:
+            self._compatible.add(search)
+        else:
+            self._compatible.remove(search)
+        if search in self._new_partial:
+            players = len(search.players)
+            self._partial_players += players if compatible else -players
+
+    def _index(
+        self,
+        search: Search,
+        keys: Optional[List[float]] = None,
+        order: Optional[List[Search]] = None
+    ) -> int:
+        if keys is None:
+            keys, order = self._keys, self._order
+        index = bisect.bisect_left(keys, self._means[search])
+        while order[index] is not search:
+            index += 1
+        return index
+
+
+def _compatible(search: Search, other: Search) -> bool:
+    """ Whether the average players of two parties would be acceptable
+    teammates or opponents for each other. For single players, this is the
+    same as `Search.matches_with`.
+    """
+    quality = per_player_quality(search.team_stats, other.team_stats)
+    return (
+        quality >= search.match_threshold and
+        quality >= other.match_threshold
+    )
@@ -1,22 +1,33 @@
 import asyncio
 import time
 from collections import OrderedDict
-from concurrent.futures import CancelledError
+from concurrent.futures import CancelledError, Executor
 from datetime import datetime, timezone
 from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
 import server.metrics as metrics
 
-from ..asyncio_extensions import SpinLock, synchronized
+from ..config import config
 from ..decorators import with_logger
 from ..players import PlayerState
-from .algorithm import make_matches, make_teams, make_teams_from_single
+from .algorithm import (
+    IncrementalMatchingGraph,
+    make_teams,
+    make_teams_from_single
+)
+from .arrival_rates import ArrivalRateModel
+from .coordinator import MatchmakingCoordinator
 from .map_pool import MapPool
+from .match_estimate import MatchEstimate
 from .pop_timer import PopTimer
-from .search import Search
+from .rating_histogram import RatingHistogram
+from .search import Match, Search
 
 MatchFoundCallback = Callable[[Search, Search, "MatchmakerQueue"], Any]
 
+# Used by queues that aren't given a coordinator
+_coordinator = MatchmakingCoordinator()
+
 
 class MatchmakerSearchTimer:
     def __init__(self, queue_name):
@@ -50,6 +61,10 @@ class MatchmakerQueue:
         rating_type: str,
         team_size: int = 1,
         map_pools: Iterable[Tuple[MapPool, Optional[int], Optional[int]]] = (),
+        matching_policy: str = "stable_marriage",
+        process_pool: Optional[Executor] = None,
+        coordinator: Optional[MatchmakingCoordinator] = None,
+        arrival_rates: Optional[ArrivalRateModel] = None,
     ):
         self.game_service = game_service
         self.name = name
@@ -57,13 +72,27 @@ class MatchmakerQueue:
         self.featured_mod = featured_mod
         self.rating_type = rating_type
         self.team_size = team_size
+        # One of the names in `algorithm.MATCHING_POLICIES`
+        self.matching_policy = matching_policy
+        # If set, the matchmaking algorithm runs in these processes instead of
+        # a thread of this process
+        self.process_pool = process_pool
+        # Pops this queue together with the queues that pop at the same time
+        self.coordinator = coordinator or _coordinator
         self.map_pools = {info[0].id: info for info in map_pools}
 
         self._queue: Dict[Search, None] = OrderedDict()
+        # Kept between pops so that only the changes need to be processed
+        self.graph = IncrementalMatchingGraph()
+        # The good matches that could be made if the queue popped now
+        self._estimate = MatchEstimate(team_size)
+        self._histogram = RatingHistogram()
+        # When `to_dict` was last broadcast, in `time.monotonic` seconds
+        self.last_info_broadcast = float("-inf")
         self.on_match_found = on_match_found
         self._is_running = True
 
-        self.timer = PopTimer(self)
+        self.timer = PopTimer(self, arrival_rates)
 
     def add_map_pool(
         self,
@@ -82,6 +111,7 @@ class MatchmakerQueue:
             return map_pool
 
     def initialize(self):
+        self.coordinator.register(self)
         asyncio.create_task(self.queue_pop_timer())
 
     @property
@@ -137,31 +167,48 @@ class MatchmakerQueue:
             # If the queue was cancelled, or some other error occurred,
             # make sure to clean up.
             self.game_service.mark_dirty(self)
-            if search in self._queue:
-                del self._queue[search]
+            self._remove(search)
 
-    @synchronized(SpinLock(sleep_duration=1))
     async def find_matches(self) -> None:
         """
         Perform the matchmaking algorithm.
 
-        Note that this function is synchronized such that only one instance of
-        MatchmakerQueue can call this function at any given time. This is
-        needed in order to safely enable multiqueuing.
+        Note that matching is coordinated such that queues that pop at the
+        same time are matched in a single pass, and no two passes run at the
+        same time. This is needed in order to safely enable multiqueuing.
         """
         self._logger.info("Searching for matches: %s", self.name)
 
+        await self.coordinator.pop(self)
+        # The searches that are left couldn't be matched with each other
+        self._estimate.reset()
+
+    async def prepare_searches(self) -> Optional[List[Search]]:
+        """
+        Get the searches for the matching algorithm, or None if there aren't
+        enough players.
+        """
         if self.num_players < 2 * self.team_size:
-            return
+            return None
 
-        searches = self.find_teams()
+        # The algorithm runs in another thread or process, so it must only see
+        # ratings that don't change under it
+        searches = list(self._queue.keys())
+        for search in searches:
+            search.refresh_rating_snapshot()
 
-        # Call self.match on all matches and filter out the ones that were cancelled
+        if all(len(search.players) == self.team_size for search in searches):
+            return self.find_teams(searches)
+
+        # Putting parties into teams may take up to
+        # MATCHMAKER_TEAM_COMPOSITION_BUDGET, which is too long to block the
+        # event loop for
         loop = asyncio.get_running_loop()
-        matches = list(filter(
-            lambda m: self.match(m[0], m[1]),
-            await loop.run_in_executor(None, make_matches, searches)
-        ))
+        return await loop.run_in_executor(None, self.find_teams, searches)
+
+    def apply_matches(self, matches: List[Match]) -> None:
+        # Call self.match on all matches and filter out the ones that were cancelled
+        matches = list(filter(lambda m: self.match(m[0], m[1]), matches))
 
         number_of_matches = len(matches)
         metrics.matches.labels(self.name).set(number_of_matches)
@@ -177,9 +224,20 @@ class MatchmakerQueue:
             except Exception:
                 self._logger.exception("Match callback raised an exception!")
 
-    def find_teams(self) -> List[Search]:
+    def find_teams(
+        self,
+        unmatched: Optional[List[Search]] = None
+    ) -> List[Search]:
+        """
+        Put the parties in `unmatched`, or in the queue if not given, into
+        teams. Parties that don't fit into a team are left out.
+
+        This may run in a thread, so it must not touch the queue if
+        `unmatched` is given.
+        """
         searches = []
-        unmatched = list(self._queue.keys())
+        if unmatched is None:
+            unmatched = list(self._queue.keys())
         need_team = []
         for search in unmatched:
             if len(search.players) == self.team_size:
@@ -188,9 +246,17 @@ class MatchmakerQueue:
                 need_team.append(search)
 
         if all(len(s.players) == 1 for s in need_team):
-            teams, unmatched = make_teams_from_single(need_team, self.team_size)
+            teams, unmatched = make_teams_from_single(
+                need_team,
+                self.team_size,
+                balance=config.MATCHMAKER_BALANCE_TEAMS
+            )
         else:
-            teams, unmatched = make_teams(need_team, self.team_size)
+            teams, unmatched = make_teams(
+                need_team,
+                self.team_size,
+                time_budget=config.MATCHMAKER_TEAM_COMPOSITION_BUDGET
+            )
         searches.extend(teams)
 
         return searches
@@ -198,9 +264,15 @@ class MatchmakerQueue:
     def push(self, search: Search):
         """ Push the given search object onto the queue """
 
+        search.refresh_rating_snapshot()
         self._queue[search] = None
         self.game_service.mark_dirty(self)
 
+        self._histogram.add(search)
+        self._estimate.add(search)
+        if len(self._estimate) >= config.QUEUE_POP_DESIRED_MATCHES:
+            self.timer.request_early_pop()
+
     def match(self, s1: Search, s2: Search) -> bool:
         """
         Mark the given two searches as matched
@@ -228,31 +300,50 @@ class MatchmakerQueue:
 
         s1.match(s2)
         s2.match(s1)
-        if s1 in self._queue:
-            del self._queue[s1]
-        if s2 in self._queue:
-            del self._queue[s2]
+        self._remove(s1)
+        self._remove(s2)
 
         return True
 
+    def _remove(self, search: Search) -> None:
+        self._queue.pop(search, None)
+        self._histogram.remove(search)
+        self._estimate.remove(search)
+
     def shutdown(self):
         self._is_running = False
+        self.coordinator.unregister(self)
 
-    def to_dict(self):
+    def info_broadcast_due(self, now: float) -> bool:
+        """
+        Whether `MATCHMAKER_INFO_INTERVAL` seconds have passed since the
+        queue info was last broadcast.
+        """
+        return now - self.last_info_broadcast >= config.MATCHMAKER_INFO_INTERVAL
+
+    def to_dict(self, compact: bool = False):
         """
         Return a fuzzy representation of the searches currently in the queue
+
+        :param compact: whether to describe the searches by the number of them
+            in each band of ratings, instead of by the boundaries of each one
         """
-        return {
+        info = {
             "queue_name": self.name,
             "queue_pop_time": datetime.fromtimestamp(
                 self.timer.next_queue_pop, timezone.utc
             ).isoformat(),
             "num_players": self.num_players,
-            "boundary_80s": [search.boundary_80 for search in self._queue.keys()],
-            "boundary_75s": [search.boundary_75 for search in self._queue.keys()],
             # TODO: Remove, the client should query the API for this
             "team_size": self.team_size,
         }
+        if compact:
+            info["rating_band_size"] = RatingHistogram.BAND_SIZE
+            info["rating_bands"] = self._histogram.to_list()
+        else:
+            info["boundary_80s"] = [search.boundary_80 for search in self._queue.keys()]
+            info["boundary_75s"] = [search.boundary_75 for search in self._queue.keys()]
+        return info
 
     def __repr__(self):
         return repr(self._queue)
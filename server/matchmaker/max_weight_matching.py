@@ -0,0 +1,524 @@
+"""
+Maximum weight matching.
+
+`max_weight_matching` works on any graph. It is Edmonds' blossom algorithm
+with the primal-dual method described in "Efficient algorithms for finding
+maximum matching in graphs" by Zvi Galil, ACM Computing Surveys, 1986, and
+follows the structure of the public domain implementation by Joris van
+Rantwijk. The running time is O(n^3) for `n` vertices. If all edge weights are
+integers, only integer arithmetic is used.
+
+`banded_max_weight_matching` finds the same matchings in O(n * 2^b * b) time
+for graphs whose edges only connect vertices that are at most `b` apart. This
+is much faster when `b` is small.
+
+Both take undirected edges `(i, j, weight)` between the vertices `0 ... n - 1`.
+There must be at most one edge between two vertices and no edge from a vertex
+to itself. They return a list where entry `i` is the vertex that `i` is
+matched with, or -1 if `i` is not matched.
+"""
+
+import math
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+Edge = Tuple[int, int, float]
+
+
+def bandwidth(edges: Sequence[Edge]) -> int:
+    return max((abs(i - j) for i, j, _ in edges), default=0)
+
+
+def banded_max_weight_matching(edges: Sequence[Edge]) -> List[int]:
+    """
+    Compute a matching of maximum total weight by going through the vertices
+    in order, keeping track of the best matching for each possible set of
+    upcoming vertices that are already matched.
+    """
+    if not edges:
+        return []
+
+    num_vertices = 1 + max(max(i, j) for i, j, _ in edges)
+    # Maps the distance to the next vertex to the weight of the edge
+    forward: List[Dict[int, float]] = [{} for _ in range(num_vertices)]
+    for i, j, w in edges:
+        if i > j:
+            i, j = j, i
+        forward[i][j - i] = w
+
+    # Bit `d` of a state is set if vertex `i + d` is already matched
+    best = {0: 0}
+    # For each vertex, maps every state after it to the previous state and
+    # the distance to the vertex it was matched with, or 0
+    choices: List[Dict[int, Tuple[int, int]]] = []
+    for i in range(num_vertices):
+        next_best = {}
+        back = {}
+        for state, weight in best.items():
+            options = [(state >> 1, weight, 0)]
+            if not state & 1:
+                options.extend(
+                    ((state | 1 << d) >> 1, weight + w, d)
+                    for d, w in forward[i].items()
+                    if not state >> d & 1
+                )
+            for next_state, next_weight, d in options:
+                if next_weight > next_best.get(next_state, -math.inf):
+                    next_best[next_state] = next_weight
+                    back[next_state] = (state, d)
+        choices.append(back)
+        best = next_best
+
+    mate = [-1] * num_vertices
+    # No vertex past the last one can be matched
+    state = 0
+    for i in reversed(range(num_vertices)):
+        state, d = choices[i][state]
+        if d:
+            mate[i] = i + d
+            mate[i + d] = i
+
+    return mate
+
+
+def max_weight_matching(edges: Sequence[Edge]) -> List[int]:
+    """
+    Compute a matching of maximum total weight with the blossom algorithm.
+    """
+    if not edges:
+        return []
+
+    num_edges = len(edges)
+    num_vertices = 1 + max(max(i, j) for i, j, _ in edges)
+    integer_weights = all(isinstance(w, int) for _, _, w in edges)
+    max_weight = max(0, max(w for _, _, w in edges))
+
+    # Endpoint `p` of edge `k` is `endpoint[p]`, where `p == 2 * k` or
+    # `p == 2 * k + 1`. The other endpoint of the same edge is `p ^ 1`.
+    endpoint = [edges[p // 2][p % 2] for p in range(2 * num_edges)]
+
+    # The remote endpoints of the edges of each vertex
+    neighbor_ends: List[List[int]] = [[] for _ in range(num_vertices)]
+    for k, (i, j, _) in enumerate(edges):
+        neighbor_ends[i].append(2 * k + 1)
+        neighbor_ends[j].append(2 * k)
+
+    # The remote endpoint of the matched edge of each vertex, or -1
+    mate = [-1] * num_vertices
+
+    # Indices 0 ... n - 1 are vertices and n ... 2n - 1 are non-trivial
+    # blossoms. Only top level blossoms and their vertices are labeled: 0 is
+    # free, 1 is an S-vertex/blossom and 2 is a T-vertex/blossom.
+    label = [0] * (2 * num_vertices)
+    # The endpoint through which the vertex or blossom got its label
+    label_end = [-1] * (2 * num_vertices)
+    # The top level blossom that each vertex belongs to
+    in_blossom = list(range(num_vertices))
+    blossom_parent = [-1] * (2 * num_vertices)
+    # The sub-blossoms of each blossom, starting with the base and going
+    # around the blossom
+    blossom_children: List[Optional[List[int]]] = [None] * (2 * num_vertices)
+    blossom_base = list(range(num_vertices)) + [-1] * num_vertices
+    # The endpoints of the edges that connect the sub-blossoms
+    blossom_endpoints: List[Optional[List[int]]] = [None] * (2 * num_vertices)
+    # The edge with the least slack to a different S-blossom, or to an
+    # S-vertex for free vertices
+    best_edge = [-1] * (2 * num_vertices)
+    # For S-blossoms, the least slack edges to each neighboring S-blossom
+    blossom_best_edges: List[Optional[List[int]]] = [None] * (2 * num_vertices)
+    unused_blossoms = list(range(num_vertices, 2 * num_vertices))
+    dual = [max_weight] * num_vertices + [0] * num_vertices
+    # Edges with zero slack that may be used
+    allowed = [False] * num_edges
+    # S-vertices that have not been scanned yet
+    queue: List[int] = []
+
+    def slack(k: int) -> float:
+        i, j, w = edges[k]
+        return dual[i] + dual[j] - 2 * w
+
+    def blossom_leaves(b: int) -> Iterator[int]:
+        if b < num_vertices:
+            yield b
+            return
+        for t in blossom_children[b]:
+            if t < num_vertices:
+                yield t
+            else:
+                yield from blossom_leaves(t)
+
+    def assign_label(w: int, t: int, p: int) -> None:
+        """Label the top level blossom of `w` through the endpoint `p`"""
+        b = in_blossom[w]
+        label[w] = label[b] = t
+        label_end[w] = label_end[b] = p
+        best_edge[w] = best_edge[b] = -1
+        if t == 1:
+            queue.extend(blossom_leaves(b))
+        else:
+            # The mate of the base of a T-blossom becomes an S-vertex
+            base = blossom_base[b]
+            assign_label(endpoint[mate[base]], 1, mate[base] ^ 1)
+
+    def scan_blossom(v: int, w: int) -> int:
+        """
+        Trace back from the S-vertices `v` and `w` to find either a new
+        blossom or an augmenting path.
+
+        :return: the base of the new blossom, or -1 for an augmenting path
+        """
+        path = []
+        base = -1
+        while v != -1 or w != -1:
+            b = in_blossom[v]
+            if label[b] & 4:
+                base = blossom_base[b]
+                break
+            path.append(b)
+            label[b] = 5
+            if label_end[b] == -1:
+                # Reached the root of the alternating tree
+                v = -1
+            else:
+                v = endpoint[label_end[b]]
+                b = in_blossom[v]
+                v = endpoint[label_end[b]]
+            # Alternate between the two paths
+            if w != -1:
+                v, w = w, v
+
+        for b in path:
+            label[b] = 1
+        return base
+
+    def add_blossom(base: int, k: int) -> None:
+        """Create a blossom with `base` that is closed by the edge `k`"""
+        v, w, _ = edges[k]
+        bb = in_blossom[base]
+        bv = in_blossom[v]
+        bw = in_blossom[w]
+        b = unused_blossoms.pop()
+        blossom_base[b] = base
+        blossom_parent[b] = -1
+        blossom_parent[bb] = b
+        blossom_children[b] = path = []
+        blossom_endpoints[b] = endpoints = []
+        # Trace back from v to the base
+        while bv != bb:
+            blossom_parent[bv] = b
+            path.append(bv)
+            endpoints.append(label_end[bv])
+            v = endpoint[label_end[bv]]
+            bv = in_blossom[v]
+        path.append(bb)
+        path.reverse()
+        endpoints.reverse()
+        endpoints.append(2 * k)
+        # Trace back from w to the base
+        while bw != bb:
+            blossom_parent[bw] = b
+            path.append(bw)
+            endpoints.append(label_end[bw] ^ 1)
+            w = endpoint[label_end[bw]]
+            bw = in_blossom[w]
+
+        label[b] = 1
+        label_end[b] = label_end[bb]
+        dual[b] = 0
+        # T-vertices in the blossom become S-vertices
+        for v in blossom_leaves(b):
+            if label[in_blossom[v]] == 2:
+                queue.append(v)
+            in_blossom[v] = b
+
+        # Merge the least slack edges of the sub-blossoms
+        best_edge_to = [-1] * (2 * num_vertices)
+        for bv in path:
+            if blossom_best_edges[bv] is None:
+                # Not an S-blossom before, so look at all of its edges
+                edge_lists = [
+                    [p // 2 for p in neighbor_ends[v]]
+                    for v in blossom_leaves(bv)
+                ]
+            else:
+                edge_lists = [blossom_best_edges[bv]]
+            for edge_list in edge_lists:
+                for k in edge_list:
+                    i, j, _ = edges[k]
+                    if in_blossom[j] == b:
+                        i, j = j, i
+                    bj = in_blossom[j]
+                    if (
+                        bj != b and label[bj] == 1 and (
+                            best_edge_to[bj] == -1
+                            or slack(k) < slack(best_edge_to[bj])
+                        )
+                    ):
+                        best_edge_to[bj] = k
+            blossom_best_edges[bv] = None
+            best_edge[bv] = -1
+
+        blossom_best_edges[b] = [k for k in best_edge_to if k != -1]
+        best_edge[b] = -1
+        for k in blossom_best_edges[b]:
+            if best_edge[b] == -1 or slack(k) < slack(best_edge[b]):
+                best_edge[b] = k
+
+    def expand_blossom(b: int, end_stage: bool) -> None:
+        """Turn the sub-blossoms of `b` into top level blossoms"""
+        for s in blossom_children[b]:
+            blossom_parent[s] = -1
+            if s < num_vertices:
+                in_blossom[s] = s
+            elif end_stage and dual[s] == 0:
+                expand_blossom(s, end_stage)
+            else:
+                for v in blossom_leaves(s):
+                    in_blossom[v] = s
+
+        if not end_stage and label[b] == 2:
+            # Relabel the sub-blossoms on the even length path from the
+            # sub-blossom that the blossom was entered through to the base
+            entry_child = in_blossom[endpoint[label_end[b] ^ 1]]
+            j = blossom_children[b].index(entry_child)
+            if j & 1:
+                # Go forward and wrap around
+                j -= len(blossom_children[b])
+                step = 1
+                endpoint_trick = 0
+            else:
+                step = -1
+                endpoint_trick = 1
+            p = label_end[b]
+            while j != 0:
+                label[endpoint[p ^ 1]] = 0
+                label[endpoint[
+                    blossom_endpoints[b][j - endpoint_trick]
+                    ^ endpoint_trick ^ 1
+                ]] = 0
+                assign_label(endpoint[p ^ 1], 2, p)
+                allowed[blossom_endpoints[b][j - endpoint_trick] // 2] = True
+                j += step
+                p = blossom_endpoints[b][j - endpoint_trick] ^ endpoint_trick
+                allowed[p // 2] = True
+                j += step
+            # The base becomes a T-blossom without relabeling its mate
+            bv = blossom_children[b][j]
+            label[endpoint[p ^ 1]] = label[bv] = 2
+            label_end[endpoint[p ^ 1]] = label_end[bv] = p
+            best_edge[bv] = -1
+            # Sub-blossoms on the other path may be reachable from outside
+            j += step
+            while blossom_children[b][j] != entry_child:
+                bv = blossom_children[b][j]
+                if label[bv] == 1:
+                    j += step
+                    continue
+                for v in blossom_leaves(bv):
+                    if label[v] != 0:
+                        break
+                if label[v] != 0:
+                    label[v] = 0
+                    label[endpoint[mate[blossom_base[bv]]]] = 0
+                    assign_label(v, 2, label_end[v])
+                j += step
+
+        label[b] = label_end[b] = -1
+        blossom_children[b] = blossom_endpoints[b] = None
+        blossom_base[b] = -1
+        blossom_best_edges[b] = None
+        best_edge[b] = -1
+        unused_blossoms.append(b)
+
+    def augment_blossom(b: int, v: int) -> None:
+        """
+        Swap the matched and unmatched edges on the path from the vertex `v`
+        to the base of the blossom `b`, making `v` the new base.
+        """
+        t = v
+        while blossom_parent[t] != b:
+            t = blossom_parent[t]
+        if t >= num_vertices:
+            augment_blossom(t, v)
+
+        i = j = blossom_children[b].index(t)
+        if i & 1:
+            j -= len(blossom_children[b])
+            step = 1
+            endpoint_trick = 0
+        else:
+            step = -1
+            endpoint_trick = 1
+        while j != 0:
+            j += step
+            t = blossom_children[b][j]
+            p = blossom_endpoints[b][j - endpoint_trick] ^ endpoint_trick
+            if t >= num_vertices:
+                augment_blossom(t, endpoint[p])
+            j += step
+            t = blossom_children[b][j]
+            if t >= num_vertices:
+                augment_blossom(t, endpoint[p ^ 1])
+            mate[endpoint[p]] = p ^ 1
+            mate[endpoint[p ^ 1]] = p
+
+        # Rotate the sub-blossoms so that the new base comes first
+        blossom_children[b] = blossom_children[b][i:] + blossom_children[b][:i]
+        blossom_endpoints[b] = (
+            blossom_endpoints[b][i:] + blossom_endpoints[b][:i]
+        )
+        blossom_base[b] = blossom_base[blossom_children[b][0]]
+
+    def augment_matching(k: int) -> None:
+        """Swap matched and unmatched edges along the path through edge `k`"""
+        v, w, _ = edges[k]
+        for s, p in ((v, 2 * k + 1), (w, 2 * k)):
+            while True:
+                bs = in_blossom[s]
+                if bs >= num_vertices:
+                    augment_blossom(bs, s)
+                mate[s] = p
+                if label_end[bs] == -1:
+                    # Reached the root of the alternating tree
+                    break
+                t = endpoint[label_end[bs]]
+                bt = in_blossom[t]
+                s = endpoint[label_end[bt]]
+                j = endpoint[label_end[bt] ^ 1]
+                if bt >= num_vertices:
+                    augment_blossom(bt, j)
+                mate[j] = label_end[bt]
+                p = label_end[bt] ^ 1
+
+    # Every stage finds one augmenting path, so there are at most n stages
+    for _ in range(num_vertices):
+        label[:] = [0] * (2 * num_vertices)
+        best_edge[:] = [-1] * (2 * num_vertices)
+        blossom_best_edges[num_vertices:] = [None] * num_vertices
+        allowed[:] = [False] * num_edges
+        queue[:] = []
+
+        # All free vertices become the roots of alternating trees
+        for v in range(num_vertices):
+            if mate[v] == -1 and label[in_blossom[v]] == 0:
+                assign_label(v, 1, -1)
+
+        augmented = False
+        while True:
+            while queue and not augmented:
+                v = queue.pop()
+                for p in neighbor_ends[v]:
+                    k = p // 2
+                    w = endpoint[p]
+                    if in_blossom[v] == in_blossom[w]:
+                        continue
+                    if not allowed[k]:
+                        k_slack = slack(k)
+                        if k_slack <= 0:
+                            allowed[k] = True
+
+                    if allowed[k]:
+                        if label[in_blossom[w]] == 0:
+                            assign_label(w, 2, p ^ 1)
+                        elif label[in_blossom[w]] == 1:
+                            base = scan_blossom(v, w)
+                            if base >= 0:
+                                add_blossom(base, k)
+                            else:
+                                augment_matching(k)
+                                augmented = True
+                                break
+                        elif label[w] == 0:
+                            # w is inside a T-blossom but not reached yet
+                            label[w] = 2
+                            label_end[w] = p ^ 1
+                    elif label[in_blossom[w]] == 1:
+                        b = in_blossom[v]
+                        if best_edge[b] == -1 or k_slack < slack(best_edge[b]):
+                            best_edge[b] = k
+                    elif label[w] == 0:
+                        if best_edge[w] == -1 or k_slack < slack(best_edge[w]):
+                            best_edge[w] = k
+
+            if augmented:
+                break
+
+            # No augmenting path with the allowed edges, so update the dual
+            # variables by the largest amount that keeps them feasible.
+            delta_edge = delta_blossom = None
+
+            # 1: the minimum dual of an S-vertex reaches zero
+            delta_type = 1
+            delta = min(dual[:num_vertices])
+
+            # 2: an edge between an S-vertex and a free vertex becomes tight
+            for v in range(num_vertices):
+                if label[in_blossom[v]] == 0 and best_edge[v] != -1:
+                    d = slack(best_edge[v])
+                    if d < delta:
+                        delta = d
+                        delta_type = 2
+                        delta_edge = best_edge[v]
+
+            # 3: an edge between two S-blossoms becomes tight
+            for b in range(2 * num_vertices):
+                if (
+                    blossom_parent[b] == -1 and label[b] == 1
+                    and best_edge[b] != -1
+                ):
+                    k_slack = slack(best_edge[b])
+                    d = k_slack // 2 if integer_weights else k_slack / 2
+                    if d < delta:
+                        delta = d
+                        delta_type = 3
+                        delta_edge = best_edge[b]
+
+            # 4: the dual of a T-blossom reaches zero
+            for b in range(num_vertices, 2 * num_vertices):
+                if (
+                    blossom_base[b] >= 0 and blossom_parent[b] == -1
+                    and label[b] == 2 and dual[b] < delta
+                ):
+                    delta = dual[b]
+                    delta_type = 4
+                    delta_blossom = b
+
+            for v in range(num_vertices):
+                if label[in_blossom[v]] == 1:
+                    dual[v] -= delta
+                elif label[in_blossom[v]] == 2:
+                    dual[v] += delta
+            for b in range(num_vertices, 2 * num_vertices):
+                if blossom_base[b] >= 0 and blossom_parent[b] == -1:
+                    if label[b] == 1:
+                        dual[b] += delta
+                    elif label[b] == 2:
+                        dual[b] -= delta
+
+            if delta_type == 1:
+                # The matching is optimal
+                break
+            elif delta_type == 2:
+                allowed[delta_edge] = True
+                i, j, _ = edges[delta_edge]
+                if label[in_blossom[i]] == 0:
+                    i, j = j, i
+                queue.append(i)
+            elif delta_type == 3:
+                allowed[delta_edge] = True
+                i, j, _ = edges[delta_edge]
+                queue.append(i)
+            else:
+                expand_blossom(delta_blossom, False)
+
+        if not augmented:
+            break
+
+        # Expand S-blossoms whose dual reached zero
+        for b in range(num_vertices, 2 * num_vertices):
+            if (
+                blossom_parent[b] == -1 and blossom_base[b] >= 0
+                and label[b] == 1 and dual[b] == 0
+            ):
+                expand_blossom(b, True)
+
+    return [endpoint[p] if p >= 0 else -1 for p in mate]
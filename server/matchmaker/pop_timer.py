@@ -1,12 +1,13 @@
 import asyncio
 from collections import deque
 from time import time
-from typing import Deque
+from typing import Deque, Optional
 
 import server.metrics as metrics
 
 from ..config import config
 from ..decorators import with_logger
+from .arrival_rates import ArrivalRateModel
 
 
 @with_logger
@@ -24,16 +25,34 @@ class PopTimer(object):
 
     The player queue rate is based on a moving average over the last few pops.
     The exact size can be set in config.
+
+    The queue can also ask for an early pop with `request_early_pop` when it
+    already has enough good matches. The timer then pops as soon as
+    `QUEUE_POP_TIME_MIN` seconds have passed since the last pop.
+
+    If the timer is given an `ArrivalRateModel`, the rate at which players
+    usually queue at this hour of the week is blended into the moving average,
+    so that the pop times are right even before there is a moving average.
     """
-    def __init__(self, queue: "MatchmakerQueue"):
+    def __init__(
+        self,
+        queue: "MatchmakerQueue",
+        arrival_rates: Optional[ArrivalRateModel] = None
+    ):
         self.queue = queue
+        self.arrival_rates = arrival_rates
         # Set up deque's for calculating a moving average
         self.last_queue_amounts: Deque[int] = deque(maxlen=config.QUEUE_POP_TIME_MOVING_AVG_SIZE)
         self.last_queue_times: Deque[float] = deque(maxlen=config.QUEUE_POP_TIME_MOVING_AVG_SIZE)
 
         self._last_queue_pop = time()
-        # Optimistically schedule first pop for half of the max pop time
-        self.next_queue_pop = self._last_queue_pop + (config.QUEUE_POP_TIME_MAX / 2)
+        self.next_queue_pop = self._last_queue_pop + self.time_until_first_pop(
+            self._last_queue_pop
+        )
+
+        self.early_pop_requested = False
+        # Created by `next_pop` so that it belongs to the running loop
+        self._early_pop: Optional[asyncio.Event] = None
 
     async def next_pop(self):
         """ Wait for the timer to pop. """
@@ -41,38 +60,110 @@ class PopTimer(object):
         time_remaining = self.next_queue_pop - time()
         self._logger.info("Next %s wave happening in %is", self.queue.name, time_remaining)
         metrics.matchmaker_queue_pop.labels(self.queue.name).set(int(time_remaining))
-        await asyncio.sleep(time_remaining)
+
+        earliest_pop = self._last_queue_pop + config.QUEUE_POP_TIME_MIN
+        await asyncio.sleep(min(time_remaining, earliest_pop - time()))
+        time_remaining = self.next_queue_pop - time()
+        if time_remaining > 0 and not self.early_pop_requested:
+            self._early_pop = asyncio.Event()
+            try:
+                await asyncio.wait_for(self._early_pop.wait(), time_remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self._early_pop = None
+
+        now = time()
+        if self.early_pop_requested and now < self.next_queue_pop:
+            self._logger.info(
+                "Popping %s %is early", self.queue.name, self.next_queue_pop - now
+            )
+            metrics.matchmaker_early_pops.labels(self.queue.name).inc()
+        self.early_pop_requested = False
+
         num_players = self.queue.num_players
         metrics.matchmaker_players.labels(self.queue.name).set(num_players)
 
-        self._last_queue_pop = time()
-        self.next_queue_pop = self._last_queue_pop + self.time_until_next_pop(
-            num_players, time_remaining
+        time_queued = now - self._last_queue_pop
+        self._last_queue_pop = now
+        self.next_queue_pop = now + self.time_until_next_pop(
+            num_players, time_queued, now
         )
 
-    def time_until_next_pop(self, num_queued: int, time_queued: float) -> float:
+    def request_early_pop(self) -> None:
+        """ Pop as soon as the minimum time between pops has passed. """
+        self.early_pop_requested = True
+        if self._early_pop is not None:
+            self._early_pop.set()
+
+    def join_pop(self, align_time: float, window: float) -> bool:
+        """ Pop early if the next pop is at most `align_time` seconds away, so
+        that the queue is matched in the same pass as a queue that pops now.
+
+        :return: whether the timer is going to pop within `window` seconds
+        """
+        now = time()
+        time_remaining = self.next_queue_pop - now
+        if time_remaining <= window:
+            return True
+        if time_remaining > align_time:
+            return False
+        if self._last_queue_pop + config.QUEUE_POP_TIME_MIN > now + window:
+            return False
+
+        self.request_early_pop()
+        return True
+
+    def time_until_first_pop(self, now: float) -> float:
+        """ Calculate how long to wait for the first pop, before there is a
+        moving average
+        """
+        usual_rate = self._usual_rate(now)
+        if not usual_rate:
+            # Optimistically schedule first pop for half of the max pop time
+            return config.QUEUE_POP_TIME_MAX / 2
+
+        return min(self._desired_players() / usual_rate, config.QUEUE_POP_TIME_MAX)
+
+    def time_until_next_pop(
+        self,
+        num_queued: int,
+        time_queued: float,
+        now: Optional[float] = None
+    ) -> float:
         """ Calculate how long we should wait for the next queue to pop based
         on the current rate of ladder queues
+
+        :param now: the time of the pop, defaults to the current time
         """
+        if now is None:
+            now = time()
+        usual_rate = self._usual_rate(now)
+        if self.arrival_rates is not None:
+            self.arrival_rates.record(now, num_queued, time_queued)
+
         # Calculate moving average of player queue rate
         self.last_queue_amounts.append(num_queued)
         self.last_queue_times.append(time_queued)
 
         total_players = sum(self.last_queue_amounts)
+        total_times = sum(self.last_queue_times)
+        if usual_rate is not None:
+            # The usual rate counts as much as this many seconds of pops
+            total_players += usual_rate * config.QUEUE_POP_RATE_PRIOR_SECONDS
+            total_times += config.QUEUE_POP_RATE_PRIOR_SECONDS
+
         if total_players == 0:
             return config.QUEUE_POP_TIME_MAX
 
-        total_times = sum(self.last_queue_times)
         if total_times:
             self._logger.debug(
                 "Queue rate for %s: %f/s", self.queue.name,
                 total_players / total_times
             )
 
-        players_per_match = self.queue.team_size * 2
-        desired_players = config.QUEUE_POP_DESIRED_MATCHES * players_per_match
         # Obtained by solving $ NUM_PLAYERS = rate * time $ for time.
-        next_pop_time = desired_players * total_times / total_players
+        next_pop_time = self._desired_players() * total_times / total_players
         if next_pop_time > config.QUEUE_POP_TIME_MAX:
             self._logger.warning(
                 "Required time (%.2fs) for %s is larger than max pop time (%ds). "
@@ -81,3 +172,12 @@ class PopTimer(object):
             )
             return config.QUEUE_POP_TIME_MAX
         return next_pop_time
+
+    def _desired_players(self) -> int:
+        players_per_match = self.queue.team_size * 2
+        return config.QUEUE_POP_DESIRED_MATCHES * players_per_match
+
+    def _usual_rate(self, now: float) -> Optional[float]:
+        if self.arrival_rates is None:
+            return None
+        return self.arrival_rates.rate(now)
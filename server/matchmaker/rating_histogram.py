@@ -0,0 +1,49 @@
+from collections import Counter
+from typing import Counter as CounterType
+from typing import Dict, List, Tuple
+
+from .search import Search
+
+
+class RatingHistogram:
+    """ The number of searches in a queue per band of ratings, updated as
+    searches come and go so that it never has to go through the whole queue.
+
+    Searches are put into bands by the same rating as their `boundary_80`, so
+    the histogram says roughly the same as the boundaries of all searches.
+    """
+
+    BAND_SIZE = 100
+
+    def __init__(self):
+        self._counts: CounterType[int] = Counter()
+        # The band that each search was counted in, since its rating may
+        # change while it is queued
+        self._bands: Dict[Search, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._bands)
+
+    def add(self, search: Search) -> None:
+        if search in self._bands:
+            return
+
+        mean, _ = search.ratings[0]
+        band = int(mean // self.BAND_SIZE) * self.BAND_SIZE
+        self._bands[search] = band
+        self._counts[band] += 1
+
+    def remove(self, search: Search) -> None:
+        band = self._bands.pop(search, None)
+        if band is None:
+            return
+
+        self._counts[band] -= 1
+        if not self._counts[band]:
+            del self._counts[band]
+
+    def to_list(self) -> List[Tuple[int, int]]:
+        """ The lowest rating of every band that has searches in it, and the
+        number of searches in it, from the lowest band up.
+        """
+        return sorted(self._counts.items())
@@ -2,18 +2,58 @@ import asyncio
 import itertools
 import math
 import time
-from typing import Any, Callable, List, Optional, Tuple
-
-from trueskill import Rating, quality
+from typing import Any, Callable, List, NamedTuple, Optional, Tuple
 
 from server.rating import RatingType
 
 from ..config import config
 from ..decorators import with_logger
 from ..players import Player
+from .quality import TeamStats, team_quality, team_stats
 
 Match = Tuple["Search", "Search"]
 OnMatchedCallback = Callable[["Search", "Search"], Any]
+Rating = Tuple[float, float]
+
+
+class RatingSnapshot(NamedTuple):
+    """
+    Everything the matchmaker needs to know about the ratings of a search,
+    computed once instead of on every comparison.
+    """
+    # Sum of the versions of the rating maps the snapshot was taken from
+    version: int
+    raw_ratings: Tuple[Rating, ...]
+    # Ratings with the means of new players adjusted
+    ratings: Tuple[Rating, ...]
+    stats: TeamStats
+    has_newbie: bool
+    max_mean: float
+    # Average of the adjusted means, counting means with high deviation as 0
+    avg_mean: float
+    quality_against_self: float
+
+    @classmethod
+    def build(
+        cls,
+        version: int,
+        raw_ratings: Tuple[Rating, ...],
+        ratings: Tuple[Rating, ...],
+        has_newbie: bool
+    ) -> "RatingSnapshot":
+        team = team_stats(ratings)
+        return cls(
+            version=version,
+            raw_ratings=raw_ratings,
+            ratings=ratings,
+            stats=team,
+            has_newbie=has_newbie,
+            max_mean=max(mean for mean, _ in ratings),
+            avg_mean=math.fsum(
+                mean if dev < 250 else 0 for mean, dev in ratings
+            ) / len(ratings),
+            quality_against_self=team_quality(team, team)
+        )
 
 
 @with_logger
@@ -49,7 +89,49 @@ class Search:
         self.on_matched = on_matched
 
         # Precompute this
-        self.quality_against_self = self.quality_with(self)
+        self.rating_snapshot = self._take_snapshot()
+
+    def _ratings_version(self) -> int:
+        return sum(
+            player.ratings.version + player.game_count.version
+            for player in self.players
+        )
+
+    def refresh_rating_snapshot(self) -> bool:
+        """
+        Take the rating snapshot again if any of the players' ratings or game
+        counts changed since it was taken. Changes to the newbie settings in
+        the config are not tracked.
+
+        :return: whether the snapshot was taken again
+        """
+        if self.rating_snapshot.version == self._ratings_version():
+            return False
+
+        self.rating_snapshot = self._take_snapshot()
+        return True
+
+    def _take_snapshot(self) -> RatingSnapshot:
+        raw_ratings = tuple(
+            player.ratings[self.rating_type] for player in self.players
+        )
+        newbies = tuple(self.is_newbie(player) for player in self.players)
+        # Reading the ratings may have initialized them, which counts as a
+        # modification
+        version = self._ratings_version()
+        return RatingSnapshot.build(
+            version,
+            raw_ratings,
+            tuple(
+                # New players (less than config.NEWBIE_MIN_GAMES games) match
+                # against less skilled opponents
+                self.adjusted_rating(player) if newbie else rating
+                for player, rating, newbie in zip(
+                    self.players, raw_ratings, newbies
+                )
+            ),
+            any(newbies)
+        )
 
     def adjusted_rating(self, player: Player):
         """
@@ -68,35 +150,39 @@ class Search:
         return len(self.players) == 1
 
     def has_newbie(self) -> bool:
-        for player in self.players:
-            if self.is_newbie(player):
-                return True
-
-        return False
+        return self.rating_snapshot.has_newbie
 
     def has_top_player(self) -> bool:
-        max_rating = max(map(lambda rating_tuple: rating_tuple[0], self.ratings))
-        return max_rating >= config.TOP_PLAYER_MIN_RATING
+        return self.rating_snapshot.max_mean >= config.TOP_PLAYER_MIN_RATING
 
     @property
-    def ratings(self):
-        ratings = []
-        for player, rating in zip(self.players, self.raw_ratings):
-            # New players (less than config.NEWBIE_MIN_GAMES games) match against less skilled opponents
-            if self.is_newbie(player):
-                rating = self.adjusted_rating(player)
-            ratings.append(rating)
-        return ratings
+    def ratings(self) -> Tuple[Rating, ...]:
+        return self.rating_snapshot.ratings
+
+    @property
+    def raw_ratings(self) -> Tuple[Rating, ...]:
+        return self.rating_snapshot.raw_ratings
+
+    @property
+    def team_stats(self) -> TeamStats:
+        return self.rating_snapshot.stats
 
     @property
-    def raw_ratings(self):
-        return [player.ratings[self.rating_type] for player in self.players]
+    def avg_mean(self) -> float:
+        return self.rating_snapshot.avg_mean
+
+    @property
+    def quality_against_self(self) -> float:
+        return self.rating_snapshot.quality_against_self
 
     def _nearby_rating_range(self, delta):
         """
         Returns 'boundary' mu values for player matching. Adjust delta for
         different game qualities.
         """
+        # The boundaries are sent to clients between queue pops, so they
+        # shouldn't wait for the snapshot to be refreshed by the next pop
+        self.refresh_rating_snapshot()
         mu, _ = self.ratings[0]  # Takes the rating of the first player, only works for 1v1
         rounded_mu = int(math.ceil(mu / 10) * 10)  # Round to 10
         return rounded_mu - delta, rounded_mu + delta
@@ -155,10 +241,7 @@ class Search:
         assert all(other.raw_ratings)
         assert other.players
 
-        team1 = [Rating(*rating) for rating in self.ratings]
-        team2 = [Rating(*rating) for rating in other.ratings]
-
-        return quality([team1, team2])
+        return team_quality(self.team_stats, other.team_stats)
 
     @property
     def is_matched(self):
@@ -257,18 +340,25 @@ class CombinedSearch(Search):
 
         self.rating_type = rating_type
         self.searches = searches
+        self.players = list(itertools.chain(*[s.players for s in searches]))
+        self.rating_snapshot = self._take_snapshot()
 
-    @property
-    def players(self) -> List[Player]:
-        return list(itertools.chain(*[s.players for s in self.searches]))
+    def refresh_rating_snapshot(self) -> bool:
+        refreshed = [s.refresh_rating_snapshot() for s in self.searches]
+        if not any(refreshed):
+            return False
 
-    @property
-    def ratings(self):
-        return list(itertools.chain(*[s.ratings for s in self.searches]))
+        self.rating_snapshot = self._take_snapshot()
+        return True
 
-    @property
-    def raw_ratings(self):
-        return list(itertools.chain(*[s.raw_ratings for s in self.searches]))
+    def _take_snapshot(self) -> RatingSnapshot:
+        snapshots = [s.rating_snapshot for s in self.searches]
+        return RatingSnapshot.build(
+            sum(s.version for s in snapshots),
+            tuple(itertools.chain(*[s.raw_ratings for s in snapshots])),
+            tuple(itertools.chain(*[s.ratings for s in snapshots])),
+            any(s.has_newbie for s in snapshots)
+        )
 
     @property
     def failed_matching_attempts(self) -> int:
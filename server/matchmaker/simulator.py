@@ -0,0 +1,437 @@
+"""
+Usage:
+    simulator.py [options]
+    simulator.py --replay FILE [--policy POLICY]
+
+Options:
+    --duration HOURS      Virtual time to simulate [default: 24]
+    --start-hour HOUR     Hour of the day that the simulation starts at [default: 0]
+    --team-size SIZE      Number of players on each team [default: 1]
+    --policy POLICY       Matching policy [default: stable_marriage]
+    --seed SEED           Seed for the random number generator
+    --record FILE         Save the searches of every pop to FILE
+    --rates FILE          Start with the queue arrival rates saved to FILE,
+                          and save the updated rates to it afterwards
+    --replay FILE         Match the searches saved to FILE with --record
+
+Run with `python -m server.matchmaker.simulator`.
+
+Simulates a matchmaker queue with a synthetic player population, without a
+database or sockets. The queue, its pop timer and the matching algorithm are
+the ones used by the server, but time is virtual, so a day of queueing takes
+as long as the matchmaking itself.
+
+Pops can be recorded as `SearchSnapshot`s and replayed later, so that a
+change to the algorithm can be compared against the same load.
+
+The simulation starts on a Monday, so that the pop timer can use the same
+arrival rates for each hour of the week as the server, see `--rates`.
+"""
+
+import asyncio
+import math
+import pickle
+import random
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+from ..config import config
+from ..decorators import with_logger
+from ..players import Player, PlayerState
+from ..rating import RatingType
+from .algorithm import make_matches
+from .arrival_rates import ArrivalRateModel, ArrivalRateStore
+from .matchmaker_queue import MatchmakerQueue
+from .search import Search
+from .snapshot import SearchSnapshot
+
+# A Monday, 00:00 UTC. Virtual time starts on it.
+SIMULATION_EPOCH = 4 * 24 * 3600
+
+# Parties joining the queue per hour, for each hour of the day
+DEFAULT_ARRIVAL_RATES = (
+    40, 30, 20, 15, 10, 10, 15, 20, 30, 40, 50, 60,
+    70, 80, 90, 100, 120, 140, 160, 160, 140, 110, 80, 60,
+)
+
+
+class Population(NamedTuple):
+    rating_mean: float = 1500
+    # Spread of the rating means of established players
+    rating_spread: float = 400
+    # Range of the rating deviations of established players
+    deviation_range: Tuple[float, float] = (50, 150)
+    # Fraction of players with less than `config.NEWBIE_MIN_GAMES` games
+    newbie_ratio: float = 0.1
+    # Relative frequency of each party size. Sizes larger than the team size
+    # of the queue are ignored.
+    party_sizes: Tuple[Tuple[int, float], ...] = ((1, 1.0), )
+    arrival_rates: Sequence[float] = DEFAULT_ARRIVAL_RATES
+    # Seconds until a party gives up waiting and leaves the queue
+    patience: float = 900
+
+    def arrival_rate(self, hour: float) -> float:
+        """Parties per second at the given hour of the day"""
+        return self.arrival_rates[int(hour) % len(self.arrival_rates)] / 3600
+
+
+class SimulationReport(NamedTuple):
+    # Wall clock seconds that each pop took
+    pop_latencies: List[float]
+    matches_per_pop: List[int]
+    # Searches left in the queue after each pop
+    unmatched_per_pop: List[int]
+    qualities: List[float]
+    # Virtual seconds that each matched player spent in the queue
+    wait_times: List[float]
+    # Parties that left the queue without a match
+    abandoned: int = 0
+
+    @property
+    def pops(self) -> int:
+        return len(self.pop_latencies)
+
+    def summary(self) -> Dict[str, float]:
+        summary = {
+            "pops": self.pops,
+            "matches": sum(self.matches_per_pop),
+            "abandoned": self.abandoned,
+            "mean_matches_per_pop": _mean(self.matches_per_pop),
+            "mean_unmatched_per_pop": _mean(self.unmatched_per_pop),
+            "mean_quality": _mean(self.qualities),
+        }
+        for name, values in (
+            ("pop_latency", self.pop_latencies),
+            ("quality", self.qualities),
+            ("wait_time", self.wait_times),
+        ):
+            for p in (5, 50, 95, 99):
+                summary[f"{name}_p{p}"] = percentile(values, p)
+
+        return summary
+
+    def format(self) -> str:
+        return "\n".join(
+            f"{name:>24}: {value:.4g}"
+            for name, value in self.summary().items()
+        )
+
+
+def percentile(values: Sequence[float], p: float) -> float:
+    """Nearest rank percentile, or NaN if there are no values"""
+    if not values:
+        return math.nan
+
+    values = sorted(values)
+    rank = math.ceil(p / 100 * len(values))
+    return values[max(rank, 1) - 1]
+
+
+def _mean(values: Sequence[float]) -> float:
+    if not values:
+        return math.nan
+    return math.fsum(values) / len(values)
+
+
+class PlayerFactory:
+    """Makes random parties of players that are drawn from a `Population`"""
+
+    def __init__(
+        self,
+        population: Population,
+        rating_type: str = RatingType.LADDER_1V1,
+        rng: Optional[random.Random] = None
+    ):
+        self.population = population
+        self.rating_type = rating_type
+        self.rng = rng or random.Random()
+        self._next_id = 1
+
+    def make_player(self) -> Player:
+        population = self.population
+        rng = self.rng
+
+        if rng.random() < population.newbie_ratio:
+            # New players haven't converged to their real rating yet
+            mean = rng.gauss(config.START_RATING_MEAN, population.rating_spread / 2)
+            dev = rng.uniform(250, config.START_RATING_DEV)
+            game_count = rng.randrange(config.NEWBIE_MIN_GAMES)
+        else:
+            mean = rng.gauss(population.rating_mean, population.rating_spread)
+            dev = rng.uniform(*population.deviation_range)
+            game_count = config.NEWBIE_MIN_GAMES + int(rng.expovariate(1 / 200))
+
+        player = Player(
+            login=f"Sim{self._next_id}",
+            player_id=self._next_id,
+            ratings={self.rating_type: (mean, dev)},
+            game_count={self.rating_type: game_count}
+        )
+        player.state = PlayerState.SEARCHING_LADDER
+        self._next_id += 1
+        return player
+
+    def make_party(self, max_size: int) -> List[Player]:
+        sizes, weights = zip(*(
+            (size, weight)
+            for size, weight in self.population.party_sizes
+            if size <= max_size
+        ))
+        size = self.rng.choices(sizes, weights)[0]
+        return [self.make_player() for _ in range(size)]
+
+
+def arrival_times(
+    population: Population,
+    duration: float,
+    start_hour: float = 0,
+    rng: Optional[random.Random] = None
+) -> List[float]:
+    """
+    Draw the times at which parties join the queue during `duration` seconds,
+    as a Poisson process whose rate changes with the hour of the day.
+    """
+    rng = rng or random.Random()
+    times = []
+    hour = math.floor(start_hour)
+    now = 0.
+    while now < duration:
+        # The rate is constant until the end of the hour, and because the
+        # process is memoryless it can start over there
+        hour_end = min((hour + 1 - start_hour) * 3600, duration)
+        rate = population.arrival_rate(hour)
+        if rate > 0:
+            now += rng.expovariate(rate)
+            while now < hour_end:
+                times.append(now)
+                now += rng.expovariate(rate)
+        now = hour_end
+        hour += 1
+
+    return times
+
+
+class _GameService:
+    """Stands in for the `GameService` that the queue notifies of changes"""
+
+    def mark_dirty(self, obj):
+        pass
+
+
+@with_logger
+class Simulation:
+    """
+    Runs a `MatchmakerQueue` with random players for a period of virtual time.
+
+        report = await Simulation(Population(), duration=3600, seed=1).run()
+        print(report.format())
+    """
+
+    def __init__(
+        self,
+        population: Population,
+        duration: float = 24 * 3600,
+        start_hour: float = 0,
+        team_size: int = 1,
+        policy: str = "stable_marriage",
+        seed: Optional[int] = None,
+        record: bool = False,
+        arrival_rates: Optional[ArrivalRateModel] = None
+    ):
+        self.population = population
+        self.duration = duration
+        self.start_hour = start_hour
+        self.team_size = team_size
+        self.rng = random.Random(seed)
+        self.players = PlayerFactory(population, RatingType.LADDER_1V1, self.rng)
+        self.queue = MatchmakerQueue(
+            game_service=_GameService(),
+            on_match_found=self._on_match_found,
+            name="simulation",
+            queue_id=0,
+            featured_mod="ladder1v1",
+            rating_type=RatingType.LADDER_1V1,
+            team_size=team_size,
+            matching_policy=policy,
+            arrival_rates=arrival_rates
+        )
+        # Searches matched by each pop, if recording
+        self.snapshots: Optional[List[SearchSnapshot]] = None
+        if record:
+            self.snapshots = []
+            self.queue.prepare_searches = self._record_searches
+
+        self.now = 0.
+        # Parties waiting in the queue and the tasks that are searching for
+        # them
+        self._waiting: Dict[Search, asyncio.Task] = {}
+        self._report = SimulationReport([], [], [], [], [])
+        self._matches_this_pop = 0
+
+    async def run(self) -> SimulationReport:
+        arrivals = arrival_times(
+            self.population, self.duration, self.start_hour, self.rng
+        )
+        timer = self.queue.timer
+        abandoned = 0
+        next_arrival = 0
+        last_pop = 0.
+        next_pop = timer.time_until_first_pop(self.timestamp)
+
+        while next_pop <= self.duration:
+            # Like `PopTimer.next_pop`, but the arrivals are the only events
+            # that can make the queue pop early
+            earliest_pop = last_pop + config.QUEUE_POP_TIME_MIN
+            while next_arrival < len(arrivals):
+                arrival = arrivals[next_arrival]
+                if arrival > next_pop:
+                    break
+                await self._join(arrival)
+                next_arrival += 1
+                if timer.early_pop_requested:
+                    next_pop = min(next_pop, max(arrival, earliest_pop))
+            timer.early_pop_requested = False
+
+            self.now = next_pop
+            abandoned += await self._leave_impatient()
+            # The timer counts the players that are in the queue when it pops
+            num_players = self.queue.num_players
+            await self._pop()
+
+            time_queued = self.now - last_pop
+            last_pop = self.now
+            next_pop = self.now + timer.time_until_next_pop(
+                num_players, time_queued, self.timestamp
+            )
+
+        for task in self._waiting.values():
+            task.cancel()
+        await asyncio.gather(*self._waiting.values(), return_exceptions=True)
+        self._waiting.clear()
+
+        return self._report._replace(abandoned=abandoned)
+
+    @property
+    def timestamp(self) -> float:
+        """ The current virtual time as a unix timestamp """
+        return SIMULATION_EPOCH + self.start_hour * 3600 + self.now
+
+    async def _join(self, arrival: float) -> None:
+        party = self.players.make_party(self.team_size)
+        search = Search(party, start_time=arrival)
+        self._waiting[search] = asyncio.create_task(self.queue.search(search))
+        # Let the search enter the queue
+        await asyncio.sleep(0)
+
+    async def _leave_impatient(self) -> int:
+        impatient = [
+            search for search in self._waiting
+            if self.now - search.start_time > self.population.patience
+        ]
+        for search in impatient:
+            search.cancel()
+            await self._waiting.pop(search)
+
+        return len(impatient)
+
+    async def _record_searches(self) -> Optional[List[Search]]:
+        """
+        Stands in for `prepare_searches` of the queue, so that the recorded
+        teams are the ones that are matched. Putting parties into teams is
+        random, so the queue can't be asked for its teams a second time.
+        """
+        searches = await MatchmakerQueue.prepare_searches(self.queue)
+        self.snapshots.append(SearchSnapshot.from_searches(
+            searches or [], RatingType.LADDER_1V1
+        ))
+        return searches
+
+    async def _pop(self) -> None:
+        self._matches_this_pop = 0
+        start = time.perf_counter()
+        await self.queue.find_matches()
+        self._report.pop_latencies.append(time.perf_counter() - start)
+        self._report.matches_per_pop.append(self._matches_this_pop)
+        self._report.unmatched_per_pop.append(len(self._waiting))
+
+    def _on_match_found(self, search1: Search, search2: Search, queue) -> None:
+        self._matches_this_pop += 1
+        self._report.qualities.append(search1.quality_with(search2))
+        for team in (search1, search2):
+            for party in getattr(team, "searches", (team, )):
+                self._waiting.pop(party)
+                self._report.wait_times.extend(
+                    [self.now - party.start_time] * len(party.players)
+                )
+
+
+def replay(
+    snapshots: Iterable[SearchSnapshot],
+    policy: str = "stable_marriage"
+) -> SimulationReport:
+    """
+    Match the searches of each snapshot with the current algorithm and
+    configuration. Wait times aren't known for recorded searches.
+    """
+    report = SimulationReport([], [], [], [], [])
+    for snapshot in snapshots:
+        searches = snapshot.to_searches()
+        start = time.perf_counter()
+        matches = make_matches(searches, policy)
+        report.pop_latencies.append(time.perf_counter() - start)
+        report.matches_per_pop.append(len(matches))
+        report.unmatched_per_pop.append(len(searches) - 2 * len(matches))
+        report.qualities.extend(
+            search1.quality_with(search2) for search1, search2 in matches
+        )
+
+    return report
+
+
+def save_snapshots(path: str, snapshots: List[SearchSnapshot]) -> None:
+    with open(path, "wb") as f:
+        pickle.dump(snapshots, f)
+
+
+def load_snapshots(path: str) -> List[SearchSnapshot]:
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+async def main(args) -> None:
+    if args["--replay"]:
+        report = replay(load_snapshots(args["--replay"]), args["--policy"])
+        print(report.format())
+        return
+
+    seed = args["--seed"]
+    rates = ArrivalRateStore()
+    if args["--rates"]:
+        rates.load(args["--rates"])
+    simulation = Simulation(
+        Population(),
+        duration=float(args["--duration"]) * 3600,
+        start_hour=float(args["--start-hour"]),
+        team_size=int(args["--team-size"]),
+        policy=args["--policy"],
+        seed=int(seed) if seed is not None else None,
+        record=bool(args["--record"]),
+        arrival_rates=rates.get("simulation")
+    )
+    report = await simulation.run()
+    print(report.format())
+
+    if args["--record"]:
+        save_snapshots(args["--record"], simulation.snapshots)
+    if args["--rates"]:
+        rates.save(args["--rates"])
+
+
+if __name__ == "__main__":  # pragma: no cover
+    import logging
+
+    from docopt import docopt
+
+    # The pop timer warns about every slow pop at night
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.run(main(docopt(__doc__)))
@@ -0,0 +1,198 @@
+"""
+Compact snapshots of searches, for running the matchmaking algorithm in
+another process.
+
+Sending `Search` objects to another process would mean pickling the players
+along with their connections and games. Instead, only the numbers that the
+algorithm looks at are copied into flat arrays. The other process rebuilds
+stand-in searches from them and sends back the matches as pairs of indices,
+which are then resolved against the original searches.
+
+The incremental matching graph of a queue stays in the main process. Its
+edges are copied into the snapshot as well, so the other process does not
+have to compute them again.
+"""
+
+from array import array
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from ..config import config
+from ..players import Player
+from .algorithm import (
+    FULL_GRAPH_SEARCHES,
+    IncrementalMatchingGraph,
+    WeightedGraph,
+    make_matches
+)
+from .search import CombinedSearch, Search
+
+# The config values that the algorithm depends on
+SETTINGS = (
+    "NEWBIE_BASE_MEAN",
+    "NEWBIE_MIN_GAMES",
+    "TOP_PLAYER_MIN_RATING",
+    "LADDER_SEARCH_EXPANSION_MAX",
+    "LADDER_SEARCH_EXPANSION_STEP",
+)
+
+
+class SearchSnapshot(NamedTuple):
+    rating_type: str
+    settings: Dict[str, Any]
+    # The number of parties in each search. Combined searches have several.
+    parties: array
+    # For each party
+    party_sizes: array
+    failed_attempts: array
+    # For each player
+    player_ids: array
+    means: array
+    deviations: array
+    game_counts: array
+    # The edges of the matching graph as pairs of search indices, in the order
+    # of each adjacency list, and their qualities. None if the graph is built
+    # in the other process.
+    edges: Optional[array] = None
+    edge_qualities: Optional[array] = None
+
+    @classmethod
+    def from_searches(
+        cls,
+        searches: List[Search],
+        rating_type: str,
+        graph: Optional[IncrementalMatchingGraph] = None
+    ) -> "SearchSnapshot":
+        snapshot = cls(
+            rating_type=rating_type,
+            settings={name: getattr(config, name) for name in SETTINGS},
+            parties=array("i"),
+            party_sizes=array("i"),
+            failed_attempts=array("i"),
+            player_ids=array("q"),
+            means=array("d"),
+            deviations=array("d"),
+            game_counts=array("i")
+        )
+        for search in searches:
+            parties = getattr(search, "searches", (search, ))
+            snapshot.parties.append(len(parties))
+            for party in parties:
+                snapshot.party_sizes.append(len(party.players))
+                snapshot.failed_attempts.append(party.failed_matching_attempts)
+                for player, (mean, dev) in zip(
+                    party.players, party.raw_ratings
+                ):
+                    snapshot.player_ids.append(player.id)
+                    snapshot.means.append(mean)
+                    snapshot.deviations.append(dev)
+                    snapshot.game_counts.append(
+                        player.game_count[rating_type]
+                    )
+
+        # Smaller queues are matched with the full graph, which doesn't use
+        # the incremental one
+        if graph is not None and len(searches) >= FULL_GRAPH_SEARCHES:
+            snapshot = snapshot._replace(
+                edges=array("i"), edge_qualities=array("d")
+            )
+            index = {search: i for i, search in enumerate(searches)}
+            for search, edges in graph.build(searches).items():
+                for other, quality in edges:
+                    snapshot.edges.extend((index[search], index[other]))
+                    snapshot.edge_qualities.append(quality)
+
+        return snapshot
+
+    def to_searches(self) -> List[Search]:
+        """
+        Rebuild searches with the same ratings and thresholds. The players
+        have nothing but an id, ratings and game counts.
+        """
+        players = [
+            Player(
+                player_id=player_id,
+                ratings={self.rating_type: (mean, dev)},
+                game_count={self.rating_type: game_count}
+            )
+            for player_id, mean, dev, game_count in zip(
+                self.player_ids, self.means, self.deviations, self.game_counts
+            )
+        ]
+
+        parties = []
+        start = 0
+        for size, failed_attempts in zip(
+            self.party_sizes, self.failed_attempts
+        ):
+            party = Search(
+                players[start:start + size], rating_type=self.rating_type
+            )
+            party._failed_matching_attempts = failed_attempts
+            parties.append(party)
+            start += size
+
+        searches = []
+        start = 0
+        for num_parties in self.parties:
+            if num_parties == 1:
+                searches.append(parties[start])
+            else:
+                searches.append(
+                    CombinedSearch(*parties[start:start + num_parties])
+                )
+            start += num_parties
+
+        return searches
+
+    def to_graph(self, searches: List[Search]) -> Optional["_CopiedGraph"]:
+        """
+        Rebuild the matching graph for the searches from `to_searches`.
+        """
+        if self.edges is None:
+            return None
+
+        graph: WeightedGraph = {}
+        for k, quality in enumerate(self.edge_qualities):
+            search = searches[self.edges[2 * k]]
+            other = searches[self.edges[2 * k + 1]]
+            graph.setdefault(search, []).append((other, quality))
+
+        return _CopiedGraph(graph)
+
+
+class _CopiedGraph(NamedTuple):
+    """
+    Stands in for the `IncrementalMatchingGraph` that the edges were copied
+    from.
+    """
+    graph: WeightedGraph
+
+    def build(self, searches: List[Search]) -> WeightedGraph:
+        return {
+            search: list(self.graph[search])
+            for search in searches
+            if search in self.graph
+        }
+
+
+def match_snapshot(
+    snapshot: SearchSnapshot,
+    policy: str = "stable_marriage"
+) -> List[Tuple[int, int]]:
+    """
+    Run the matchmaking algorithm on the searches in the snapshot. This is
+    meant to be called in a worker process.
+
+    :return: the matches as pairs of indices into the snapshot's searches
+    """
+    for name, value in snapshot.settings.items():
+        setattr(config, name, value)
+
+    searches = snapshot.to_searches()
+    graph = snapshot.to_graph(searches)
+    index = {search: i for i, search in enumerate(searches)}
+
+    return [
+        (index[search1], index[search2])
+        for search1, search2 in make_matches(searches, policy, graph)
+    ]
@@ -0,0 +1,235 @@
+"""
+Team composition for queues where players search in parties.
+
+Forming teams of exactly `size` players out of parties of different sizes is
+a bin packing problem. Only the number of parties of each size matters for
+how many teams can be formed, so `count_teams` solves it with dynamic
+programming over those counts. For every composition (multiset of party sizes
+that adds up to `size`) it finds how many teams to make with it.
+`compose_teams` then fills those teams with actual parties, going through them
+in order of rating so that the parties on a team have similar ratings.
+
+The number of states can grow quickly with many parties of different sizes,
+so the search gives up once a deadline has passed.
+"""
+
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Sequence, Tuple
+
+from .search import CombinedSearch, Search
+
+# Party sizes of a team, largest first
+Composition = Tuple[int, ...]
+
+
+class TimeBudgetExceeded(Exception):
+    pass
+
+
+def compositions(size: int) -> List[Composition]:
+    """
+    All ways of making a team of `size` players out of at least two parties,
+    starting with the ones with the largest parties.
+    """
+    def parts(total: int, largest: int):
+        if total == 0:
+            yield ()
+            return
+        for part in range(min(total, largest), 0, -1):
+            for rest in parts(total - part, part):
+                yield (part, *rest)
+
+    return [composition for composition in parts(size, size - 1)]
+
+
+def count_teams(
+    counts: Dict[int, int],
+    size: int,
+    deadline: Optional[float] = None
+) -> Dict[Composition, int]:
+    """
+    Find how many teams to make with each composition in order to make as
+    many teams as possible out of `counts[k]` parties of size `k`.
+
+    :param deadline: value of `time.perf_counter` after which to give up by
+        raising `TimeBudgetExceeded`
+    """
+    counter = _TeamCounter(size, deadline)
+    _, plan = counter.best(0, tuple(counts.get(k, 0) for k in range(1, size)))
+    return {
+        composition: num
+        for composition, num in zip(counter.compositions, plan)
+        if num
+    }
+
+
+class _TeamCounter:
+    """
+    Dynamic programming over the number of parties of each size, remembering
+    the results for later calls.
+    """
+
+    def __init__(self, size: int, deadline: Optional[float]):
+        self.size = size
+        self.deadline = deadline
+        self.compositions = compositions(size)
+        party_sizes = range(1, size)
+        # The number of parties of each size in each composition
+        self.party_counts = [
+            tuple(composition.count(k) for k in party_sizes)
+            for composition in self.compositions
+        ]
+        # Party sizes that still appear in the compositions from `i` on
+        self._usable = [
+            tuple(
+                any(counts[k - 1] for counts in self.party_counts[i:])
+                for k in party_sizes
+            )
+            for i in range(len(self.compositions))
+        ]
+        self._memo: Dict[
+            Tuple[int, Tuple[int, ...]], Tuple[int, Tuple[int, ...]]
+        ] = {}
+
+    def most(self, remaining: Tuple[int, ...]) -> int:
+        """The most teams that can be made with the remaining parties"""
+        if not self.compositions:
+            return 0
+        return self.best(0, remaining)[0]
+
+    def best(
+        self,
+        i: int,
+        remaining: Tuple[int, ...]
+    ) -> Tuple[int, Tuple[int, ...]]:
+        """
+        The most teams that can be made with the compositions from `i` on, and
+        the number of teams to make with each of them.
+        """
+        if not self.compositions:
+            return 0, ()
+        if i == len(self.compositions) - 1:
+            # The last composition is all solo players
+            return remaining[0] // self.size, (remaining[0] // self.size, )
+
+        key = (i, remaining)
+        if key in self._memo:
+            return self._memo[key]
+        if self.deadline is not None and time.perf_counter() > self.deadline:
+            raise TimeBudgetExceeded()
+
+        party_counts = self.party_counts[i]
+        most = min(
+            remaining[k] // count
+            for k, count in enumerate(party_counts)
+            if count
+        )
+        bound = sum(
+            (k + 1) * count
+            for k, (count, use) in enumerate(zip(remaining, self._usable[i]))
+            if use
+        ) // self.size
+        result = (-1, ())
+        # Trying the most teams first usually reaches the bound right away
+        for num in range(most, -1, -1):
+            teams, plan = self.best(i + 1, tuple(
+                have - num * need for have, need in zip(remaining, party_counts)
+            ))
+            if num + teams > result[0]:
+                result = (num + teams, (num, *plan))
+                if result[0] == bound:
+                    break
+
+        self._memo[key] = result
+        return result
+
+
+def compose_teams(
+    searches: Sequence[Search],
+    size: int,
+    deadline: Optional[float] = None
+) -> Tuple[List[Search], List[Search]]:
+    """
+    Form as many teams of `size` players as possible, grouping parties of
+    similar rating together.
+
+    The parties are gone through from the lowest rating up. Each one is put on
+    a team with the lowest rated parties that still leave it possible to make
+    the most teams, or left out if that isn't possible with it on a team.
+
+    :param deadline: value of `time.perf_counter` after which to give up
+        deciding on the teams by raising `TimeBudgetExceeded`
+    :return: the teams and the searches that are not on any team
+    """
+    teams: List[Search] = []
+    members_of_teams: List[List[Search]] = []
+    unmatched: List[Search] = []
+    party_sizes = range(1, size)
+    by_size: Dict[int, List[Search]] = {k: [] for k in party_sizes}
+    for search in searches:
+        num_players = len(search.players)
+        if num_players == size:
+            teams.append(search)
+        elif num_players > size:
+            unmatched.append(search)
+        else:
+            by_size[num_players].append(search)
+
+    means = {search: search.avg_mean for search in searches}
+    queues: Dict[int, Deque[Search]] = {
+        k: deque(sorted(parties, key=means.__getitem__))
+        for k, parties in by_size.items()
+    }
+    counter = _TeamCounter(size, deadline)
+    num_teams = counter.most(tuple(len(queues[k]) for k in party_sizes))
+    while num_teams:
+        if deadline is not None and time.perf_counter() > deadline:
+            raise TimeBudgetExceeded()
+
+        anchor = min(
+            (queue[0] for queue in queues.values() if queue),
+            key=means.__getitem__
+        )
+        k = len(anchor.players)
+        counts = tuple(len(queues[j]) for j in party_sizes)
+
+        # Each team gets the lowest rated parties of each size that it needs,
+        # so the composition that spreads the least is the one whose highest
+        # rated party is the lowest.
+        best_composition, best_mean = None, None
+        for composition, party_counts in zip(
+            counter.compositions, counter.party_counts
+        ):
+            if not party_counts[k - 1]:
+                continue
+            remaining = tuple(
+                have - need for have, need in zip(counts, party_counts)
+            )
+            if min(remaining) < 0 or counter.most(remaining) < num_teams - 1:
+                continue
+            highest = max(
+                means[queues[j][count - 1]]
+                for j, count in zip(party_sizes, party_counts)
+                if count
+            )
+            if best_mean is None or highest < best_mean:
+                best_composition, best_mean = party_counts, highest
+
+        if best_composition is None:
+            unmatched.append(queues[k].popleft())
+            continue
+
+        members = []
+        for j, count in zip(party_sizes, best_composition):
+            members.extend(queues[j].popleft() for _ in range(count))
+        members_of_teams.append(members)
+        num_teams -= 1
+
+    # Making the searches takes as long as with any other way of making
+    # teams, so it doesn't count towards the deadline
+    teams.extend(CombinedSearch(*members) for members in members_of_teams)
+    for queue in queues.values():
+        unmatched.extend(queue)
+
+    return teams, unmatched
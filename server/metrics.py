@@ -37,6 +37,13 @@ matchmaker_queue_pop = Gauge(
     ["queue"],
 )
 
+matchmaker_early_pops = Counter(
+    "server_matchmaker_queue_early_pops_total",
+    "Total number of queue pops that happened before the timer ran out "
+    "because the queue had enough good matches",
+    ["queue"],
+)
+
 # =====
 # Users
 # =====
@@ -61,6 +68,31 @@ players_online = Gauge(
     "Number of users currently online as per lobbyconnection.player_service",
 )
 
+logins_in_progress = Gauge(
+    "server_user_logins_in_progress",
+    "Number of logins that are currently being processed",
+)
+
+login_queue_depth = Gauge(
+    "server_user_login_queue_depth",
+    "Number of logins waiting to be processed",
+    ["queue"],
+)
+
+login_queue_wait = Histogram(
+    "server_user_login_queue_wait_seconds",
+    "Seconds logins spent waiting to be processed",
+    ["queue"],
+    buckets=[0.01, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300],
+)
+
+login_duration = Histogram(
+    "server_user_login_duration_seconds",
+    "Seconds from receiving a login until it was processed, including the "
+    "time spent waiting",
+    buckets=[0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120, 300],
+)
+
 
 # ========================
 # Connections and Messages
@@ -91,6 +123,56 @@ connection_on_message_received = Histogram(
     "Seconds spent in 'connection.on_message_received'",
 )
 
+command_calls = Counter(
+    "server_commands_total",
+    "Total number of commands handled",
+    ["connection", "command"],
+)
+
+command_errors = Counter(
+    "server_command_errors_total",
+    "Total number of commands whose handler raised an exception, not "
+    "counting errors that are reported to the client",
+    ["connection", "command"],
+)
+
+command_duration = Histogram(
+    "server_command_duration_seconds",
+    "Seconds spent handling a command",
+    ["connection", "command"],
+    buckets=[0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10],
+)
+
+unknown_commands = Counter(
+    "server_commands_unknown_total",
+    "Total number of commands that have no handler",
+    ["connection"],
+)
+
+send_queue_bytes = Gauge(
+    "server_send_queue_bytes",
+    "Bytes held back in the send queues of congested connections",
+    ["protocol"],
+)
+
+congested_connections = Gauge(
+    "server_congested_connections",
+    "Number of connections whose send queue is in use",
+    ["protocol"],
+)
+
+coalesced_messages = Counter(
+    "server_messages_coalesced_total",
+    "Total number of queued messages that were replaced by a newer version",
+    ["protocol"],
+)
+
+slow_consumer_disconnects = Counter(
+    "server_slow_consumer_disconnects_total",
+    "Total number of connections closed because they couldn't keep up",
+    ["protocol"],
+)
+
 
 # =====
 # Games
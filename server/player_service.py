@@ -1,5 +1,5 @@
 import asyncio
-from typing import Optional, Set, ValuesView
+from typing import Optional, Set, Type, ValuesView
 
 import aiocron
 from sqlalchemy import and_, select
@@ -9,8 +9,10 @@ import server.metrics as metrics
 from server.db import FAFDatabase
 from server.decorators import with_logger
 from server.players import Player
+from server.protocol import Protocol
 from server.rating import RatingType
 
+from .broadcast import DeltaTracker, SnapshotCache
 from .core import Service
 from .db.models import (
     avatars,
@@ -38,6 +40,9 @@ class PlayerService(Service):
         # Static-ish data fields.
         self.uniqueid_exempt = {}
         self._dirty_players = set()
+        self.player_deltas = DeltaTracker("id")
+        # All online players as sent to clients on login
+        self.snapshot = SnapshotCache("player_info", "players")
 
     async def initialize(self) -> None:
         await self.update_data()
@@ -72,6 +77,13 @@ class PlayerService(Service):
     def clear_dirty(self):
         self._dirty_players = set()
 
+    def encode_snapshot(self, protocol_class: Type[Protocol]) -> bytes:
+        """
+        Return the encoded `player_info` messages for all online players as of
+        the last dirty report.
+        """
+        return self.snapshot.encode(protocol_class)
+
     async def fetch_player_data(self, player):
         async with self._db.acquire() as conn:
             result = await conn.execute(
@@ -195,6 +207,8 @@ class PlayerService(Service):
         if player.id in self._players:
             del self._players[player.id]
             metrics.players_online.set(len(self._players))
+            self.snapshot.remove(player.id)
+        self.player_deltas.invalidate(player.id)
 
     async def has_permission_role(self, player: Player, role_name: str) -> bool:
         async with self._db.acquire() as conn:
@@ -1,13 +1,20 @@
+from .codec import Codec, JsonCodec, OrjsonCodec, get_codec
+from .compressed_json import CompressedJsonProtocol
 from .gpgnet import GpgNetClientProtocol, GpgNetServerProtocol
 from .protocol import DisconnectedError, Protocol
 from .qdatastream import QDataStreamProtocol
 from .simple_json import SimpleJsonProtocol
 
 __all__ = (
+    "Codec",
+    "CompressedJsonProtocol",
     "DisconnectedError",
     "GpgNetClientProtocol",
     "GpgNetServerProtocol",
+    "JsonCodec",
+    "OrjsonCodec",
     "Protocol",
     "QDataStreamProtocol",
-    "SimpleJsonProtocol"
+    "SimpleJsonProtocol",
+    "get_codec"
 )
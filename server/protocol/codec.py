@@ -0,0 +1,132 @@
+"""
+Serialization of message dictionaries to and from JSON text.
+
+The stdlib `json` module is always available. If `orjson` is installed it is
+used instead, but only where it produces exactly the same output as the
+stdlib encoder, so that clients can't tell which backend was used.
+"""
+
+import json
+import re
+from abc import ABCMeta, abstractmethod
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+class Codec(metaclass=ABCMeta):
+    name = None
+
+    @abstractmethod
+    def encode(self, message: Any) -> str:
+        """Serialize a message as compact JSON text"""
+        pass  # pragma: no cover
+
+    @abstractmethod
+    def decode(self, data: Union[bytes, str]) -> Any:
+        """
+        Parse JSON text
+
+        :raises: ValueError
+        """
+        pass  # pragma: no cover
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}()"
+
+
+class JsonCodec(Codec):
+    """Codec using the stdlib `json` module"""
+
+    name = "json"
+
+    def __init__(self):
+        self._encoder = json.JSONEncoder(separators=(",", ":"))
+
+    def encode(self, message: Any) -> str:
+        return self._encoder.encode(message)
+
+    def decode(self, data: Union[bytes, str]) -> Any:
+        return json.loads(data)
+
+
+# Matches orjson output that the stdlib encoder would produce differently:
+# floats that the stdlib formats with an exponent (`1e+16` and `1e-05` instead
+# of `1e16` and `0.00001`). Strings containing these patterns cause false
+# positives, which only cost a fallback.
+_FLOAT_EXPONENT = re.compile(rb"e[0-9-]")
+# Maps every digit to `0` and everything else to a space, so that runs of
+# digits can be found with a fast substring search.
+_DIGIT_RUNS = bytes(
+    ord("0") if i in b"0123456789" else ord(" ") for i in range(256)
+)
+# orjson parses integers that don't fit into 64 bits as floats
+_LONG_INTEGER = b"0" * 19
+
+
+class OrjsonCodec(JsonCodec):
+    """
+    Codec using `orjson` with a fallback to the stdlib `json` module.
+
+    For any message that the stdlib encoder can serialize, the output is the
+    same as that of `JsonCodec`, with the exception of non finite floats which
+    are not valid JSON to begin with.
+    """
+
+    name = "orjson"
+
+    def __init__(self):
+        if orjson is None:
+            raise RuntimeError("orjson is not installed")
+        super().__init__()
+
+    def encode(self, message: Any) -> str:
+        try:
+            data = orjson.dumps(message, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            return super().encode(message)
+
+        # The stdlib escapes everything that is not printable ASCII
+        if not data.isascii() or b"\x7f" in data:
+            return super().encode(message)
+
+        if b"0.0000" in data or _FLOAT_EXPONENT.search(data):
+            return super().encode(message)
+
+        return data.decode()
+
+    def decode(self, data: Union[bytes, str]) -> Any:
+        if isinstance(data, str):
+            digits = data.encode("utf-8", "surrogatepass")
+        else:
+            digits = data
+        if _LONG_INTEGER in digits.translate(_DIGIT_RUNS):
+            return super().decode(data)
+
+        try:
+            return orjson.loads(data)
+        except ValueError:
+            # Things like NaN or lone surrogates are accepted by the stdlib,
+            # and if not, it raises the usual error.
+            return super().decode(data)
+
+
+def get_codec(name: str = "auto") -> Codec:
+    """
+    Return a codec by name. `auto` picks the fastest one that is available.
+    """
+    if name == "auto":
+        name = "json" if orjson is None else "orjson"
+
+    if name == "json":
+        return JsonCodec()
+    if name == "orjson":
+        return OrjsonCodec()
+
+    raise ValueError(f"Unknown codec {name}")
+
+
+default_codec = get_codec()
@@ -0,0 +1,248 @@
+import struct
+import zlib
+from asyncio import StreamReader, StreamWriter
+from typing import Optional, Tuple
+
+from server.decorators import with_logger
+
+from .codec import Codec, default_codec
+from .protocol import Protocol
+
+FRAME_HEADER = struct.Struct("!IB")
+
+# Frame flags
+PLAIN = 0
+ZLIB = 1
+
+# The largest frame that a client may send, counting the flag. Compressed
+# frames are decompressed in chunks, and the plain frames inside of them are
+# held to the same limit, so that a small frame can't expand into a huge one.
+MAX_FRAME_SIZE = 1024 * 1024
+DECOMPRESS_CHUNK_SIZE = 64 * 1024
+
+COMPRESSION_COMMAND = "set_compression"
+COMPRESSION_COMMAND_BYTES = COMPRESSION_COMMAND.encode()
+ZLIB_METHOD = "zlib"
+
+# Preset dictionary for the zlib streams. Both sides of the connection must
+# use the exact same bytes, so this must never be changed. Add a new method
+# name instead.
+ZLIB_DICTIONARY = b"".join((
+    b'"command":"game_info","games":[{"command":"game_info",'
+    b'"visibility":"public","password_protected":false,"uid":'
+    b'"title":"","state":"open","game_type":"custom","featured_mod":"faf",'
+    b'"sim_mods":{},"mapname":"","map_file_path":"maps/.zip","host":'
+    b'"num_players":,"max_players":,"launched_at":null,"rating_type":"global",'
+    b'"rating_min":null,"rating_max":null,"enforce_rating_range":false,'
+    b'"teams":{"1":[],"2":[]}}',
+    b'"command":"player_info","players":[{"id":,"login":"",'
+    b'"avatar":{"url":"https://content.faforever.com/faf/avatars/.png",'
+    b'"tooltip":""},"country":"","clan":"","ratings":{"global":{"rating":[,],'
+    b'"number_of_games":},"ladder_1v1":{"rating":[,],"number_of_games":}},'
+    b'"global_rating":[,],"ladder_rating":[,],"number_of_games":}',
+    b'"command":"matchmaker_info","queues":[{"queue_name":"ladder1v1",'
+    b'"queue_pop_time":"","queue_pop_time_delta":,"num_players":,'
+    b'"boundary_80s":[],"boundary_75s":[]}]}',
+))
+
+
+@with_logger
+class CompressedJsonProtocol(Protocol):
+    """
+    Length prefixed frames of UTF-8 encoded JSON with optional compression.
+
+    Every frame starts with a 4 byte big endian length and a 1 byte flag. The
+    length counts the flag and the payload.
+
+    `PLAIN` frames contain a single JSON message. `ZLIB` frames contain the
+    next chunk of a zlib stream which was started with `ZLIB_DICTIONARY`.
+    Decompressing the chunk yields any number of complete `PLAIN` frames.
+
+    Connections start out uncompressed. A client can ask for compression by
+    sending
+        {"command": "set_compression", "methods": ["zlib"]}
+    to which the server responds with the method it chose, or null. All
+    frames sent by the server after the response are compressed. The client
+    may then also send compressed frames. Once compression is on, further
+    requests are answered with the method in use and change nothing.
+
+    Frames sent by the client may be at most `MAX_FRAME_SIZE` bytes long,
+    including the plain frames inside of compressed ones. Larger frames close
+    the connection.
+    """
+
+    def __init__(
+        self,
+        reader: StreamReader,
+        writer: StreamWriter,
+        codec: Codec = default_codec
+    ):
+        super().__init__(reader, writer, codec)
+        self._compressor = None
+        self._decompressor = None
+        # Plain frames that were decompressed but not read yet
+        self._decompressed = bytearray()
+
+    @staticmethod
+    def pack_frame(flag: int, payload: bytes) -> bytes:
+        return FRAME_HEADER.pack(len(payload) + 1, flag) + payload
+
+    @staticmethod
+    def encode_message(message: dict, codec: Codec = default_codec) -> bytes:
+        return CompressedJsonProtocol.encode_json(codec.encode(message))
+
+    @staticmethod
+    def encode_json(text: str) -> bytes:
+        return CompressedJsonProtocol.pack_frame(PLAIN, text.encode())
+
+    @staticmethod
+    def read_frame(buffer: bytes, pos: int = 0) -> Optional[Tuple[int, int, bytes]]:
+        """
+        Parse a frame from a buffer at the given position.
+
+        :return: (end position, flag, payload) or None if the frame is not
+            complete.
+        """
+        if len(buffer) - pos < FRAME_HEADER.size:
+            return None
+
+        length, flag = FRAME_HEADER.unpack_from(buffer, pos)
+        end = pos + 4 + length
+        if len(buffer) < end:
+            return None
+
+        return end, flag, bytes(buffer[pos + FRAME_HEADER.size:end])
+
+    @property
+    def compression(self) -> Optional[str]:
+        return ZLIB_METHOD if self._compressor is not None else None
+
+    @staticmethod
+    def decode_message(data: bytes, codec: Codec = default_codec) -> dict:
+        return codec.decode(data)
+
+    async def read_raw_message(self) -> bytes:
+        """
+        Read the payload of the next plain frame from the stream. Compression
+        requests are handled here and not returned. Only payloads that mention
+        the compression command are parsed to look for them.
+
+        On malformed stream, raises IncompleteReadError
+        """
+        while True:
+            frame = self._read_decompressed_frame()
+            if frame is not None:
+                flag, payload = frame
+            elif self._decompressor and self._decompressor.unconsumed_tail:
+                self._decompress(self._decompressor.unconsumed_tail)
+                continue
+            else:
+                flag, payload = await self._read_stream_frame()
+
+            if flag == ZLIB:
+                self._decompress(payload)
+                continue
+            if flag != PLAIN:
+                raise ValueError(f"Unknown frame flag {flag}")
+
+            if COMPRESSION_COMMAND_BYTES in payload:
+                message = self.codec.decode(payload)
+                if (
+                    isinstance(message, dict)
+                    and message.get("command") == COMPRESSION_COMMAND
+                ):
+                    self._negotiate_compression(message)
+                    continue
+
+            return payload
+
+    async def _read_stream_frame(self) -> Tuple[int, bytes]:
+        header = await self.reader.readexactly(FRAME_HEADER.size)
+        length, flag = FRAME_HEADER.unpack(header)
+        self._check_frame_length(length)
+
+        payload = await self.reader.readexactly(length - 1)
+        return flag, payload
+
+    def _read_decompressed_frame(self) -> Optional[Tuple[int, bytes]]:
+        if len(self._decompressed) >= FRAME_HEADER.size:
+            length, _ = FRAME_HEADER.unpack_from(self._decompressed)
+            self._check_frame_length(length)
+
+        frame = self.read_frame(self._decompressed)
+        if frame is None:
+            return None
+
+        end, flag, payload = frame
+        del self._decompressed[:end]
+        return flag, payload
+
+    @staticmethod
+    def _check_frame_length(length: int) -> None:
+        if length < 1:
+            raise ValueError("Malformed frame: missing flag")
+        if length > MAX_FRAME_SIZE:
+            raise ValueError(f"Frame of {length} bytes is too large")
+
+    def _decompress(self, payload: bytes) -> None:
+        """
+        Decompress at most `DECOMPRESS_CHUNK_SIZE` bytes. The rest of the
+        payload is kept in the `unconsumed_tail` of the decompressor until the
+        frames that were decompressed so far have been read.
+        """
+        if self._decompressor is None:
+            raise ValueError("Received compressed frame without negotiation")
+
+        self._decompressed += self._decompressor.decompress(
+            payload,
+            DECOMPRESS_CHUNK_SIZE
+        )
+        # Only incomplete frames are left in the buffer when more data is
+        # decompressed, and their length was checked
+        limit = MAX_FRAME_SIZE + FRAME_HEADER.size + DECOMPRESS_CHUNK_SIZE
+        if len(self._decompressed) > limit:
+            raise ValueError("Too much decompressed data")
+
+    def _negotiate_compression(self, message: dict) -> None:
+        if self._compressor is not None:
+            # Compression can't be renegotiated once it is on, since the
+            # client may already be sending compressed frames. The response
+            # tells the client that the method stays the same.
+            self._logger.debug("Refusing to renegotiate compression")
+            self.write_message(
+                {"command": COMPRESSION_COMMAND, "method": self.compression}
+            )
+            return
+
+        methods = message.get("methods") or ()
+        method = ZLIB_METHOD if ZLIB_METHOD in methods else None
+
+        # The response itself is still sent uncompressed, so it can't wait in
+        # the send queue.
+        self.flush_now()
+        self._write_all_queued()
+        self._write_transport(self.encode_message(
+            {"command": COMPRESSION_COMMAND, "method": method},
+            self.codec
+        ))
+        if method is None:
+            return
+
+        self._logger.debug("Enabling %s compression", method)
+        self._compressor = zlib.compressobj(zdict=ZLIB_DICTIONARY)
+        self._decompressor = zlib.decompressobj(zdict=ZLIB_DICTIONARY)
+
+    def _write_transport(self, data: bytes) -> None:
+        """
+        Compress the data if compression was negotiated. Compression happens
+        only once the data leaves the send queue, since queued data may still
+        be replaced.
+        """
+        if self._compressor is not None:
+            data = self.pack_frame(
+                ZLIB,
+                self._compressor.compress(data) +
+                self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            )
+
+        super()._write_transport(data)
@@ -1,42 +1,139 @@
+import asyncio
 import contextlib
-import json
+import itertools
 from abc import ABCMeta, abstractmethod
 from asyncio import StreamReader, StreamWriter
-from typing import List
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional, Tuple
 
 import server.metrics as metrics
+from server.config import config
+from server.decorators import with_logger
 
-from ..asyncio_extensions import synchronizedmethod
-
-json_encoder = json.JSONEncoder(separators=(",", ":"))
+from .codec import Codec, default_codec
 
 
 class DisconnectedError(ConnectionError):
     """For signaling that a protocol has lost connection to the remote."""
 
 
+@with_logger
 class Protocol(metaclass=ABCMeta):
-    def __init__(self, reader: StreamReader, writer: StreamWriter):
+    """
+    Base class for the client protocols.
+
+    Writes are not handed to the transport immediately. Instead, all writes
+    made during one iteration of the event loop are collected and flushed
+    together at the start of the next iteration, or earlier by `flush_now`.
+
+    Outgoing data is written to the transport until its buffer holds
+    `config.SEND_QUEUE_MAX_BYTES`. After that, further writes are held back in
+    a send queue until the client catches up. Queued writes that carry a key
+    replace any older queued write with the same key, so a slow client only
+    receives the latest version of e.g. a `game_info` message. If the queue
+    can't be emptied within `config.SLOW_CONSUMER_TIMEOUT` seconds, the
+    connection is aborted.
+    """
+
+    def __init__(
+        self,
+        reader: StreamReader,
+        writer: StreamWriter,
+        codec: Codec = default_codec
+    ):
         self.reader = reader
         self.writer = writer
-        # Force calls to drain() to only return once the data has been sent
-        self.writer.transport.set_write_buffer_limits(high=0)
+        self.codec = codec
+
+        self._queue: Dict[Hashable, bytes] = OrderedDict()
+        self._queued_bytes = 0
+        # Keys for queued writes that can't be coalesced
+        self._unique_keys = itertools.count()
+        self._congested_since: Optional[float] = None
+        self._slow_consumer_timer: Optional[asyncio.TimerHandle] = None
+
+        # Writes waiting for the next flush
+        self._pending: List[Tuple[bytes, Optional[Hashable]]] = []
+        self._flush_handle: Optional[asyncio.Handle] = None
+        self._flushed: Optional[asyncio.Future] = None
+        # Shared by everyone waiting for the buffers to empty
+        self._drain_task: Optional[asyncio.Task] = None
 
     @staticmethod
     @abstractmethod
-    def encode_message(message: dict) -> bytes:
+    def encode_message(message: dict, codec: Codec = default_codec) -> bytes:
         """
         Encode a message as raw bytes. Can be used along with `*_raw` methods.
         """
         pass  # pragma: no cover
 
+    @staticmethod
+    @abstractmethod
+    def encode_json(text: str) -> bytes:
+        """
+        Encode an already serialized JSON message as raw bytes. Can be used
+        along with `*_raw` methods.
+        """
+        pass  # pragma: no cover
+
     def is_connected(self) -> bool:
         """
         Return whether or not the connection is still alive
         """
         return not self.writer.is_closing()
 
+    def is_congested(self) -> bool:
+        """
+        Return whether further writes will be held back in the send queue
+        """
+        return bool(self._queue) or (
+            self.transport_bytes >= config.SEND_QUEUE_MAX_BYTES
+        )
+
+    @property
+    def transport_bytes(self) -> int:
+        """Number of bytes waiting in the transport buffer"""
+        return self.writer.transport.get_write_buffer_size()
+
+    @property
+    def queued_bytes(self) -> int:
+        """Number of bytes held back in the send queue"""
+        return self._queued_bytes
+
+    @property
+    def queued_messages(self) -> int:
+        """Number of writes held back in the send queue"""
+        return len(self._queue)
+
+    def congested_for(self) -> Optional[float]:
+        """
+        Return the number of seconds that the send queue has been in use, or
+        None if it is empty.
+        """
+        if self._congested_since is None:
+            return None
+
+        return asyncio.get_event_loop().time() - self._congested_since
+
+    @staticmethod
+    @abstractmethod
+    def decode_message(data: bytes, codec: Codec = default_codec) -> dict:
+        """
+        Parse a message that was read with `read_raw_message`.
+        """
+        pass  # pragma: no cover
+
     @abstractmethod
+    async def read_raw_message(self) -> bytes:
+        """
+        Asynchronously read the next message from the stream without parsing
+        it. The result can be parsed with `decode_message`, possibly in
+        another process.
+
+        :raises: IncompleteReadError
+        """
+        pass  # pragma: no cover
+
     async def read_message(self) -> dict:
         """
         Asynchronously read a message from the stream
@@ -44,7 +141,46 @@ class Protocol(metaclass=ABCMeta):
         :raises: IncompleteReadError
         :return dict: Parsed message
         """
-        pass  # pragma: no cover
+        return self.decode_message(await self.read_raw_message(), self.codec)
+
+    async def flush(self) -> None:
+        """
+        Wait until all writes made so far have been handed to the transport.
+        Unlike `drain` this does not wait for the client to receive them.
+        """
+        if self._flushed is None:
+            return
+
+        await asyncio.shield(self._flushed)
+
+    def flush_now(self) -> None:
+        """
+        Hand all pending writes to the transport without waiting for the
+        scheduled flush.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        pending, self._pending = self._pending, []
+        flushed, self._flushed = self._flushed, None
+        try:
+            if pending and self.is_connected():
+                self._write_pending(pending)
+        finally:
+            if flushed is not None and not flushed.done():
+                flushed.set_result(None)
+
+    def _write_pending(
+        self,
+        pending: List[Tuple[bytes, Optional[Hashable]]]
+    ) -> None:
+        if not self.is_congested():
+            self._write_transport(b"".join(data for data, _ in pending))
+            return
+
+        for data, key in pending:
+            self._enqueue(data, key)
 
     async def send_message(self, message: dict) -> None:
         """
@@ -53,7 +189,7 @@ class Protocol(metaclass=ABCMeta):
         :param message: Message to send
         :raises: DisconnectedError
         """
-        await self.send_raw(self.encode_message(message))
+        await self.send_raw(self.encode_message(message, self.codec))
 
     async def send_messages(self, messages: List[dict]) -> None:
         """
@@ -65,17 +201,29 @@ class Protocol(metaclass=ABCMeta):
         :raises: DisconnectedError
         """
         self.write_messages(messages)
-        await self.drain()
+        await self._flush_checked()
 
     async def send_raw(self, data: bytes) -> None:
         """
         Send raw bytes. Should generally not be used.
 
+        Like the other `send_*` methods this only waits until the data was
+        handed to the transport or the send queue, not until the client
+        received it. Slow clients are dealt with by the send queue.
+
         :param data: bytes to send
         :raises: DisconnectedError
         """
         self.write_raw(data)
-        await self.drain()
+        await self._flush_checked()
+
+    async def _flush_checked(self) -> None:
+        await self.flush()
+
+        exc = self.reader.exception()
+        if exc is not None or not self.is_connected():
+            await self.close()
+            raise DisconnectedError("Protocol connection lost!") from exc
 
     def write_message(self, message: dict) -> None:
         """
@@ -88,7 +236,7 @@ class Protocol(metaclass=ABCMeta):
         if not self.is_connected():
             raise DisconnectedError("Protocol is not connected!")
 
-        self.write_raw(self.encode_message(message))
+        self.write_raw(self.encode_message(message, self.codec))
 
     def write_messages(self, messages: List[dict]) -> None:
         """
@@ -96,47 +244,157 @@ class Protocol(metaclass=ABCMeta):
 
         :param messages: List of messages to write
         """
-        metrics.sent_messages.labels(self.__class__.__name__).inc()
-        if not self.is_connected():
-            raise DisconnectedError("Protocol is not connected!")
-
-        self.writer.writelines([self.encode_message(msg) for msg in messages])
+        self.write_raw(b"".join(
+            self.encode_message(msg, self.codec) for msg in messages
+        ))
 
-    def write_raw(self, data: bytes) -> None:
+    def write_raw(self, data: bytes, key: Optional[Hashable] = None) -> None:
         """
         Write raw bytes into the message buffer. Should generally not be used.
 
         :param data: bytes to send
+        :param key: if the data has to be queued, it replaces any queued data
+            with the same key.
         """
         metrics.sent_messages.labels(self.__class__.__name__).inc()
         if not self.is_connected():
             raise DisconnectedError("Protocol is not connected!")
 
+        self._pending.append((data, key))
+        if self._flush_handle is None:
+            loop = asyncio.get_event_loop()
+            self._flush_handle = loop.call_soon(self.flush_now)
+            self._flushed = loop.create_future()
+
+    def _enqueue(self, data: bytes, key: Optional[Hashable]) -> None:
+        if key is None:
+            key = next(self._unique_keys)
+        else:
+            old_data = self._queue.pop(key, None)
+            if old_data is not None:
+                self._queued_bytes -= len(old_data)
+                metrics.coalesced_messages.labels(
+                    self.__class__.__name__
+                ).inc()
+
+        self._queue[key] = data
+        self._queued_bytes += len(data)
+        self._on_congested()
+
+    def _write_transport(self, data: bytes) -> None:
+        """Hand data over to the transport. Hook for subclasses."""
         self.writer.write(data)
 
+    def _on_congested(self) -> None:
+        if self._congested_since is None:
+            loop = asyncio.get_event_loop()
+            self._congested_since = loop.time()
+            self._slow_consumer_timer = loop.call_later(
+                config.SLOW_CONSUMER_TIMEOUT,
+                self._abort_slow_consumer
+            )
+
+        self._start_drain()
+
+    def _on_queue_empty(self) -> None:
+        self._congested_since = None
+        if self._slow_consumer_timer is not None:
+            self._slow_consumer_timer.cancel()
+            self._slow_consumer_timer = None
+
+    def _clear_queue(self) -> None:
+        self._queue.clear()
+        self._queued_bytes = 0
+        self._on_queue_empty()
+
+    def _write_all_queued(self) -> None:
+        """Move everything from the send queue to the transport."""
+        if self._queue:
+            data = b"".join(self._queue.values())
+            self._clear_queue()
+            self._write_transport(data)
+
+    def _write_queued(self) -> None:
+        """Move data from the send queue to the transport up to the budget."""
+        chunks = []
+        size = 0
+        while self._queue and (not chunks or size < config.SEND_QUEUE_MAX_BYTES):
+            _, data = self._queue.popitem(last=False)
+            chunks.append(data)
+            size += len(data)
+
+        self._queued_bytes -= size
+        if not self._queue:
+            self._on_queue_empty()
+
+        self._write_transport(b"".join(chunks))
+
+    def _abort_slow_consumer(self) -> None:
+        self._slow_consumer_timer = None
+        self._logger.warning(
+            "Aborting slow connection with %d bytes queued for %.1f seconds",
+            self.queued_bytes + self.transport_bytes,
+            self.congested_for()
+        )
+        metrics.slow_consumer_disconnects.labels(
+            self.__class__.__name__
+        ).inc()
+        self._clear_queue()
+        self.writer.transport.abort()
+
     async def close(self) -> None:
         """
         Close the underlying writer as soon as the buffer has emptied.
         :return:
         """
+        self.flush_now()
+        if self.is_connected():
+            self._write_all_queued()
+        self._clear_queue()
         self.writer.close()
         with contextlib.suppress(Exception):
             await self.writer.wait_closed()
 
-    @synchronizedmethod
     async def drain(self) -> None:
         """
-        Await the write buffer to empty.
-        See StreamWriter.drain()
+        Await the send queue to empty and the write buffer to drop below its
+        high water mark. See StreamWriter.drain()
 
         :raises: DisconnectedError if the client disconnects while waiting for
         the write buffer to empty.
         """
-        # Method needs to be synchronized as drain() cannot be called
-        # concurrently by multiple coroutines:
-        # http://bugs.python.org/issue29930.
+        self.flush_now()
+        await asyncio.shield(self._start_drain())
+
+    def _start_drain(self) -> asyncio.Task:
+        # StreamWriter.drain() cannot be called concurrently by multiple
+        # coroutines: http://bugs.python.org/issue29930. So everyone waits
+        # for the same task instead.
+        if self._drain_task is None or self._drain_task.done():
+            self._drain_task = asyncio.ensure_future(self._drain())
+            self._drain_task.add_done_callback(_retrieve_exception)
+
+        return self._drain_task
+
+    async def _drain(self) -> None:
         try:
-            await self.writer.drain()
+            while True:
+                await self.writer.drain()
+                if self._pending:
+                    self.flush_now()
+                elif self._queue:
+                    if not self.is_connected():
+                        raise DisconnectedError("Protocol is not connected!")
+                    self._write_queued()
+                else:
+                    return
         except Exception as e:
             await self.close()
             raise DisconnectedError("Protocol connection lost!") from e
+
+
+def _retrieve_exception(task: asyncio.Task) -> None:
+    # Nobody might be waiting for the task, e.g. when it was started to empty
+    # the send queue.
+    if not task.cancelled():
+        task.exception()
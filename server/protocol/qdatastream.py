@@ -1,11 +1,14 @@
+import asyncio
 import base64
 import json
 import struct
+from asyncio import StreamReader, StreamWriter
 from typing import Tuple
 
 from server.decorators import with_logger
 
-from .protocol import Protocol, json_encoder
+from .codec import Codec, default_codec
+from .protocol import Protocol
 
 
 @with_logger
@@ -14,6 +17,16 @@ class QDataStreamProtocol(Protocol):
     Implements the legacy QDataStream-based encoding scheme
     """
 
+    def __init__(
+        self,
+        reader: StreamReader,
+        writer: StreamWriter,
+        codec: Codec = default_codec
+    ):
+        super().__init__(reader, writer, codec)
+        # Bytes that have been read from the stream but not parsed yet
+        self._buffer = bytearray()
+
     @staticmethod
     def read_qstring(buffer: bytes, pos: int = 0) -> Tuple[int, str]:
         """
@@ -23,19 +36,22 @@ class QDataStreamProtocol(Protocol):
 
         Pos is added to buffer_pos.
 
+        Passing a `memoryview` avoids copying the string before it is
+        decoded.
+
         :type buffer: bytes
         :return (int, str): (buffer_pos, message)
         """
-        chunk = buffer[pos:pos + 4]
-        rest = buffer[pos + 4:]
-        assert len(chunk) == 4
+        assert len(buffer) - pos >= 4
 
-        (size, ) = struct.unpack("!I", chunk)
-        if len(rest) < size:
+        (size, ) = struct.unpack_from("!I", buffer, pos)
+        start = pos + 4
+        end = start + size
+        if len(buffer) < end:
             raise ValueError(
                 "Malformed QString: Claims length {} but actually {}. Entire buffer: {}"
-                .format(size, len(rest), base64.b64encode(buffer)))
-        return size + pos + 4, (buffer[pos + 4:pos + 4 + size]).decode("UTF-16BE")
+                .format(size, len(buffer) - start, base64.b64encode(buffer)))
+        return end, str(buffer[start:end], "UTF-16BE")
 
     @staticmethod
     def pack_qstring(message: str) -> bytes:
@@ -47,10 +63,10 @@ class QDataStreamProtocol(Protocol):
         return struct.pack("!I", len(block)) + block
 
     @staticmethod
-    def read_block(data):
-        buffer_pos = 0
-        while len(data[buffer_pos:]) > 4:
-            buffer_pos, msg = QDataStreamProtocol.read_qstring(data, buffer_pos)
+    def read_block(data, pos: int = 0):
+        view = memoryview(data)
+        while len(view) - pos > 4:
+            pos, msg = QDataStreamProtocol.read_qstring(view, pos)
             yield msg
 
     @staticmethod
@@ -67,7 +83,7 @@ class QDataStreamProtocol(Protocol):
         return QDataStreamProtocol.pack_block(msg)
 
     @staticmethod
-    def encode_message(message: dict) -> bytes:
+    def encode_message(message: dict, codec: Codec = default_codec) -> bytes:
         """
         Encodes a python object as a block of QStrings
         """
@@ -77,26 +93,25 @@ class QDataStreamProtocol(Protocol):
         elif command == "pong":
             return PONG_MSG
 
-        return QDataStreamProtocol.pack_message(json_encoder.encode(message))
+        return QDataStreamProtocol.encode_json(codec.encode(message))
 
-    async def read_message(self):
-        """
-        Read a message from the stream
-
-        On malformed stream, raises IncompleteReadError
+    @staticmethod
+    def encode_json(text: str) -> bytes:
+        return QDataStreamProtocol.pack_message(text)
 
-        :return dict: Parsed message
+    @staticmethod
+    def decode_message(block: bytes, codec: Codec = default_codec) -> dict:
+        """
+        Parse a block of QStrings that was read with `read_raw_message`
         """
-        (block_length, ) = struct.unpack("!I", (await self.reader.readexactly(4)))
-        block = await self.reader.readexactly(block_length)
         # FIXME: New protocol will remove the need for this
 
-        pos, action = self.read_qstring(block)
+        pos, action = QDataStreamProtocol.read_qstring(block)
         if action in ("PING", "PONG"):
             return {"command": action.lower()}
 
         try:
-            message = json.loads(action)
+            message = codec.decode(action)
         except json.decoder.JSONDecodeError as e:
             raise json.decoder.JSONDecodeError(
                 msg = f"Invalid JSON, full action string was: \
@@ -104,9 +119,9 @@ class QDataStreamProtocol(Protocol):
                 doc = e.doc,
                 pos = e.pos) from e
         try:
-            for part in self.read_block(block):
+            for part in QDataStreamProtocol.read_block(block, pos):
                 try:
-                    message_part = json.loads(part)
+                    message_part = codec.decode(part)
                     if part != action:
                         message.update(message_part)
                 except (ValueError, TypeError):
@@ -117,6 +132,48 @@ class QDataStreamProtocol(Protocol):
             pass
         return message
 
+    async def read_raw_message(self) -> bytes:
+        """
+        Read the next block from the stream
+
+        On malformed stream, raises IncompleteReadError
+        """
+        return await self._read_block()
+
+    async def _read_block(self) -> bytes:
+        """
+        Read the next length prefixed block from the stream.
+
+        Data is read from the stream in chunks of up to `READ_CHUNK_SIZE`
+        bytes, so a chunk can contain several small blocks which are then
+        parsed without waiting on the stream again.
+
+        :raises: IncompleteReadError
+        """
+        buffer = self._buffer
+        expected = 4
+        while True:
+            if len(buffer) >= 4:
+                (block_length, ) = struct.unpack_from("!I", buffer)
+                expected = 4 + block_length
+                if len(buffer) >= expected:
+                    with memoryview(buffer) as view:
+                        block = bytes(view[4:expected])
+                    del buffer[:expected]
+                    return block
+
+            chunk = await self.reader.read(
+                max(READ_CHUNK_SIZE, expected - len(buffer))
+            )
+            if not chunk:
+                partial = bytes(buffer)
+                buffer.clear()
+                raise asyncio.IncompleteReadError(partial, expected)
+
+            buffer += chunk
+
+
+READ_CHUNK_SIZE = 2 ** 16
 
 PING_MSG = QDataStreamProtocol.pack_message("PING")
 PONG_MSG = QDataStreamProtocol.pack_message("PONG")
@@ -1,13 +1,20 @@
-import json
-
-from .protocol import Protocol, json_encoder
+from .codec import Codec, default_codec
+from .protocol import Protocol
 
 
 class SimpleJsonProtocol(Protocol):
     @staticmethod
-    def encode_message(message: dict) -> bytes:
-        return (json_encoder.encode(message) + "\n").encode()
+    def encode_message(message: dict, codec: Codec = default_codec) -> bytes:
+        return SimpleJsonProtocol.encode_json(codec.encode(message))
+
+    @staticmethod
+    def encode_json(text: str) -> bytes:
+        return (text + "\n").encode()
+
+    @staticmethod
+    def decode_message(data: bytes, codec: Codec = default_codec) -> dict:
+        return codec.decode(data)
 
-    async def read_message(self) -> dict:
+    async def read_raw_message(self) -> bytes:
         line = await self.reader.readline()
-        return json.loads(line.strip())
+        return line.strip()
@@ -20,12 +20,46 @@ class RatingTypeMap(DefaultDict[K, V]):
     A thin wrapper around `defaultdict` which stores RatingType keys as strings.
     """
     def __init__(self, default_factory, *args, **kwargs):
+        # Incremented whenever the map is modified. Used to tell when values
+        # that were computed from it need to be recomputed.
+        self.version = 0
         super().__init__(default_factory, *args, **kwargs)
 
         # Initialize defaults for enumerated rating types
         for rating in (RatingType.GLOBAL, RatingType.LADDER_1V1):
             self.__getitem__(rating)
 
+    def __setitem__(self, key: K, value: V) -> None:
+        super().__setitem__(key, value)
+        self.version += 1
+
+    def __delitem__(self, key: K) -> None:
+        super().__delitem__(key)
+        self.version += 1
+
+    def update(self, *args, **kwargs) -> None:
+        super().update(*args, **kwargs)
+        self.version += 1
+
+    def setdefault(self, key: K, default: V = None) -> V:
+        if key not in self:
+            self.version += 1
+        return super().setdefault(key, default)
+
+    def pop(self, key: K, *args) -> V:
+        if key in self:
+            self.version += 1
+        return super().pop(key, *args)
+
+    def popitem(self) -> Tuple[K, V]:
+        item = super().popitem()
+        self.version += 1
+        return item
+
+    def clear(self) -> None:
+        super().clear()
+        self.version += 1
+
 
 # Only used to coerce rating type.
 class PlayerRatings(RatingTypeMap[Tuple[float, float]]):
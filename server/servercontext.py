@@ -1,9 +1,11 @@
 import asyncio
 import socket
-from typing import Callable, Dict, Iterable, Type
+import time
+from typing import Callable, Dict, Iterable, Set, Type
 
 import server.metrics as metrics
 
+from .broadcast import BroadcastBatch
 from .core import Service
 from .decorators import with_logger
 from .lobbyconnection import LobbyConnection
@@ -30,6 +32,8 @@ class ServerContext:
         self._connection_factory = connection_factory
         self._services = services
         self.connections: Dict[LobbyConnection, Protocol] = {}
+        # Connections that had delta updates turned off while congested
+        self._paused_deltas: Set[LobbyConnection] = set()
         self.protocol_class = protocol_class
 
     def __repr__(self):
@@ -79,14 +83,74 @@ class ServerContext:
                     "Encountered error in broadcast: %s", conn
                 )
 
+    def write_broadcast_batch(self, batch: BroadcastBatch):
+        """
+        Write all messages from the batch that a connection should receive in
+        a single write.
+
+        Connections whose send queue is in use receive every game and player
+        as a separate message instead, so that the queue can replace older
+        messages about the same game or player. They also stop receiving
+        delta updates until their queue is empty again.
+        """
+        queued_bytes = 0
+        congested = 0
+        for conn, proto in self.connections.items():
+            try:
+                if not proto.is_connected():
+                    continue
+
+                if proto.is_congested():
+                    self._write_congested(conn, proto, batch)
+                    queued_bytes += proto.queued_bytes
+                    congested += 1
+                    continue
+
+                if conn in self._paused_deltas:
+                    self._paused_deltas.discard(conn)
+                    conn.delta_updates_since = time.monotonic()
+
+                group_key = batch.group_key(conn)
+                data = batch.encode_group(group_key, self.protocol_class)
+                if data:
+                    proto.write_raw(data)
+                batch.mark_sent(conn, group_key)
+            except Exception:
+                self._logger.exception(
+                    "Encountered error in broadcast: %s", conn
+                )
+
+        protocol_name = self.protocol_class.__name__
+        metrics.send_queue_bytes.labels(protocol_name).set(queued_bytes)
+        metrics.congested_connections.labels(protocol_name).set(congested)
+
+    def _write_congested(self, conn, proto: Protocol, batch: BroadcastBatch):
+        if getattr(conn, "delta_updates_since", None) is not None:
+            conn.delta_updates_since = None
+            self._paused_deltas.add(conn)
+
+        for key, data in batch.encode_items_for(conn, self.protocol_class):
+            proto.write_raw(data, key)
+        batch.mark_sent(conn, batch.group_key(conn))
+
     async def client_connected(self, stream_reader, stream_writer):
         self._logger.debug("%s: Client connected", self.name)
         protocol = self.protocol_class(stream_reader, stream_writer)
+        await self.handle_connection(
+            protocol,
+            Address(*stream_writer.get_extra_info("peername"))
+        )
+
+    async def handle_connection(self, protocol: Protocol, address: Address):
+        """
+        Feed messages from the protocol to a new connection until either side
+        disconnects.
+        """
         connection = self._connection_factory()
         self.connections[connection] = protocol
 
         try:
-            await connection.on_connection_made(protocol, Address(*stream_writer.get_extra_info("peername")))
+            await connection.on_connection_made(protocol, address)
             metrics.user_connections.labels("None", "None").inc()
             while protocol.is_connected():
                 message = await protocol.read_message()
@@ -95,12 +159,13 @@ class ServerContext:
         except (ConnectionError, TimeoutError, asyncio.CancelledError):
             pass
         except asyncio.IncompleteReadError as ex:
-            if not stream_reader.at_eof():
+            if not protocol.reader.at_eof():
                 self._logger.exception(ex)
         except Exception as ex:
             self._logger.exception(ex)
         finally:
             del self.connections[connection]
+            self._paused_deltas.discard(connection)
             await protocol.close()
             await connection.on_connection_lost()
 
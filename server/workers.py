@@ -0,0 +1,639 @@
+"""
+Multi-process mode.
+
+A number of worker processes accept the client connections on the public
+ports using SO_REUSEPORT, so that the kernel spreads the connections over
+them. The workers take care of everything that only concerns a single
+connection: the protocol framing, compression and compression negotiation,
+and the send queues of slow clients.
+
+The coordinator process runs the `ServerInstance` with all services and their
+state. Every client connection is represented there by a `RemoteProtocol`
+which relays messages to and from the worker over a unix socket.
+
+Every frame on the unix socket starts with a header containing the frame
+type, the id of the client connection within its worker and the payload
+length. Messages from clients are read by the worker with
+`Protocol.read_raw_message` and sent to the coordinator unparsed, together
+with the name of the client's protocol when the client connects. The
+coordinator parses each message once with the `decode_message` of that
+protocol, since it needs the message objects anyway. Data for clients is sent
+to the workers as newline separated JSON, which the worker converts to the
+framing of the client's protocol. The JSON is encoded once by the
+coordinator: any format for sending the message objects to the worker would
+cost as much to produce, and broadcasts are encoded only once for all
+connections.
+
+The send queues of slow clients live in the workers, so the workers regularly
+report how much data is waiting for each connection. The coordinator treats
+connections with a non empty queue in their worker as congested, so it
+pauses their delta updates and sends them keyed writes, which the worker
+coalesces in the send queue like `Protocol` does for direct connections.
+Connections that are closed because they couldn't keep up are only counted in
+the metrics of their worker, which aren't exported.
+
+The unix socket is only accessible to the user running the server, and the
+coordinator refuses workers running as a different user.
+"""
+
+import asyncio
+import itertools
+import multiprocessing
+import os
+import socket
+import struct
+import tempfile
+import time
+from functools import partial
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple, Type
+
+from .config import config
+from .decorators import with_logger
+from .protocol import (
+    CompressedJsonProtocol,
+    DisconnectedError,
+    Protocol,
+    QDataStreamProtocol,
+    SimpleJsonProtocol
+)
+from .protocol.codec import Codec, default_codec
+from .servercontext import ServerContext
+from .types import Address
+
+IPC_HEADER = struct.Struct("!BII")
+
+# Worker to coordinator
+CONNECT = 0     # Payload is the peer address and protocol name as JSON
+MESSAGE = 1     # Payload is a message as read by `Protocol.read_raw_message`
+DISCONNECT = 2
+STATS = 5       # Payload is the `STATS_FORMAT` packed `SendQueueStats`
+# Coordinator to worker
+WRITE = 3       # Payload is newline separated JSON
+CLOSE = 4
+WRITE_KEYED = 6  # Payload is the key length, the key and one JSON message
+
+ListenAddress = Tuple[str, int, Type[Protocol]]
+
+# The protocols that workers can accept clients with, by name
+CLIENT_PROTOCOLS: Dict[str, Type[Protocol]] = {
+    protocol_class.__name__: protocol_class
+    for protocol_class in (
+        QDataStreamProtocol,
+        SimpleJsonProtocol,
+        CompressedJsonProtocol
+    )
+}
+# Transport bytes, queued bytes, queued messages and congested seconds
+SendQueueStats = Tuple[int, int, int, Optional[float]]
+
+EMPTY_STATS: SendQueueStats = (0, 0, 0, None)
+# Congested seconds are negative if the connection is not congested
+STATS_FORMAT = struct.Struct("!QQId")
+KEY_LENGTH = struct.Struct("!H")
+# How often the workers report the send queue usage of their connections
+STATS_INTERVAL = 1
+
+
+def pack_ipc(kind: int, conn_id: int, payload: bytes = b"") -> bytes:
+    return IPC_HEADER.pack(kind, conn_id, len(payload)) + payload
+
+
+async def read_ipc(reader: asyncio.StreamReader) -> Tuple[int, int, bytes]:
+    """
+    Read one frame from the unix socket
+
+    :raises: IncompleteReadError
+    :return: (frame type, connection id, payload)
+    """
+    header = await reader.readexactly(IPC_HEADER.size)
+    kind, conn_id, length = IPC_HEADER.unpack(header)
+    payload = await reader.readexactly(length) if length else b""
+
+    return kind, conn_id, payload
+
+
+def pack_stats(stats: SendQueueStats) -> bytes:
+    transport_bytes, queued_bytes, queued_messages, congested = stats
+    return STATS_FORMAT.pack(
+        transport_bytes,
+        queued_bytes,
+        queued_messages,
+        -1. if congested is None else congested
+    )
+
+
+def unpack_stats(payload: bytes) -> SendQueueStats:
+    transport_bytes, queued_bytes, queued_messages, congested = (
+        STATS_FORMAT.unpack(payload)
+    )
+    return (
+        transport_bytes,
+        queued_bytes,
+        queued_messages,
+        None if congested < 0 else congested
+    )
+
+
+def pack_keyed(key: Hashable, data: bytes) -> bytes:
+    """
+    Prefix `data` with its coalescing key. The worker only compares keys, so
+    any key that can be serialized as JSON is sent as its JSON text.
+    """
+    key_data = default_codec.encode(key).encode()
+    return KEY_LENGTH.pack(len(key_data)) + key_data + data
+
+
+def unpack_keyed(payload: bytes) -> Tuple[bytes, bytes]:
+    """:return: (key, data)"""
+    (length,) = KEY_LENGTH.unpack_from(payload)
+    start = KEY_LENGTH.size
+    return payload[start:start + length], payload[start + length:]
+
+
+def private_socket_path() -> str:
+    """
+    Return a path for the unix socket in a new directory that only the
+    current user can access.
+    """
+    return os.path.join(tempfile.mkdtemp(prefix="faf-lobby-"), "workers.sock")
+
+
+def peer_uid(sock: socket.socket) -> int:
+    """Return the user id of the process at the other end of a unix socket"""
+    creds = sock.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+    )
+    _, uid, _ = struct.unpack("3i", creds)
+    return uid
+
+
+class WorkerChannel:
+    """The coordinator's end of the unix socket to one worker"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self._drain_lock = asyncio.Lock()
+
+    def write(self, kind: int, conn_id: int, payload: bytes = b"") -> None:
+        self.writer.write(pack_ipc(kind, conn_id, payload))
+
+    def is_closing(self) -> bool:
+        return self.writer.is_closing()
+
+    async def drain(self) -> None:
+        # Shared by all connections of the worker, see
+        # http://bugs.python.org/issue29930
+        async with self._drain_lock:
+            await self.writer.drain()
+
+
+class _RemoteTransport:
+    def __init__(self, writer: "_RemoteWriter"):
+        self._writer = writer
+
+    def get_write_buffer_size(self) -> int:
+        # Slow clients are dealt with by the send queues in the worker. See
+        # `RemoteProtocol.transport_bytes` for how much data is waiting there.
+        return 0
+
+    def abort(self) -> None:
+        self._writer.close()
+
+
+class _RemoteWriter:
+    """
+    Stands in for the `StreamWriter` of a connection that is handled by a
+    worker process.
+    """
+
+    def __init__(self, channel: WorkerChannel, conn_id: int):
+        self.channel = channel
+        self.conn_id = conn_id
+        self.transport = _RemoteTransport(self)
+        self._closed = False
+
+    def write(self, data: bytes) -> None:
+        self.channel.write(WRITE, self.conn_id, data)
+
+    def write_keyed(self, data: bytes, key: Hashable) -> None:
+        self.channel.write(WRITE_KEYED, self.conn_id, pack_keyed(key, data))
+
+    def is_closing(self) -> bool:
+        return self._closed or self.channel.is_closing()
+
+    def close(self) -> None:
+        if self.is_closing():
+            self._closed = True
+            return
+
+        self._closed = True
+        self.channel.write(CLOSE, self.conn_id)
+
+    def mark_closed(self) -> None:
+        """The worker reported that the client disconnected"""
+        self._closed = True
+
+    async def wait_closed(self) -> None:
+        pass
+
+    async def drain(self) -> None:
+        if self.channel.is_closing():
+            raise ConnectionResetError("Worker disconnected")
+
+        await self.channel.drain()
+
+
+class RemoteProtocol(Protocol):
+    """
+    The coordinator side of a client connection that is handled by a worker.
+    Messages are encoded as newline separated JSON, which the worker converts
+    to the framing of the protocol the client is actually using. Messages from
+    the client arrive unparsed and are decoded by `client_protocol`.
+
+    Nothing is queued here, the send queue of the connection is in the worker.
+    """
+
+    def __init__(
+        self,
+        channel: WorkerChannel,
+        conn_id: int,
+        codec: Codec = default_codec,
+        client_protocol: Type[Protocol] = SimpleJsonProtocol
+    ):
+        super().__init__(
+            asyncio.StreamReader(),
+            _RemoteWriter(channel, conn_id),
+            codec
+        )
+        self.client_protocol = client_protocol
+        self._messages: asyncio.Queue = asyncio.Queue()
+        # The send queue usage of the connection in the worker
+        self.remote_stats = EMPTY_STATS
+
+    @staticmethod
+    def encode_message(message: dict, codec: Codec = default_codec) -> bytes:
+        return RemoteProtocol.encode_json(codec.encode(message))
+
+    @staticmethod
+    def encode_json(text: str) -> bytes:
+        return (text + "\n").encode()
+
+    def is_congested(self) -> bool:
+        return self.queued_messages > 0 or (
+            self.transport_bytes >= config.SEND_QUEUE_MAX_BYTES
+        )
+
+    @property
+    def transport_bytes(self) -> int:
+        return self.remote_stats[0]
+
+    @property
+    def queued_bytes(self) -> int:
+        return self.remote_stats[1]
+
+    @property
+    def queued_messages(self) -> int:
+        return self.remote_stats[2]
+
+    def congested_for(self) -> Optional[float]:
+        return self.remote_stats[3]
+
+    def _write_pending(
+        self,
+        pending: List[Tuple[bytes, Optional[Hashable]]]
+    ) -> None:
+        # Keyed writes get their own frames, so that the worker can coalesce
+        # them if the client is slow
+        unkeyed = []
+        for data, key in pending:
+            if key is None:
+                unkeyed.append(data)
+                continue
+
+            if unkeyed:
+                self.writer.write(b"".join(unkeyed))
+                unkeyed = []
+            self.writer.write_keyed(data, key)
+
+        if unkeyed:
+            self.writer.write(b"".join(unkeyed))
+
+    def decode_message(self, data: bytes, codec: Codec = default_codec) -> dict:
+        return self.client_protocol.decode_message(data, codec)
+
+    def feed_raw_message(self, data: bytes) -> None:
+        self._messages.put_nowait(data)
+
+    def feed_eof(self) -> None:
+        self.writer.mark_closed()
+        self.reader.feed_eof()
+        self._messages.put_nowait(None)
+
+    async def read_raw_message(self) -> bytes:
+        data = await self._messages.get()
+        if data is None:
+            # Make sure that further reads fail as well
+            self._messages.put_nowait(None)
+            raise DisconnectedError("Client disconnected")
+
+        return data
+
+
+@with_logger
+class CoordinatorContext(ServerContext):
+    """
+    Accepts connections from worker processes on a unix socket, and handles
+    the client connections of each worker like `ServerContext` does for
+    clients that connect directly.
+    """
+
+    def __init__(self, name, connection_factory, services):
+        super().__init__(name, connection_factory, services, RemoteProtocol)
+
+    async def listen(self, path: str):
+        self._logger.debug("%s: listen(%s)", self.name, path)
+
+        self._server = await asyncio.start_unix_server(
+            self.worker_connected,
+            path=path
+        )
+        os.chmod(path, 0o600)
+        return self._server
+
+    async def worker_connected(self, stream_reader, stream_writer):
+        uid = peer_uid(stream_writer.get_extra_info("socket"))
+        if uid != os.getuid():
+            self._logger.warning(
+                "%s: Refusing worker running as user %d", self.name, uid
+            )
+            stream_writer.close()
+            return
+
+        self._logger.info("%s: Worker connected", self.name)
+        channel = WorkerChannel(stream_reader, stream_writer)
+        protocols: Dict[int, RemoteProtocol] = {}
+
+        try:
+            while True:
+                kind, conn_id, payload = await read_ipc(stream_reader)
+                if kind == MESSAGE:
+                    protocol = protocols.get(conn_id)
+                    if protocol is not None:
+                        protocol.feed_raw_message(payload)
+                elif kind == CONNECT:
+                    host, port, protocol_name = default_codec.decode(payload)
+                    protocol = RemoteProtocol(
+                        channel,
+                        conn_id,
+                        client_protocol=CLIENT_PROTOCOLS[protocol_name]
+                    )
+                    protocols[conn_id] = protocol
+                    asyncio.ensure_future(self.handle_connection(
+                        protocol,
+                        Address(host, port)
+                    ))
+                elif kind == DISCONNECT:
+                    protocol = protocols.pop(conn_id, None)
+                    if protocol is not None:
+                        protocol.feed_eof()
+                elif kind == STATS:
+                    protocol = protocols.get(conn_id)
+                    if protocol is not None:
+                        protocol.remote_stats = unpack_stats(payload)
+                else:
+                    self._logger.warning("Unexpected frame type %d", kind)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception:
+            self._logger.exception("Error handling worker frames")
+        finally:
+            self._logger.warning(
+                "%s: Worker disconnected, dropping %d clients",
+                self.name, len(protocols)
+            )
+            for protocol in protocols.values():
+                protocol.feed_eof()
+            stream_writer.close()
+
+
+@with_logger
+class Worker:
+    """
+    Accepts client connections and relays their messages to the coordinator
+    at `coordinator_path`.
+    """
+
+    def __init__(self, coordinator_path: str, addresses: Iterable[ListenAddress]):
+        self.coordinator_path = coordinator_path
+        self.addresses = list(addresses)
+        self.servers: List[asyncio.AbstractServer] = []
+        self._protocols: Dict[int, Protocol] = {}
+        self._ids = itertools.count()
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._drain_lock = asyncio.Lock()
+        self._relay_task: Optional[asyncio.Task] = None
+        self._stats_task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        self._reader, self._writer = await asyncio.open_unix_connection(
+            self.coordinator_path
+        )
+        self._relay_task = asyncio.ensure_future(self._relay_writes())
+        self._stats_task = asyncio.ensure_future(self._report_stats())
+
+        for host, port, protocol_class in self.addresses:
+            server = await asyncio.start_server(
+                partial(self.client_connected, protocol_class),
+                host=host,
+                port=port,
+                reuse_port=True
+            )
+            for sock in server.sockets:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            self.servers.append(server)
+
+    async def wait_closed(self) -> None:
+        """Wait until the coordinator goes away"""
+        await self._relay_task
+
+    async def shutdown(self) -> None:
+        if self._stats_task is not None:
+            self._stats_task.cancel()
+        for server in self.servers:
+            server.close()
+        for protocol in list(self._protocols.values()):
+            await protocol.close()
+        if self._writer is not None:
+            self._writer.close()
+
+    def _send(self, kind: int, conn_id: int, payload: bytes = b"") -> None:
+        if not self._writer.is_closing():
+            self._writer.write(pack_ipc(kind, conn_id, payload))
+
+    async def _drain(self) -> None:
+        async with self._drain_lock:
+            await self._writer.drain()
+
+    async def client_connected(
+        self,
+        protocol_class: Type[Protocol],
+        stream_reader: asyncio.StreamReader,
+        stream_writer: asyncio.StreamWriter
+    ):
+        conn_id = next(self._ids)
+        protocol = protocol_class(stream_reader, stream_writer)
+        self._protocols[conn_id] = protocol
+        host, port = stream_writer.get_extra_info("peername")[:2]
+        self._send(CONNECT, conn_id, default_codec.encode(
+            [host, port, protocol_class.__name__]
+        ).encode())
+
+        try:
+            while protocol.is_connected():
+                data = await protocol.read_raw_message()
+                self._send(MESSAGE, conn_id, data)
+                await self._drain()
+        except (ConnectionError, asyncio.IncompleteReadError, TimeoutError):
+            pass
+        except Exception:
+            self._logger.exception("Error reading from client")
+        finally:
+            del self._protocols[conn_id]
+            self._send(DISCONNECT, conn_id)
+            await protocol.close()
+
+    async def _relay_writes(self) -> None:
+        try:
+            while True:
+                kind, conn_id, payload = await read_ipc(self._reader)
+                protocol = self._protocols.get(conn_id)
+                if protocol is None or not protocol.is_connected():
+                    continue
+
+                if kind == WRITE:
+                    protocol.write_raw(self._reframe(protocol, payload))
+                elif kind == WRITE_KEYED:
+                    key, data = unpack_keyed(payload)
+                    protocol.write_raw(self._reframe(protocol, data), key)
+                elif kind == CLOSE:
+                    asyncio.ensure_future(protocol.close())
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self._logger.info("Coordinator disconnected")
+        finally:
+            await self.shutdown()
+
+    async def _report_stats(self) -> None:
+        """
+        Report the send queue usage of every connection whose usage changed
+        since the last report.
+        """
+        reported: Dict[int, SendQueueStats] = {}
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            for conn_id, protocol in self._protocols.items():
+                stats = (
+                    protocol.transport_bytes,
+                    protocol.queued_bytes,
+                    protocol.queued_messages,
+                    protocol.congested_for()
+                )
+                if stats != reported.get(conn_id, EMPTY_STATS):
+                    reported[conn_id] = stats
+                    self._send(STATS, conn_id, pack_stats(stats))
+
+            for conn_id in reported.keys() - self._protocols.keys():
+                del reported[conn_id]
+
+    @staticmethod
+    def _reframe(protocol: Protocol, payload: bytes) -> bytes:
+        """Convert newline separated JSON to the framing of the protocol"""
+        if type(protocol) is SimpleJsonProtocol:
+            return payload
+
+        return b"".join(
+            protocol.encode_json(line.decode())
+            for line in payload.splitlines()
+        )
+
+
+def run_worker(coordinator_path: str, addresses: List[ListenAddress]) -> None:
+    """Entry point of a worker process"""
+    async def main():
+        worker = Worker(coordinator_path, addresses)
+        await worker.start()
+        await worker.wait_closed()
+
+    asyncio.run(main())
+
+
+@with_logger
+class WorkerPool:
+    """
+    Runs the worker processes. Workers that exit are started again after
+    `RESTART_DELAY` seconds.
+    """
+
+    RESTART_DELAY = 5
+
+    def __init__(
+        self,
+        count: int,
+        coordinator_path: str,
+        addresses: List[ListenAddress]
+    ):
+        self.coordinator_path = coordinator_path
+        self.addresses = addresses
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * count
+        self._context = multiprocessing.get_context("spawn")
+        self._started_at: List[float] = [0.] * count
+        self._closed = False
+
+    def start(self) -> None:
+        for index in range(len(self.processes)):
+            self._start_process(index)
+
+    def _start_process(self, index: int) -> None:
+        if self._closed:
+            return
+
+        process = self._context.Process(
+            target=run_worker,
+            args=(self.coordinator_path, self.addresses),
+            name=f"LobbyWorker-{index}",
+            daemon=True
+        )
+        process.start()
+        self.processes[index] = process
+        self._started_at[index] = time.monotonic()
+        asyncio.get_event_loop().add_reader(
+            process.sentinel, self._on_process_exit, index
+        )
+
+    def _on_process_exit(self, index: int) -> None:
+        process = self.processes[index]
+        asyncio.get_event_loop().remove_reader(process.sentinel)
+        process.join()
+        if self._closed:
+            return
+
+        self._logger.error(
+            "Worker %s exited with code %s after %.0f seconds, restarting it",
+            process.name,
+            process.exitcode,
+            time.monotonic() - self._started_at[index]
+        )
+        asyncio.get_event_loop().call_later(
+            self.RESTART_DELAY, self._start_process, index
+        )
+
+    def shutdown(self) -> None:
+        self._closed = True
+        loop = asyncio.get_event_loop()
+        processes = [process for process in self.processes if process]
+        for process in processes:
+            loop.remove_reader(process.sentinel)
+            process.terminate()
+        for process in processes:
+            process.join()
@@ -2,7 +2,7 @@ import asyncio
 import hashlib
 import logging
 from collections import defaultdict
-from typing import Any, Callable, Dict, Tuple
+from typing import Any, Callable, Dict, Iterable, Tuple
 from unittest import mock
 
 import asynctest
@@ -192,23 +192,34 @@ async def perform_login(
     })
 
 
+def _unpack_batched(msg: Dict[str, Any]) -> Iterable[Dict[str, Any]]:
+    """
+    Games from batched `game_info` messages are yielded one by one before the
+    batch itself, so that tests can wait for individual game updates.
+    """
+    if msg.get("command") == "game_info" and "games" in msg:
+        yield from msg["games"]
+    yield msg
+
+
 async def _read_until(
     proto: Protocol,
     pred: Callable[[Dict[str, Any]], bool]
 ) -> Dict[str, Any]:
     while True:
         msg = await proto.read_message()
-        try:
-            if pred(msg):
-                return msg
-        except KeyError:
-            pass
-        except Exception:
-            logging.getLogger().warning(
-                "read_until predicate raised during message: %s",
-                msg,
-                exc_info=True
-            )
+        for candidate in _unpack_batched(msg):
+            try:
+                if pred(candidate):
+                    return candidate
+            except KeyError:
+                pass
+            except Exception:
+                logging.getLogger().warning(
+                    "read_until predicate raised during message: %s",
+                    candidate,
+                    exc_info=True
+                )
 
 
 async def read_until(
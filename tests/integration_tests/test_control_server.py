@@ -3,6 +3,7 @@ import asyncio
 import aiohttp
 import pytest
 
+from server import run_control_server
 from tests.utils import fast_forward
 
 from .conftest import connect_and_sign_in, read_until_command
@@ -64,3 +65,26 @@ async def test_games(control_server, lobby_server, game_service):
             data = await resp.json()
 
             assert data == [listify(game_service[msg["uid"]].to_dict())]
+
+
+@fast_forward(2)
+async def test_connections(lobby_server, player_service, game_service):
+    control_server = await run_control_server(
+        player_service, game_service, [lobby_server]
+    )
+    test_id, _, _ = await connect_and_sign_in(
+        ("test", "test_password"), lobby_server
+    )
+
+    url = f"http://{control_server.host}:{control_server.port}/connections"
+    async with aiohttp.ClientSession(raise_for_status=True) as session:
+        async with session.get(url) as resp:
+            data = await resp.json()
+
+    await control_server.shutdown()
+
+    assert len(data) == 1
+    assert data[0]["player_id"] == test_id
+    assert data[0]["login"] == "test"
+    assert data[0]["queued_bytes"] == 0
+    assert data[0]["congested_seconds"] is None
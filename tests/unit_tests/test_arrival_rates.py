@@ -0,0 +1,79 @@
+import json
+from datetime import datetime, timezone
+from unittest import mock
+
+import pytest
+
+from server.config import config
+from server.matchmaker.arrival_rates import (
+    HOURS_PER_WEEK,
+    ArrivalRateModel,
+    ArrivalRateStore,
+    hour_of_week
+)
+
+# Monday, 00:00 UTC
+MONDAY = datetime(2021, 3, 1, tzinfo=timezone.utc).timestamp()
+
+
+def test_hour_of_week():
+    assert hour_of_week(MONDAY) == 0
+    assert hour_of_week(MONDAY + 3599) == 0
+    assert hour_of_week(MONDAY + 3600) == 1
+    assert hour_of_week(MONDAY - 1) == HOURS_PER_WEEK - 1
+    assert hour_of_week(MONDAY + 7 * 24 * 3600 + 5 * 3600) == 5
+
+
+def test_rate_needs_enough_time():
+    model = ArrivalRateModel()
+
+    model.record(MONDAY, 10, 100)
+    assert model.rate(MONDAY) is None
+
+    for _ in range(9):
+        model.record(MONDAY, 10, 100)
+    assert model.rate(MONDAY) == pytest.approx(0.1)
+    # Other hours are not affected
+    assert model.rate(MONDAY + 3600) is None
+
+
+def test_rate_moves_to_new_rate():
+    model = ArrivalRateModel()
+
+    with mock.patch.object(config, "QUEUE_POP_RATE_HALF_LIFE_WEEKS", 1):
+        for _ in range(1000):
+            model.record(MONDAY, 10, 100)
+        # After one half life of pops at the new rate, the rate is halfway
+        # there
+        for _ in range(36):
+            model.record(MONDAY, 30, 100)
+
+    assert model.rate(MONDAY) == pytest.approx(0.2, rel=0.05)
+
+
+def test_store_save_and_load(tmp_path):
+    path = str(tmp_path / "rates.json")
+    store = ArrivalRateStore()
+    for _ in range(10):
+        store.get("ladder1v1").record(MONDAY, 10, 100)
+    store.save(path)
+
+    other = ArrivalRateStore()
+    # Models that were handed out before loading are updated
+    model = other.get("ladder1v1")
+    other.load(path)
+
+    assert model.rate(MONDAY) == pytest.approx(0.1)
+    assert other.get("tmm2v2").rate(MONDAY) is None
+
+
+def test_store_load_missing_or_broken(tmp_path, caplog):
+    store = ArrivalRateStore()
+    store.load(str(tmp_path / "missing.json"))
+    assert store.models == {}
+
+    path = tmp_path / "broken.json"
+    path.write_text(json.dumps({"queues": {"ladder1v1": {"players": [1]}}}))
+    store.load(str(path))
+    assert store.models == {}
+    assert "Failed to load" in caplog.text
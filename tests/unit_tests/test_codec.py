@@ -0,0 +1,207 @@
+import asyncio
+import json
+import time
+from socket import socketpair
+
+import pytest
+from hypothesis import given, settings
+from hypothesis import strategies as st
+
+from server.protocol import (
+    JsonCodec,
+    QDataStreamProtocol,
+    SimpleJsonProtocol,
+    get_codec
+)
+
+orjson = pytest.importorskip("orjson")
+
+from server.protocol import OrjsonCodec  # noqa: E402 isort:skip
+
+json_codec = JsonCodec()
+orjson_codec = OrjsonCodec()
+
+
+def st_json():
+    """Strategy for generating anything the stdlib can serialize"""
+    return st.recursive(
+        st.none() | st.booleans() | st.text() |
+        st.integers() | st.floats(allow_nan=False, allow_infinity=False),
+        lambda children: (
+            st.lists(children) |
+            st.dictionaries(st.text() | st.integers(), children)
+        ),
+        max_leaves=20
+    )
+
+
+def player_info():
+    return {
+        "command": "player_info",
+        "players": [
+            {
+                "id": i,
+                "login": f"Player_{i}",
+                "avatar": {"url": "https://content.faforever.com/a.png", "tooltip": "A"},
+                "country": "DE",
+                "clan": "FAF",
+                "ratings": {
+                    "global": {"rating": [1500.3452, 120.5435], "number_of_games": i},
+                    "ladder_1v1": {"rating": [1200.0, 75.3], "number_of_games": 3}
+                },
+                "global_rating": [1500.3452, 120.5435],
+                "ladder_rating": [1200.0, 75.3],
+                "number_of_games": i,
+                "state": "idle"
+            }
+            for i in range(100)
+        ]
+    }
+
+
+def game_info():
+    return {
+        "command": "game_info",
+        "games": [
+            {
+                "command": "game_info",
+                "visibility": "public",
+                "password_protected": False,
+                "uid": i,
+                "title": "All welcome",
+                "state": "open",
+                "game_type": "custom",
+                "featured_mod": "faf",
+                "sim_mods": {},
+                "mapname": "scmp_007",
+                "map_file_path": "maps/scmp_007.zip",
+                "host": f"Player_{i}",
+                "num_players": 4,
+                "max_players": 8,
+                "launched_at": None,
+                "rating_type": "global",
+                "rating_min": None,
+                "rating_max": None,
+                "enforce_rating_range": False,
+                "teams": {1: [f"Player_{i}", "Other"], 2: ["Third", "Fourth"]}
+            }
+            for i in range(100)
+        ]
+    }
+
+
+def matchmaker_info():
+    return {
+        "command": "matchmaker_info",
+        "queues": [
+            {
+                "queue_name": name,
+                "queue_pop_time": "2020-07-31T12:00:00.123456+00:00",
+                "queue_pop_time_delta": 35.5,
+                "num_players": 24,
+                "boundary_80s": [[1200, 1500]] * 12,
+                "boundary_75s": [[1100, 1600]] * 12,
+            }
+            for name in ("ladder1v1", "tmm2v2", "tmm4v4_full_share")
+        ]
+    }
+
+
+@given(message=st_json())
+@settings(max_examples=1000)
+def test_orjson_encode_identical(message):
+    assert orjson_codec.encode(message) == json_codec.encode(message)
+
+
+@given(message=st_json())
+@settings(max_examples=300)
+def test_orjson_decode_identical(message):
+    data = json_codec.encode(message)
+
+    assert orjson_codec.decode(data) == json_codec.decode(data)
+
+
+@pytest.mark.parametrize("message", (
+    {"text": "ü \x7f\x00"},
+    {"float": 1e-05, "big": 1.5e16},
+    {"int": 2 ** 64},
+    {"surrogate": "\ud800"},
+    {1: "int key"},
+    player_info(),
+    game_info(),
+    matchmaker_info()
+))
+def test_orjson_encode_edge_cases(message):
+    assert orjson_codec.encode(message) == json_codec.encode(message)
+
+
+@pytest.mark.parametrize("data", (
+    '{"nan": NaN}',
+    '{"int": 18446744073709551616}',
+    "-9223372036854775809",
+    '"\\ud800"',
+    b'{"command": "hello"}'
+))
+def test_orjson_decode_fallback(data):
+    assert orjson_codec.decode(data) == json_codec.decode(data)
+
+
+def test_orjson_decode_error():
+    with pytest.raises(json.JSONDecodeError):
+        orjson_codec.decode("{")
+
+
+def test_orjson_encode_error():
+    with pytest.raises(TypeError):
+        orjson_codec.encode({"object": object()})
+
+
+def test_get_codec():
+    assert isinstance(get_codec("json"), JsonCodec)
+    assert isinstance(get_codec("orjson"), OrjsonCodec)
+    assert isinstance(get_codec(), OrjsonCodec)
+
+    with pytest.raises(ValueError):
+        get_codec("xml")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("protocol_class", (QDataStreamProtocol, SimpleJsonProtocol))
+@pytest.mark.parametrize("codec", (json_codec, orjson_codec))
+async def test_protocol_codec_parameter(protocol_class, codec):
+    rsock, _ = socketpair()
+    reader, writer = await asyncio.open_connection(sock=rsock)
+    protocol = protocol_class(reader, writer, codec)
+    message = game_info()["games"][0]
+
+    assert protocol.codec is codec
+    assert protocol_class.encode_message(message, codec) == \
+        protocol_class.encode_message(message, json_codec)
+
+    reader.feed_data(protocol_class.encode_message(message, codec))
+    assert await protocol.read_message() == json.loads(json.dumps(message))
+
+    await protocol.close()
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("message", (player_info(), game_info(), matchmaker_info()))
+def test_codec_benchmark(message):
+    number = 1000
+
+    for codec in (json_codec, orjson_codec):
+        start = time.perf_counter()
+        for _ in range(number):
+            data = codec.encode(message)
+        encode = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(number):
+            codec.decode(data)
+        decode = time.perf_counter() - start
+
+        size = len(data) * number / 1024 ** 2
+        print(
+            f"{message['command']} {codec.name}: encode {size / encode:.1f}MB/s,"
+            f" decode {size / decode:.1f}MB/s"
+        )
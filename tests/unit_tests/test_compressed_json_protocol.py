@@ -0,0 +1,298 @@
+import asyncio
+import json
+import zlib
+from socket import socketpair
+
+import pytest
+
+from server.protocol import CompressedJsonProtocol, DisconnectedError
+from server.protocol.compressed_json import (
+    FRAME_HEADER,
+    MAX_FRAME_SIZE,
+    PLAIN,
+    ZLIB,
+    ZLIB_DICTIONARY
+)
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest.fixture
+def socket_pair():
+    """A pair of connected sockets."""
+    return socketpair()
+
+
+@pytest.fixture
+async def protocol(socket_pair):
+    rsock, _ = socket_pair
+    reader, writer = await asyncio.open_connection(sock=rsock)
+    protocol = CompressedJsonProtocol(reader, writer)
+    yield protocol
+
+    await protocol.close()
+
+
+@pytest.fixture
+async def client(socket_pair):
+    """The other end of the connection"""
+    _, wsock = socket_pair
+    reader, writer = await asyncio.open_connection(sock=wsock)
+    yield reader, writer
+
+    writer.close()
+
+
+async def read_frame(reader):
+    length = int.from_bytes(await reader.readexactly(4), "big")
+    payload = await reader.readexactly(length)
+    return payload[0], payload[1:]
+
+
+def unpack_frames(data):
+    frames = []
+    pos = 0
+    while pos < len(data):
+        pos, flag, payload = CompressedJsonProtocol.read_frame(data, pos)
+        frames.append((flag, payload))
+    return frames
+
+
+async def negotiate(protocol, client):
+    reader, writer = client
+    writer.write(CompressedJsonProtocol.encode_message({
+        "command": "set_compression",
+        "methods": ["brotli", "zlib"]
+    }))
+    writer.write(CompressedJsonProtocol.encode_message({"command": "hello"}))
+
+    assert await protocol.read_message() == {"command": "hello"}
+    flag, payload = await read_frame(reader)
+    assert flag == PLAIN
+    assert json.loads(payload) == {
+        "command": "set_compression",
+        "method": "zlib"
+    }
+
+    return zlib.decompressobj(zdict=ZLIB_DICTIONARY)
+
+
+async def test_encode_message():
+    data = CompressedJsonProtocol.encode_message({"command": "test"})
+
+    assert data == b'\x00\x00\x00\x13\x00{"command":"test"}'
+    assert CompressedJsonProtocol.read_frame(data) == (
+        len(data), PLAIN, b'{"command":"test"}'
+    )
+
+
+async def test_read_frame_incomplete():
+    data = CompressedJsonProtocol.encode_message({"command": "test"})
+
+    assert CompressedJsonProtocol.read_frame(data[:3]) is None
+    assert CompressedJsonProtocol.read_frame(data[:-1]) is None
+
+
+async def test_read_uncompressed(protocol):
+    protocol.reader.feed_data(
+        CompressedJsonProtocol.encode_message({"command": "hello"}) +
+        CompressedJsonProtocol.encode_message({"command": "ask_session"})
+    )
+
+    assert await protocol.read_message() == {"command": "hello"}
+    assert await protocol.read_message() == {"command": "ask_session"}
+
+
+async def test_read_malformed(protocol):
+    protocol.reader.feed_data(b"\0")
+    protocol.reader.feed_eof()
+
+    with pytest.raises(asyncio.IncompleteReadError):
+        await protocol.read_message()
+
+
+async def test_send_uncompressed(protocol, client):
+    reader, _ = client
+    await protocol.send_message({"command": "test"})
+
+    assert await read_frame(reader) == (PLAIN, b'{"command":"test"}')
+
+
+async def test_negotiate_unsupported(protocol, client):
+    reader, writer = client
+    writer.write(CompressedJsonProtocol.encode_message({
+        "command": "set_compression",
+        "methods": ["brotli"]
+    }))
+    writer.write(CompressedJsonProtocol.encode_message({"command": "hello"}))
+
+    assert await protocol.read_message() == {"command": "hello"}
+    assert protocol.compression is None
+
+    flag, payload = await read_frame(reader)
+    assert flag == PLAIN
+    assert json.loads(payload) == {"command": "set_compression", "method": None}
+
+    await protocol.send_message({"command": "test"})
+    assert await read_frame(reader) == (PLAIN, b'{"command":"test"}')
+
+
+async def test_send_compressed(protocol, client):
+    reader, _ = client
+    decompressor = await negotiate(protocol, client)
+    assert protocol.compression == "zlib"
+
+    messages = [{"command": "player_info", "players": [{"id": i}]} for i in range(3)]
+    await protocol.send_message(messages[0])
+    await protocol.send_messages(messages[1:])
+
+    received = []
+    for _ in range(2):
+        flag, payload = await read_frame(reader)
+        assert flag == ZLIB
+        for flag, data in unpack_frames(decompressor.decompress(payload)):
+            assert flag == PLAIN
+            received.append(json.loads(data))
+
+    assert received == messages
+
+
+async def test_renegotiate_refused(protocol, client):
+    reader, writer = client
+    decompressor = await negotiate(protocol, client)
+
+    writer.write(CompressedJsonProtocol.encode_message({
+        "command": "set_compression",
+        "methods": []
+    }))
+    writer.write(CompressedJsonProtocol.encode_message({"command": "hello"}))
+    assert await protocol.read_message() == {"command": "hello"}
+    assert protocol.compression == "zlib"
+
+    flag, payload = await read_frame(reader)
+    assert flag == ZLIB
+    (flag, data), = unpack_frames(decompressor.decompress(payload))
+    assert json.loads(data) == {"command": "set_compression", "method": "zlib"}
+
+
+async def test_write_raw_compresses_broadcast(protocol, client):
+    reader, _ = client
+    decompressor = await negotiate(protocol, client)
+
+    # Broadcasts are encoded once and then written to all connections
+    data = CompressedJsonProtocol.encode_message({"command": "game_info"})
+    protocol.write_raw(data)
+    await protocol.drain()
+
+    flag, payload = await read_frame(reader)
+    assert flag == ZLIB
+    assert decompressor.decompress(payload) == data
+
+
+async def test_read_compressed(protocol, client):
+    _, writer = client
+    await negotiate(protocol, client)
+
+    compressor = zlib.compressobj(zdict=ZLIB_DICTIONARY)
+    writer.write(CompressedJsonProtocol.pack_frame(
+        ZLIB,
+        compressor.compress(
+            CompressedJsonProtocol.encode_message({"command": "a"}) +
+            CompressedJsonProtocol.encode_message({"command": "b"})
+        ) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    ))
+    writer.write(CompressedJsonProtocol.encode_message({"command": "c"}))
+
+    assert await protocol.read_message() == {"command": "a"}
+    assert await protocol.read_message() == {"command": "b"}
+    assert await protocol.read_message() == {"command": "c"}
+
+
+async def test_read_compressed_without_negotiation(protocol):
+    compressor = zlib.compressobj(zdict=ZLIB_DICTIONARY)
+    protocol.reader.feed_data(CompressedJsonProtocol.pack_frame(
+        ZLIB,
+        compressor.compress(b"data") + compressor.flush(zlib.Z_SYNC_FLUSH)
+    ))
+
+    with pytest.raises(ValueError):
+        await protocol.read_message()
+
+
+async def test_read_frame_too_large(protocol):
+    protocol.reader.feed_data(FRAME_HEADER.pack(MAX_FRAME_SIZE + 1, PLAIN))
+
+    with pytest.raises(ValueError):
+        await protocol.read_message()
+
+
+async def test_read_compressed_large_batch(protocol, client):
+    _, writer = client
+    await negotiate(protocol, client)
+
+    # Many small messages in one compressed frame are fine, even though they
+    # are larger than a frame all together
+    messages = [{"command": "test", "data": "a" * 1000}] * 2000
+    compressor = zlib.compressobj(zdict=ZLIB_DICTIONARY)
+    writer.write(CompressedJsonProtocol.pack_frame(
+        ZLIB,
+        compressor.compress(b"".join(
+            CompressedJsonProtocol.encode_message(message)
+            for message in messages
+        )) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    ))
+
+    for message in messages:
+        assert await protocol.read_message() == message
+
+
+async def test_read_compressed_frame_too_large(protocol, client):
+    _, writer = client
+    await negotiate(protocol, client)
+
+    # A small frame that decompresses into a single huge frame
+    compressor = zlib.compressobj(zdict=ZLIB_DICTIONARY)
+    payload = compressor.compress(
+        CompressedJsonProtocol.pack_frame(PLAIN, b" " * 64 * MAX_FRAME_SIZE)
+    ) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    writer.write(CompressedJsonProtocol.pack_frame(ZLIB, payload))
+
+    with pytest.raises(ValueError):
+        await protocol.read_message()
+    assert len(protocol._decompressed) < 2 * MAX_FRAME_SIZE
+
+
+async def test_compression_ratio():
+    players = {
+        "command": "player_info",
+        "players": [
+            {
+                "id": i,
+                "login": f"Player_{i}",
+                "avatar": {"url": "https://content.faforever.com/faf/avatars/a.png", "tooltip": "A"},
+                "country": "DE",
+                "clan": "",
+                "ratings": {
+                    "global": {"rating": [1500.0, 120.0], "number_of_games": i},
+                    "ladder_1v1": {"rating": [1200.0, 75.0], "number_of_games": 3}
+                },
+                "global_rating": [1500.0, 120.0],
+                "ladder_rating": [1200.0, 75.0],
+                "number_of_games": i
+            }
+            for i in range(1000)
+        ]
+    }
+    data = CompressedJsonProtocol.encode_message(players)
+    compressor = zlib.compressobj(zdict=ZLIB_DICTIONARY)
+    compressed = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    assert len(compressed) < len(data) / 5
+
+
+async def test_send_when_disconnected(protocol, client):
+    await negotiate(protocol, client)
+    await protocol.close()
+
+    with pytest.raises(DisconnectedError):
+        await protocol.send_message({"some": "message"})
@@ -0,0 +1,126 @@
+import pytest
+from prometheus_client import REGISTRY
+
+from server.dispatch import DispatchTable
+from server.exceptions import ClientError
+from server.gameconnection import COMMAND_HANDLERS as GAME_COMMANDS
+from server.lobbyconnection import COMMAND_HANDLERS as LOBBY_COMMANDS
+from server.lobbyconnection import LobbyConnection
+
+pytestmark = pytest.mark.asyncio
+
+
+class Connection:
+    def __init__(self):
+        self.handled = []
+
+    async def command_echo(self, message):
+        self.handled.append(message)
+
+    async def command_fail(self, message):
+        raise ValueError("Test failure")
+
+    async def command_client_error(self, message):
+        raise ClientError("Test client error")
+
+    async def helper(self):
+        pass  # pragma: no cover
+
+
+class SubConnection(Connection):
+    async def command_echo(self, message):
+        self.handled.append("overridden")
+
+    async def command_extra(self, message):
+        pass  # pragma: no cover
+
+
+def sample(name, command):
+    return REGISTRY.get_sample_value(
+        name, {"connection": "test", "command": command}
+    ) or 0
+
+
+@pytest.fixture
+def table():
+    return DispatchTable.from_class("test", Connection, "command_")
+
+
+def test_from_class(table):
+    assert "echo" in table
+    assert "fail" in table
+    assert "helper" not in table
+    assert len(table) == 3
+
+
+def test_from_class_inherited():
+    table = DispatchTable.from_class("test", SubConnection, "command_")
+
+    assert "fail" in table
+    assert "extra" in table
+    assert len(table) == 4
+
+
+async def test_handler_looked_up_on_connection(table):
+    conn = SubConnection()
+    await table.lookup("echo")(conn, {"command": "echo"})
+    assert conn.handled == ["overridden"]
+
+    async def replaced(message):
+        conn.handled.append("replaced")
+
+    conn.command_echo = replaced
+    await table.lookup("echo")(conn, {"command": "echo"})
+    assert conn.handled == ["overridden", "replaced"]
+
+
+async def test_call_metrics(table):
+    calls = sample("server_commands_total", "echo")
+    count = sample("server_command_duration_seconds_count", "echo")
+    conn = Connection()
+
+    await table.lookup("echo")(conn, {"command": "echo"})
+
+    assert conn.handled == [{"command": "echo"}]
+    assert sample("server_commands_total", "echo") == calls + 1
+    assert sample("server_command_duration_seconds_count", "echo") == count + 1
+    assert sample("server_command_errors_total", "echo") == 0
+
+
+async def test_error_metrics(table):
+    errors = sample("server_command_errors_total", "fail")
+
+    with pytest.raises(ValueError):
+        await table.lookup("fail")(Connection(), {"command": "fail"})
+
+    assert sample("server_command_errors_total", "fail") == errors + 1
+
+
+async def test_client_errors_not_counted(table):
+    calls = sample("server_commands_total", "client_error")
+    errors = sample("server_command_errors_total", "client_error")
+
+    with pytest.raises(ClientError):
+        await table.lookup("client_error")(Connection(), {})
+
+    assert sample("server_commands_total", "client_error") == calls + 1
+    assert sample("server_command_errors_total", "client_error") == errors
+
+
+def test_unknown_command(table):
+    def unknown():
+        return REGISTRY.get_sample_value(
+            "server_commands_unknown_total", {"connection": "test"}
+        ) or 0
+
+    before = unknown()
+    assert table.lookup("nope") is None
+    assert unknown() == before + 1
+
+
+def test_lobby_and_game_commands():
+    assert "hello" in LOBBY_COMMANDS
+    assert "game_host" in LOBBY_COMMANDS
+    assert LOBBY_COMMANDS.lookup("hello").handler is LobbyConnection.command_hello
+
+    assert "GameState" in GAME_COMMANDS
@@ -1,5 +1,8 @@
+from unittest import mock
+
 import pytest
 
+from server.config import config
 from server.games import CustomGame, Game, LadderGame, VisibilityState
 from server.players import PlayerState
 
@@ -66,3 +69,22 @@ async def test_create_game_other_gamemode(players, game_service):
     assert game in game_service.dirty_games
     assert isinstance(game, Game)
     assert game.game_mode == "labwars"
+
+
+async def test_pop_dirty_queues(game_service, queue_factory):
+    queue1, queue2 = queue_factory("queue1"), queue_factory("queue2")
+    queue2.last_info_broadcast = 100
+
+    with mock.patch.object(config, "MATCHMAKER_INFO_INTERVAL", 10):
+        game_service.mark_dirty(queue1)
+        game_service.mark_dirty(queue2)
+        assert game_service.pop_dirty_queues(105) == [queue1]
+
+        # Queues stay dirty until they may be broadcast again
+        game_service.clear_dirty()
+        assert game_service.pop_dirty_queues(106) == []
+        assert game_service.pop_dirty_queues(110) == [queue2]
+        assert game_service.dirty_queues == set()
+
+    assert queue1.last_info_broadcast == 105
+    assert queue2.last_info_broadcast == 110
@@ -1,4 +1,5 @@
 import asyncio
+import time
 from unittest import mock
 
 import pytest
@@ -7,6 +8,7 @@ from hypothesis import given, settings
 from hypothesis import strategies as st
 
 from server import LadderService, LobbyConnection
+from server.config import config
 from server.db.models import matchmaker_queue, matchmaker_queue_map_pool
 from server.games import LadderGame
 from server.ladder_service import game_name
@@ -84,6 +86,36 @@ async def test_load_from_database(ladder_service, queue_factory):
         ]
 
 
+async def test_load_matching_policy(ladder_service):
+    policies = {"ladder1v1": "max_weight", "tmm2v2": "unknown"}
+    with mock.patch.object(config, "QUEUE_MATCHING_POLICIES", policies):
+        await ladder_service.update_data()
+
+    assert ladder_service.queues["ladder1v1"].matching_policy == "max_weight"
+    assert ladder_service.queues["tmm2v2"].matching_policy == "stable_marriage"
+    assert ladder_service.queues["neroxis1v1"].matching_policy == \
+        "stable_marriage"
+
+
+async def test_arrival_rates_persisted(database, game_service, tmp_path):
+    path = str(tmp_path / "rates.json")
+    now = time.time()
+    with mock.patch.object(config, "QUEUE_POP_RATES_FILE", path):
+        ladder_service = LadderService(database, game_service)
+        await ladder_service.initialize()
+        timer = ladder_service.queues["ladder1v1"].timer
+        for _ in range(10):
+            timer.time_until_next_pop(100, 100, now)
+        await ladder_service.shutdown()
+
+        ladder_service = LadderService(database, game_service)
+        await ladder_service.initialize()
+        rates = ladder_service.queues["ladder1v1"].timer.arrival_rates
+        await ladder_service.shutdown()
+
+    assert rates.rate(now) == pytest.approx(1)
+
+
 @fast_forward(5)
 async def test_load_from_database_new_data(ladder_service, database):
     async with database.acquire() as conn:
@@ -792,6 +824,46 @@ async def test_get_ladder_history_tmm2v2(ladder_service: LadderService, player_f
     assert history == [7, 9, 8, 7, 6, 5]
 
 
+async def test_get_ladder_history_batched_and_cached(
+    ladder_service: LadderService,
+    player_factory
+):
+    p1 = player_factory("Dostya", player_id=1)
+    p2 = player_factory("Rhiza", player_id=2)
+
+    with mock.patch.object(
+        ladder_service,
+        "_load_game_history",
+        wraps=ladder_service._load_game_history
+    ) as load:
+        history = await ladder_service.get_game_history([p1, p2], queue_id=1)
+        load.assert_called_once_with([1, 2], 1)
+
+        load.reset_mock()
+        assert await ladder_service.get_game_history(
+            [p1, p2], queue_id=1
+        ) == history
+        load.assert_not_called()
+
+        await ladder_service.get_game_history([p1], queue_id=2)
+        load.assert_called_once_with([1], 2)
+
+    assert history == [6, 5, 4, 3, 4, 5]
+
+
+async def test_get_ladder_history_includes_launched_games(
+    ladder_service: LadderService,
+    player_factory
+):
+    p1 = player_factory("Dostya", player_id=1)
+    await ladder_service.get_game_history([p1], queue_id=1)
+
+    ladder_service._map_history.add(1, 1, (time.time() + 3600, 100000, 15))
+
+    history = await ladder_service.get_game_history([p1], queue_id=1, limit=2)
+    assert history == [15, 6]
+
+
 async def test_game_name(player_factory):
     p1 = player_factory(login="Dostya", clan="CYB")
     p2 = player_factory(login="QAI", clan="CYB")
@@ -1,3 +1,4 @@
+import asyncio
 import re
 from hashlib import sha256
 from unittest import mock
@@ -20,6 +21,7 @@ from server.geoip_service import GeoIpService
 from server.ice_servers.nts import TwilioNTS
 from server.ladder_service import LadderService
 from server.lobbyconnection import LobbyConnection
+from server.login_admission import LoginAdmission
 from server.matchmaker import Search
 from server.party_service import PartyService
 from server.player_service import PlayerService
@@ -481,19 +483,28 @@ async def test_abort(mocker, lobbyconnection):
     lobbyconnection.protocol.close.assert_any_call()
 
 
-async def test_send_game_list(mocker, database, lobbyconnection, game_stats_service):
+async def test_send_game_list(mocker, lobbyconnection):
     games = mocker.patch.object(lobbyconnection, "game_service")  # type: GameService
-    game1, game2 = mock.create_autospec(Game(42, database, mock.Mock(), game_stats_service)), \
-                   mock.create_autospec(Game(22, database, mock.Mock(), game_stats_service))
+    games.encode_snapshot.return_value = b"encoded games"
+    games.snapshot.keys.return_value = {1, 2}
 
-    games.open_games = [game1, game2]
+    await lobbyconnection.send_game_list()
+
+    games.encode_snapshot.assert_called_once_with(type(lobbyconnection.protocol))
+    lobbyconnection.protocol.write_raw.assert_called_once_with(b"encoded games")
+    assert lobbyconnection.seen_games == {1, 2}
+
+
+async def test_send_game_list_empty(mocker, lobbyconnection):
+    games = mocker.patch.object(lobbyconnection, "game_service")  # type: GameService
+    games.encode_snapshot.return_value = b""
     lobbyconnection.send = CoroutineMock()
 
     await lobbyconnection.send_game_list()
 
-    lobbyconnection.send.assert_any_call({
+    lobbyconnection.send.assert_called_once_with({
         "command": "game_info",
-        "games": [game1.to_dict(), game2.to_dict()]
+        "games": []
     })
 
 
@@ -692,6 +703,23 @@ async def test_command_social_remove_friend(lobbyconnection, database):
     assert lobbyconnection.player.friends == set()
 
 
+async def test_command_social_add_foe_resends_hosted_game(
+    lobbyconnection,
+    mock_games
+):
+    game = mock.create_autospec(Game)
+    game.id = 42
+    game.host = lobbyconnection.player
+    lobbyconnection.game_connection = mock.Mock(game=game)
+
+    await lobbyconnection.on_message_received({
+        "command": "social_add",
+        "foe": 2
+    })
+
+    mock_games.mark_dirty.assert_called_once_with(game)
+
+
 async def test_command_ice_servers(
     lobbyconnection: LobbyConnection,
     mock_nts_client
@@ -1000,6 +1028,45 @@ async def test_command_matchmaker_info(
     })
 
 
+async def test_command_matchmaker_info_compact(
+    lobbyconnection,
+    ladder_service,
+    queue_factory,
+    player_factory
+):
+    queue = queue_factory("test", rating_type=RatingType.LADDER_1V1)
+    queue.timer.next_queue_pop = 1_562_000_000
+    queue.push(Search([
+        player_factory(player_id=1, ladder_rating=(2000, 100), ladder_games=200),
+    ]))
+    queue.push(Search([
+        player_factory(player_id=2, ladder_rating=(2050, 100), ladder_games=200),
+    ]))
+
+    lobbyconnection.ladder_service.queues = {
+        "test": queue
+    }
+    lobbyconnection.compact_matchmaker_info = True
+    lobbyconnection.send = CoroutineMock()
+    await lobbyconnection.on_message_received({
+        "command": "matchmaker_info"
+    })
+
+    lobbyconnection.send.assert_called_with({
+        "command": "matchmaker_info",
+        "queues": [
+            {
+                "queue_name": "test",
+                "queue_pop_time": "2019-07-01T16:53:20+00:00",
+                "team_size": 1,
+                "num_players": 2,
+                "rating_band_size": 100,
+                "rating_bands": [(2000, 2)]
+            }
+        ]
+    })
+
+
 async def test_connection_lost(lobbyconnection):
     lobbyconnection.game_connection = asynctest.create_autospec(GameConnection)
     await lobbyconnection.on_connection_lost()
@@ -1017,6 +1084,78 @@ async def test_connection_lost_send(lobbyconnection, mock_protocol):
     mock_protocol.send_raw.assert_not_called()
 
 
+async def test_connection_lost_grants_login_priority(lobbyconnection):
+    lobbyconnection.login_admission = LoginAdmission()
+    game = mock.create_autospec(Game)
+    game.state = GameState.LIVE
+    lobbyconnection.player.game = game
+
+    await lobbyconnection.on_connection_lost()
+
+    assert lobbyconnection.login_admission.has_priority(
+        "Dummy", "127.0.0.1"
+    )
+    # Someone else claiming the login doesn't get priority
+    assert not lobbyconnection.login_admission.has_priority(
+        "Dummy", "10.0.0.1"
+    )
+
+
+async def test_connection_lost_lobby_no_login_priority(lobbyconnection):
+    lobbyconnection.login_admission = LoginAdmission()
+    game = mock.create_autospec(Game)
+    game.state = GameState.LOBBY
+    lobbyconnection.player.game = game
+
+    await lobbyconnection.on_connection_lost()
+
+    assert not lobbyconnection.login_admission.has_priority(
+        "Dummy", "127.0.0.1"
+    )
+
+
+async def test_hello_waits_for_admission(lobbyconnection, mock_protocol):
+    lobbyconnection.login_admission = LoginAdmission()
+    lobbyconnection._login = CoroutineMock()
+
+    with mock.patch.object(config, "LOGIN_MAX_CONCURRENT", 0):
+        hello = asyncio.ensure_future(lobbyconnection.command_hello({
+            "command": "hello",
+            "login": "test",
+            "password": sha256(b"test_password").hexdigest(),
+            "unique_id": "blah"
+        }))
+        await asyncio.sleep(0.01)
+
+        mock_protocol.write_message.assert_called_once_with({
+            "command": "login_queue",
+            "position": 1
+        })
+        lobbyconnection._login.assert_not_called()
+        assert lobbyconnection.login_admission.waiting == 1
+
+        hello.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await hello
+        assert lobbyconnection.login_admission.waiting == 0
+
+
+async def test_hello_admitted(lobbyconnection):
+    lobbyconnection.login_admission = LoginAdmission()
+    lobbyconnection._login = CoroutineMock()
+    message = {
+        "command": "hello",
+        "login": "test",
+        "password": sha256(b"test_password").hexdigest(),
+        "unique_id": "blah"
+    }
+
+    await lobbyconnection.on_message_received(message)
+
+    lobbyconnection._login.assert_called_once_with(message)
+    assert lobbyconnection.login_admission.active == 0
+
+
 async def test_check_policy_conformity(lobbyconnection, policy_server):
     host, port = policy_server
     config.FAF_POLICY_SERVER_BASE_URL = f"http://{host}:{port}"
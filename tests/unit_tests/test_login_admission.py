@@ -0,0 +1,156 @@
+import asyncio
+from unittest import mock
+
+import pytest
+
+from server.config import config
+from server.login_admission import LoginAdmission
+
+pytestmark = pytest.mark.asyncio
+
+HOST = "127.0.0.1"
+
+
+@pytest.fixture
+def admission():
+    with mock.patch.object(config, "LOGIN_MAX_CONCURRENT", 2), \
+            mock.patch.object(config, "LOGIN_QUEUE_UPDATE_INTERVAL", 0.05):
+        yield LoginAdmission()
+
+
+class Login:
+    """Holds a slot until `finish` is called"""
+
+    def __init__(self, admission, login, host=HOST):
+        self.login = login
+        self.host = host
+        self.positions = []
+        self.admitted = asyncio.Event()
+        self._finished = asyncio.Event()
+        self.task = asyncio.ensure_future(self._run(admission))
+
+    async def _run(self, admission):
+        async with admission.admit(
+            self.login, self.host, self._on_position
+        ):
+            self.admitted.set()
+            await self._finished.wait()
+
+    async def _on_position(self, position):
+        self.positions.append(position)
+
+    async def finish(self):
+        self._finished.set()
+        await self.task
+
+
+async def start_logins(admission, *logins):
+    started = [Login(admission, login) for login in logins]
+    await asyncio.sleep(0)
+    return started
+
+
+async def test_admits_up_to_limit(admission):
+    first, second, third = await start_logins(admission, "a", "b", "c")
+
+    assert first.admitted.is_set()
+    assert second.admitted.is_set()
+    assert not third.admitted.is_set()
+    assert admission.active == 2
+    assert admission.waiting == 1
+    assert third.positions == [1]
+
+    await first.finish()
+    await asyncio.wait_for(third.admitted.wait(), 1)
+    assert admission.waiting == 0
+
+    await second.finish()
+    await third.finish()
+    assert admission.active == 0
+
+
+async def test_position_updates(admission):
+    logins = await start_logins(admission, "a", "b", "c", "d")
+    assert logins[3].positions == [2]
+
+    await logins[0].finish()
+    await asyncio.sleep(0.08)
+    assert logins[3].positions[-1] == 1
+
+    for login in logins[1:]:
+        await login.finish()
+
+
+async def test_priority_skips_line(admission):
+    admission.grant_priority("playing", HOST)
+    assert admission.has_priority("playing", HOST)
+    assert not admission.has_priority("other", HOST)
+    # The login name alone is not enough
+    assert not admission.has_priority("playing", "10.0.0.1")
+
+    first, second, normal, priority = await start_logins(
+        admission, "a", "b", "other", "playing"
+    )
+    assert normal.positions == [1]
+    assert priority.positions == [1]
+
+    await first.finish()
+    await asyncio.wait_for(priority.admitted.wait(), 1)
+    assert not normal.admitted.is_set()
+
+    for login in (second, normal, priority):
+        await login.finish()
+
+
+async def test_priority_expires(admission):
+    with mock.patch.object(config, "LOGIN_PRIORITY_TIME", -1):
+        admission.grant_priority("playing", HOST)
+
+    assert not admission.has_priority("playing", HOST)
+
+
+async def test_waiting_login_gives_up(admission):
+    first, second, third, fourth = await start_logins(
+        admission, "a", "b", "c", "d"
+    )
+    third.task.cancel()
+    await asyncio.sleep(0)
+    assert admission.waiting == 1
+
+    await first.finish()
+    await asyncio.wait_for(fourth.admitted.wait(), 1)
+    assert admission.active == 2
+
+    await second.finish()
+    await fourth.finish()
+    assert admission.active == 0
+
+
+async def test_position_callback_error_releases_nothing(admission):
+    first, second = await start_logins(admission, "a", "b")
+
+    async def disconnected(position):
+        raise ConnectionError()
+
+    with pytest.raises(ConnectionError):
+        async with admission.admit("c", HOST, disconnected):
+            pass
+
+    assert admission.waiting == 0
+    assert admission.active == 2
+
+    await first.finish()
+    await second.finish()
+
+
+async def test_limit_raised(admission):
+    first, second, third = await start_logins(admission, "a", "b", "c")
+
+    with mock.patch.object(config, "LOGIN_MAX_CONCURRENT", 4):
+        fourth, = await start_logins(admission, "d")
+        await asyncio.wait_for(third.admitted.wait(), 1)
+        await asyncio.wait_for(fourth.admitted.wait(), 1)
+        assert admission.active == 4
+
+        for login in (first, second, third, fourth):
+            await login.finish()
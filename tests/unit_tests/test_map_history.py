@@ -0,0 +1,44 @@
+from server.matchmaker.map_history import MapHistory
+
+NOW = 1_600_000_000
+
+
+def test_recent_maps():
+    history = MapHistory(max_age=3600)
+    history.load(1, 1, [
+        (NOW - 100, 10, 5),
+        (NOW - 300, 12, 7),
+        (NOW - 200, 11, 6),
+        (NOW - 4000, 9, 4),
+    ])
+
+    assert history.is_loaded(1, 1)
+    assert not history.is_loaded(1, 2)
+    assert not history.is_loaded(2, 1)
+    assert history.recent_maps(1, 1, limit=2, now=NOW) == [5, 6]
+    assert history.recent_maps(1, 1, limit=10, now=NOW) == [5, 6, 7]
+
+
+def test_add_merges_with_loaded_games():
+    history = MapHistory()
+    # Launched while the history was being loaded
+    history.add(1, 1, (NOW, 20, 8))
+    assert not history.is_loaded(1, 1)
+
+    history.load(1, 1, [(NOW, 20, 8), (NOW - 10, 19, None)])
+    history.add(1, 1, (NOW + 10, 21, 9))
+
+    assert history.recent_maps(1, 1, limit=5, now=NOW) == [9, 8, None]
+
+
+def test_prune():
+    history = MapHistory(max_age=3600)
+    history.load(1, 1, [(NOW - 100, 10, 5), (NOW - 4000, 9, 4)])
+    history.load(2, 1, [(NOW - 4000, 8, 3)])
+
+    history.prune(NOW)
+
+    assert history.is_loaded(1, 1)
+    assert history.recent_maps(1, 1, limit=5, now=NOW) == [5]
+    # Nothing is left to remember, so it will be loaded again if needed
+    assert not history.is_loaded(2, 1)
@@ -0,0 +1,121 @@
+import itertools
+
+import pytest
+
+from server.config import config
+from server.matchmaker import Search
+from server.matchmaker.match_estimate import MatchEstimate
+from server.players import PlayerState
+
+
+@pytest.fixture
+def make_search(player_factory):
+    player_ids = itertools.count(1)
+
+    def make(*means):
+        return Search([
+            player_factory(
+                player_id=next(player_ids),
+                ladder_rating=(mean, 50),
+                ladder_games=config.NEWBIE_MIN_GAMES + 1,
+                state=PlayerState.SEARCHING_LADDER
+            )
+            for mean in means
+        ])
+    return make
+
+
+def test_pairs_close_searches(make_search):
+    estimate = MatchEstimate(team_size=1)
+
+    for mean in (1000, 1500, 2000, 1010, 1510):
+        estimate.add(make_search(mean))
+
+    assert len(estimate) == 2
+
+
+def test_remove_pairs_partner_again(make_search):
+    estimate = MatchEstimate(team_size=1)
+    s1, s2, s3 = make_search(1500), make_search(1500), make_search(1510)
+    estimate.add(s1)
+    estimate.add(s2)
+    estimate.add(s3)
+    assert len(estimate) == 1
+
+    estimate.remove(s1)
+    assert len(estimate) == 1
+    assert s1 not in estimate
+
+    estimate.remove(s2)
+    assert len(estimate) == 0
+
+    # Removing searches that were never added does nothing
+    estimate.remove(s1)
+    estimate.remove(make_search(1500))
+    assert len(estimate) == 0
+
+
+def test_reset(make_search):
+    estimate = MatchEstimate(team_size=1)
+    s1, s2, s3 = make_search(1500), make_search(1500), make_search(1500)
+    estimate.add(s1)
+    estimate.add(s2)
+
+    estimate.reset()
+    assert len(estimate) == 0
+    assert s1 in estimate
+
+    # New searches are still paired with the old ones
+    estimate.add(s3)
+    assert len(estimate) == 1
+
+
+def test_parties_that_need_teammates(make_search):
+    estimate = MatchEstimate(team_size=2)
+    solo = [make_search(1500) for _ in range(3)]
+
+    estimate.add(make_search(1500, 1500))
+    estimate.add(make_search(1500, 1500))
+    for search in solo:
+        estimate.add(search)
+    assert len(estimate) == 1
+
+    estimate.add(make_search(1500))
+    assert len(estimate) == 2
+
+    estimate.reset()
+    estimate.remove(solo[0])
+    assert len(estimate) == 0
+
+
+def test_parties_without_compatible_neighbours(make_search):
+    estimate = MatchEstimate(team_size=2)
+    solo = [make_search(mean) for mean in (500, 1000, 1500, 2000)]
+    for search in solo:
+        estimate.add(search)
+
+    # Too far apart to be teammates or opponents of each other
+    assert len(estimate) == 0
+
+    close = make_search(1510)
+    estimate.add(close)
+    estimate.add(make_search(2010))
+    # Now 1500, 1510, 2000 and 2010 have a close neighbour
+    assert len(estimate) == 1
+
+    estimate.remove(close)
+    assert len(estimate) == 0
+
+
+def test_only_checks_nearby_searches(make_search):
+    estimate = MatchEstimate(team_size=1)
+    num_paired = 2 * MatchEstimate.NUM_TO_CHECK
+    for _ in range(num_paired):
+        estimate.add(make_search(1500))
+    assert len(estimate) == MatchEstimate.NUM_TO_CHECK
+
+    # Both are only next to paired searches, so they aren't paired with each
+    # other even though they would match
+    estimate.add(make_search(1490))
+    estimate.add(make_search(1510))
+    assert len(estimate) == MatchEstimate.NUM_TO_CHECK
@@ -0,0 +1,290 @@
+import asyncio
+import itertools
+import time
+from unittest import mock
+
+import pytest
+
+from server.config import config
+from server.matchmaker import Search
+from server.matchmaker.coordinator import MatchmakingCoordinator, match_queues
+from server.players import PlayerState
+from server.rating import RatingType
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest.fixture
+def coordinator():
+    return MatchmakingCoordinator()
+
+
+@pytest.fixture
+def make_queue(queue_factory, coordinator):
+    def make(name, team_size=1):
+        queue = queue_factory(
+            name, team_size=team_size, rating_type=RatingType.LADDER_1V1
+        )
+        queue.coordinator = coordinator
+        return queue
+    return make
+
+
+@pytest.fixture
+def make_player(player_factory):
+    player_ids = itertools.count(1)
+
+    def make(mean):
+        return player_factory(
+            player_id=next(player_ids),
+            ladder_rating=(mean, 50),
+            ladder_games=config.NEWBIE_MIN_GAMES + 1,
+            state=PlayerState.SEARCHING_LADDER
+        )
+    return make
+
+
+def fill(queue, make_player, mean=1500):
+    for _ in range(2 * queue.team_size):
+        queue.push(Search([make_player(mean)]))
+
+
+def schedule_pop(queue, delay):
+    now = time.time()
+    queue.timer.next_queue_pop = now + delay
+    queue.timer._last_queue_pop = now - config.QUEUE_POP_TIME_MIN
+
+
+async def pop_on_timer(queue):
+    await queue.timer.next_pop()
+    await queue.find_matches()
+
+
+async def test_simultaneous_pops_one_pass(make_queue, make_player):
+    queues = [make_queue(f"{size}v{size}", size) for size in (1, 2, 4)]
+    for queue in queues:
+        fill(queue, make_player)
+
+    with mock.patch(
+        "server.matchmaker.coordinator.match_queues",
+        wraps=match_queues
+    ) as matching:
+        await asyncio.gather(*(queue.find_matches() for queue in queues))
+
+    matching.assert_called_once()
+    jobs, = matching.call_args[0]
+    assert len(jobs) == 3
+    for queue in queues:
+        queue.on_match_found.assert_called_once()
+
+
+async def test_player_in_several_queues_gets_best_match(make_queue, make_player):
+    queue1, queue2 = make_queue("queue1"), make_queue("queue2")
+    player = make_player(1500)
+    s1, s2 = Search([player]), Search([make_player(1600)])
+    s3, s4 = Search([player]), Search([make_player(1510)])
+    queue1.push(s1)
+    queue1.push(s2)
+    queue2.push(s3)
+    queue2.push(s4)
+
+    await asyncio.gather(queue1.find_matches(), queue2.find_matches())
+
+    queue1.on_match_found.assert_not_called()
+    queue2.on_match_found.assert_called_once_with(s3, s4, queue2)
+    assert not s2.is_matched
+    # The search range of the dropped search widens like for any other search
+    # that wasn't matched
+    assert s2.failed_matching_attempts == 1
+
+
+async def test_pop_during_pass_is_handed_the_next_pass(make_queue, make_player):
+    queue1, queue2 = make_queue("queue1"), make_queue("queue2")
+    fill(queue1, make_player)
+    fill(queue2, make_player)
+    passes = []
+
+    def slow_match_queues(jobs):
+        passes.append(len(jobs))
+        time.sleep(0.2)
+        return match_queues(jobs)
+
+    with mock.patch(
+        "server.matchmaker.coordinator.match_queues",
+        slow_match_queues
+    ):
+        start = time.monotonic()
+        first = asyncio.create_task(queue1.find_matches())
+        await asyncio.sleep(0.05)
+        await queue2.find_matches()
+        await first
+        elapsed = time.monotonic() - start
+
+    assert passes == [1, 1]
+    assert elapsed < 0.8
+    queue1.on_match_found.assert_called_once()
+    queue2.on_match_found.assert_called_once()
+
+
+async def test_pass_error(make_queue, make_player):
+    queue1, queue2 = make_queue("queue1"), make_queue("queue2")
+    fill(queue1, make_player)
+    fill(queue2, make_player)
+
+    with mock.patch(
+        "server.matchmaker.coordinator.match_queues",
+        side_effect=ValueError("Test error")
+    ):
+        results = await asyncio.gather(
+            queue1.find_matches(),
+            queue2.find_matches(),
+            return_exceptions=True
+        )
+    assert [type(result) for result in results] == [ValueError, ValueError]
+
+    # The next pass works again
+    await queue1.find_matches()
+    queue1.on_match_found.assert_called_once()
+
+
+async def test_better_smaller_team_match_kept(make_queue, make_player):
+    queue1, queue2 = make_queue("1v1"), make_queue("2v2", team_size=2)
+    player = make_player(1500)
+    # A perfect 1v1 match
+    s1, s2 = Search([player]), Search([make_player(1500)])
+    queue1.push(s1)
+    queue1.push(s2)
+    # A 2v2 match with a larger rating difference per player
+    team_searches = [Search([player])] + [
+        Search([make_player(mean)]) for mean in (1600, 1650, 1800)
+    ]
+    for search in team_searches:
+        queue2.push(search)
+
+    await asyncio.gather(queue1.find_matches(), queue2.find_matches())
+
+    queue1.on_match_found.assert_called_once_with(s1, s2, queue1)
+    queue2.on_match_found.assert_not_called()
+    assert all(search.failed_matching_attempts == 1 for search in team_searches)
+
+
+async def test_better_larger_team_match_kept(make_queue, make_player):
+    queue1, queue2 = make_queue("1v1"), make_queue("2v2", team_size=2)
+    player = make_player(1500)
+    # A 1v1 match with a large rating difference
+    s1, s2 = Search([player]), Search([make_player(1700)])
+    queue1.push(s1)
+    queue1.push(s2)
+    assert s1.matches_with(s2)
+    # A perfect 2v2 match, which has a lower quality than a perfect 1v1 match
+    team_searches = [Search([player])] + [
+        Search([make_player(1500)]) for _ in range(3)
+    ]
+    for search in team_searches:
+        queue2.push(search)
+
+    await asyncio.gather(queue1.find_matches(), queue2.find_matches())
+
+    queue1.on_match_found.assert_not_called()
+    queue2.on_match_found.assert_called_once()
+    assert not s2.is_matched
+    assert s2.failed_matching_attempts == 1
+
+
+async def test_staggered_pops_one_pass(make_queue, make_player, coordinator):
+    queue1, queue2 = make_queue("queue1"), make_queue("queue2")
+    for queue in (queue1, queue2):
+        fill(queue, make_player)
+        coordinator.register(queue)
+    schedule_pop(queue1, 0.1)
+    schedule_pop(queue2, 0.4)
+
+    with mock.patch(
+        "server.matchmaker.coordinator.match_queues",
+        wraps=match_queues
+    ) as matching, mock.patch.object(config, "MATCHMAKER_POP_ALIGN_TIME", 0):
+        await asyncio.wait_for(
+            asyncio.gather(pop_on_timer(queue1), pop_on_timer(queue2)), 2
+        )
+
+    matching.assert_called_once()
+    jobs, = matching.call_args[0]
+    assert len(jobs) == 2
+    queue1.on_match_found.assert_called_once()
+    queue2.on_match_found.assert_called_once()
+
+
+async def test_queue_due_soon_pops_early(make_queue, make_player, coordinator):
+    queues = [make_queue(f"queue{i}") for i in range(3)]
+    for queue in queues:
+        fill(queue, make_player)
+        coordinator.register(queue)
+    schedule_pop(queues[0], 0.1)
+    schedule_pop(queues[1], config.MATCHMAKER_POP_ALIGN_TIME / 2)
+    # Too far away to be aligned
+    schedule_pop(queues[2], config.MATCHMAKER_POP_ALIGN_TIME * 2)
+
+    with mock.patch(
+        "server.matchmaker.coordinator.match_queues",
+        wraps=match_queues
+    ) as matching:
+        start = time.monotonic()
+        await asyncio.wait_for(
+            asyncio.gather(pop_on_timer(queues[0]), pop_on_timer(queues[1])),
+            config.MATCHMAKER_POP_WINDOW + 1
+        )
+        elapsed = time.monotonic() - start
+
+    assert elapsed < config.MATCHMAKER_POP_WINDOW
+    matching.assert_called_once()
+    jobs, = matching.call_args[0]
+    assert len(jobs) == 2
+    queues[1].on_match_found.assert_called_once()
+    queues[2].on_match_found.assert_not_called()
+
+
+async def test_unregistered_queue_not_aligned(make_queue, make_player, coordinator):
+    queue1, queue2 = make_queue("queue1"), make_queue("queue2")
+    fill(queue1, make_player)
+    coordinator.register(queue1)
+    coordinator.register(queue2)
+    coordinator.unregister(queue2)
+    schedule_pop(queue2, 0.5)
+
+    start = time.monotonic()
+    await queue1.find_matches()
+
+    assert time.monotonic() - start < 0.4
+    assert not queue2.timer.early_pop_requested
+
+
+async def test_pass_cancelled(make_queue, make_player, coordinator):
+    queue1, queue2 = make_queue("queue1"), make_queue("queue2")
+    fill(queue1, make_player)
+    fill(queue2, make_player)
+    started = asyncio.Event()
+
+    async def slow_pass(queues):
+        started.set()
+        await asyncio.sleep(10)
+
+    with mock.patch.object(coordinator, "_pass", slow_pass):
+        first = asyncio.create_task(queue1.find_matches())
+        await started.wait()
+        # Waits for the next pass
+        second = asyncio.create_task(queue2.find_matches())
+        await asyncio.sleep(0)
+
+        coordinator._runner.cancel()
+        results = await asyncio.wait_for(
+            asyncio.gather(first, second, return_exceptions=True), 1
+        )
+
+    assert [type(result) for result in results] == [
+        asyncio.CancelledError, asyncio.CancelledError
+    ]
+    assert coordinator._pending == {}
+
+    # The next pop starts a new runner
+    await queue1.find_matches()
+    queue1.on_match_found.assert_called_once()
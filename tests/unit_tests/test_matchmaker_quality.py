@@ -0,0 +1,161 @@
+import itertools
+import random
+from unittest import mock
+
+import pytest
+import trueskill
+from hypothesis import given, settings
+from hypothesis import strategies as st
+
+from server.matchmaker import Search, quality
+from tests.conftest import make_player
+
+from .strategies import st_rating, st_searches_list
+
+
+@pytest.fixture(scope="module", params=["numpy", "python"])
+def backend(request):
+    if request.param == "numpy":
+        if quality.np is None:
+            pytest.skip("NumPy is not installed")
+        yield request.param
+    else:
+        with mock.patch.object(quality, "np", None):
+            yield request.param
+
+
+def trueskill_quality(search, other):
+    return trueskill.quality([
+        [trueskill.Rating(*rating) for rating in search.ratings],
+        [trueskill.Rating(*rating) for rating in other.ratings]
+    ])
+
+
+def approx(expected):
+    return pytest.approx(expected, rel=1e-9, abs=1e-300)
+
+
+def make_searches(count, max_players=1):
+    return [
+        Search([
+            make_player(
+                ladder_rating=(random.gauss(1500, 300), random.uniform(30, 500)),
+                ladder_games=random.randint(0, 100),
+                login=f"p{i}"
+            )
+            for i in range(random.randint(1, max_players))
+        ])
+        for _ in range(count)
+    ]
+
+
+@given(
+    team1=st.lists(st_rating(), min_size=1, max_size=4),
+    team2=st.lists(st_rating(), min_size=1, max_size=4)
+)
+def test_team_quality_parity(team1, team2):
+    expected = trueskill.quality([
+        [trueskill.Rating(*rating) for rating in team1],
+        [trueskill.Rating(*rating) for rating in team2]
+    ])
+
+    assert quality.team_quality(
+        quality.team_stats(team1),
+        quality.team_stats(team2)
+    ) == approx(expected)
+
+
+@given(searches=st_searches_list(max_players=4, max_size=12))
+@settings(deadline=None)
+def test_quality_matrix_parity(backend, searches):
+    matrix = quality.quality_matrix(searches)
+
+    assert len(matrix) == len(searches)
+    for (i, search), (j, other) in itertools.product(
+        enumerate(searches), repeat=2
+    ):
+        assert matrix[i][j] == approx(trueskill_quality(search, other))
+
+
+@given(searches=st_searches_list(max_players=4, max_size=12))
+@settings(deadline=None)
+def test_pair_qualities_parity(backend, searches):
+    pairs = list(itertools.combinations(range(len(searches)), 2))
+
+    qualities = quality.pair_qualities(searches, pairs)
+
+    assert len(qualities) == len(pairs)
+    for (i, j), value in zip(pairs, qualities):
+        assert value == approx(trueskill_quality(searches[i], searches[j]))
+
+
+def test_quality_with_uses_closed_form():
+    search, other = make_searches(2, max_players=3)
+
+    assert search.quality_with(other) == approx(trueskill_quality(search, other))
+    assert search.quality_against_self == approx(
+        trueskill_quality(search, search)
+    )
+
+
+def test_quality_blocks(backend):
+    searches = make_searches(10, max_players=2)
+    matrix = quality.quality_matrix(searches)
+
+    rows = []
+    for start, block in quality.iter_quality_blocks(searches, block_size=3):
+        assert start == len(rows)
+        rows.extend(list(row) for row in block)
+
+    assert rows == [list(row) for row in matrix]
+
+
+def test_empty(backend):
+    assert len(quality.quality_matrix([])) == 0
+    assert list(quality.iter_quality_blocks([])) == []
+    assert quality.pair_qualities([], []) == []
+
+
+def test_beta_from_trueskill_environment():
+    search, other = make_searches(2)
+    before = search.quality_with(other)
+
+    env = trueskill.global_env()
+    try:
+        trueskill.setup(mu=env.mu, sigma=env.sigma, beta=env.beta * 2,
+                        tau=env.tau, draw_probability=env.draw_probability)
+        assert search.quality_with(other) != before
+        assert search.quality_with(other) == approx(
+            trueskill_quality(search, other)
+        )
+    finally:
+        trueskill.setup(env=env)
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("num_searches", (100, 1000, 10000))
+def test_quality_matrix_benchmark(backend, bench, num_searches):
+    if backend == "python" and num_searches > 1000:
+        pytest.skip("Takes too long without NumPy")
+
+    searches = make_searches(num_searches, max_players=4)
+
+    with bench:
+        for _ in quality.iter_quality_blocks(searches):
+            pass
+    elapsed = bench.elapsed()
+
+    # Extrapolate the time trueskill takes from a sample of pairs
+    sample = random.sample(list(itertools.combinations(searches, 2)), 1000) \
+        if num_searches <= 1000 else \
+        [tuple(random.sample(searches, 2)) for _ in range(1000)]
+    with bench:
+        for search, other in sample:
+            trueskill_quality(search, other)
+    trueskill_elapsed = bench.elapsed() * num_searches ** 2 / len(sample)
+
+    print(
+        f"{num_searches} searches ({backend}): {elapsed:.3f}s,"
+        f" trueskill.quality: ~{trueskill_elapsed:.2f}s"
+    )
+    assert elapsed < trueskill_elapsed
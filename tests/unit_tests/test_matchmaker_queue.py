@@ -1,7 +1,15 @@
 import asyncio
 import functools
+import multiprocessing
+import threading
 import time
-from concurrent.futures import CancelledError, TimeoutError
+from concurrent.futures import (
+    CancelledError,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    TimeoutError
+)
+from concurrent.futures.process import BrokenProcessPool
 
 import mock
 import pytest
@@ -10,6 +18,8 @@ from hypothesis import strategies as st
 
 import server.config as config
 from server.matchmaker import CombinedSearch, MapPool, PopTimer, Search
+from server.matchmaker.algorithm import make_teams_from_single
+from server.matchmaker.arrival_rates import ArrivalRateModel
 from server.players import PlayerState
 from server.rating import RatingType
 
@@ -160,6 +170,17 @@ def test_search_boundaries(matchmaker_players):
     assert p1.ratings[RatingType.LADDER_1V1][0] < s1.boundary_75[1]
 
 
+def test_search_boundaries_use_current_rating(matchmaker_players):
+    p1 = matchmaker_players[0]
+    s1 = Search([p1])
+    s1.boundary_80
+
+    p1.ratings[RatingType.LADDER_1V1] = (1000, 50)
+
+    assert s1.boundary_80 == (800, 1200)
+    assert s1.boundary_75 == (900, 1100)
+
+
 def test_search_expansion_controlled_by_failed_matching_attempts(matchmaker_players, mocker):
     p1 = matchmaker_players[0]
     s1 = Search([p1])
@@ -197,17 +218,62 @@ def test_combined_search_attributes(matchmaker_players):
     s2.register_failed_matching_attempt()
     search = CombinedSearch(s1, s2)
     assert search.players == [p1, p2, p3]
-    assert search.raw_ratings == [
+    assert search.raw_ratings == (
         p1.ratings[RatingType.LADDER_1V1],
         p2.ratings[RatingType.LADDER_1V1],
         p3.ratings[RatingType.LADDER_1V1]
-    ]
+    )
     assert search.failed_matching_attempts == 1
 
     search.register_failed_matching_attempt()
     assert search.failed_matching_attempts == 2
 
 
+def test_search_rating_snapshot_reused(matchmaker_players):
+    s1 = Search([matchmaker_players[0]])
+    snapshot = s1.rating_snapshot
+
+    s1.quality_with(Search([matchmaker_players[1]]))
+
+    assert not s1.refresh_rating_snapshot()
+    assert s1.rating_snapshot is snapshot
+    assert s1.ratings is snapshot.ratings
+
+
+def test_search_rating_snapshot_refreshed(matchmaker_players):
+    pro, _, _, _, _, newbie = matchmaker_players
+    s1 = Search([pro])
+    s2 = Search([newbie])
+    old_threshold = s1.match_threshold
+
+    pro.ratings[RatingType.LADDER_1V1] = (2300, 300)
+
+    assert s1.refresh_rating_snapshot()
+    assert not s1.refresh_rating_snapshot()
+    assert s1.raw_ratings == ((2300, 300),)
+    assert s1.match_threshold < old_threshold
+    assert s2.has_newbie()
+
+    newbie.game_count[RatingType.LADDER_1V1] = config.NEWBIE_MIN_GAMES + 1
+
+    assert s2.refresh_rating_snapshot()
+    assert not s2.has_newbie()
+    assert s2.ratings == s2.raw_ratings
+
+
+def test_combined_search_rating_snapshot_refreshed(matchmaker_players):
+    p1, p2, p3, _, _, _ = matchmaker_players
+    search = CombinedSearch(Search([p1, p2]), Search([p3]))
+
+    p3.ratings[RatingType.LADDER_1V1] = (1000, 100)
+
+    assert search.refresh_rating_snapshot()
+    assert search.raw_ratings[-1] == (1000, 100)
+    assert search.team_stats.mu == pytest.approx(
+        sum(mean for mean, _ in search.ratings)
+    )
+
+
 def test_queue_time_until_next_pop(queue_factory):
     team_size = 2
     t1 = PopTimer(queue_factory(team_size=team_size))
@@ -251,6 +317,135 @@ def test_queue_pop_time_moving_average_size(queue_factory):
     assert t1.time_until_next_pop(0, 100) == config.QUEUE_POP_TIME_MAX
 
 
+def test_queue_pop_time_usual_rate(queue_factory):
+    now = time.time()
+    rates = ArrivalRateModel()
+    for _ in range(10):
+        rates.record(now, 100, 100)
+
+    queue = queue_factory(team_size=2)
+    cold = PopTimer(queue)
+    warm = PopTimer(queue, rates)
+    desired_players = config.QUEUE_POP_DESIRED_MATCHES * 2 * 2
+
+    # The first pop is scheduled for when the usual rate has brought enough
+    # players
+    assert cold.next_queue_pop - now == pytest.approx(
+        config.QUEUE_POP_TIME_MAX / 2, abs=1
+    )
+    assert warm.next_queue_pop - now == pytest.approx(desired_players, abs=1)
+
+    # The usual rate is blended with the moving average
+    assert cold.time_until_next_pop(1, 100, now) == config.QUEUE_POP_TIME_MAX
+    assert warm.time_until_next_pop(1, 100, now) < config.QUEUE_POP_TIME_MAX
+    assert warm.time_until_next_pop(1, 100, now) > desired_players
+
+
+@pytest.mark.asyncio
+async def test_queue_pop_early(queue_factory):
+    timer = PopTimer(queue_factory())
+    timer.next_queue_pop = time.time() + 10
+
+    with mock.patch.object(config, "QUEUE_POP_TIME_MIN", 0.1):
+        pop = asyncio.create_task(timer.next_pop())
+        await asyncio.sleep(0.05)
+        timer.request_early_pop()
+        # Still waiting for the minimum time between pops
+        await asyncio.sleep(0)
+        assert not pop.done()
+
+        await asyncio.wait_for(pop, 1)
+
+    assert not timer.early_pop_requested
+    assert timer.last_queue_times[-1] == pytest.approx(0.1, abs=0.05)
+
+
+@pytest.mark.asyncio
+async def test_queue_pop_early_min_time(queue_factory):
+    timer = PopTimer(queue_factory())
+    timer.next_queue_pop = time.time() + 0.2
+    timer.request_early_pop()
+
+    with mock.patch.object(config, "QUEUE_POP_TIME_MIN", 0.2):
+        start = time.monotonic()
+        await timer.next_pop()
+
+    assert time.monotonic() - start >= 0.15
+
+
+def test_queue_pop_join(queue_factory):
+    timer = PopTimer(queue_factory())
+    now = time.time()
+    timer._last_queue_pop = now - 100
+
+    # Pops within the window anyway
+    timer.next_queue_pop = now + 0.5
+    assert timer.join_pop(align_time=10, window=1)
+    assert not timer.early_pop_requested
+
+    # Too far away
+    timer.next_queue_pop = now + 20
+    assert not timer.join_pop(align_time=10, window=1)
+    assert not timer.early_pop_requested
+
+    # Can't pop early because the last pop was too recent
+    timer.next_queue_pop = now + 5
+    timer._last_queue_pop = now
+    with mock.patch.object(config, "QUEUE_POP_TIME_MIN", 15):
+        assert not timer.join_pop(align_time=10, window=1)
+    assert not timer.early_pop_requested
+
+    timer._last_queue_pop = now - 100
+    assert timer.join_pop(align_time=10, window=1)
+    assert timer.early_pop_requested
+
+
+@pytest.mark.asyncio
+async def test_queue_to_dict_compact(queue_factory, player_factory):
+    queue = queue_factory(rating_type=RatingType.LADDER_1V1)
+    s1 = Search([player_factory(player_id=1, ladder_rating=(1550, 50))])
+    s2 = Search([player_factory(player_id=2, ladder_rating=(1520, 50))])
+    s3 = Search([player_factory(player_id=3, ladder_rating=(820, 50))])
+    for search in (s1, s2, s3):
+        queue.push(search)
+
+    info = queue.to_dict(compact=True)
+    assert "boundary_80s" not in info
+    assert info["num_players"] == 3
+    assert info["rating_band_size"] == 100
+    assert info["rating_bands"] == [(800, 1), (1500, 2)]
+
+    queue.match(s1, s2)
+    assert queue.to_dict(compact=True)["rating_bands"] == [(800, 1)]
+    assert len(queue.to_dict()["boundary_80s"]) == 1
+
+
+def test_queue_push_refreshes_rating_snapshot(queue_factory, player_factory):
+    queue = queue_factory(rating_type=RatingType.LADDER_1V1)
+    player = player_factory(player_id=1, ladder_rating=(1500, 50))
+    search = Search([player])
+
+    player.ratings[RatingType.LADDER_1V1] = (820, 50)
+    queue.push(search)
+
+    assert queue.to_dict(compact=True)["rating_bands"] == [(800, 1)]
+
+
+def test_queue_push_requests_early_pop(queue_factory, player_factory):
+    queue = queue_factory(rating_type=RatingType.LADDER_1V1)
+    searches = [
+        Search([player_factory(player_id=i, ladder_rating=(1500, 50))])
+        for i in range(2 * config.QUEUE_POP_DESIRED_MATCHES)
+    ]
+
+    for search in searches[:-1]:
+        queue.push(search)
+        assert not queue.timer.early_pop_requested
+
+    queue.push(searches[-1])
+    assert queue.timer.early_pop_requested
+
+
 @given(rating=st.integers())
 def test_queue_map_pools_empty(queue_factory, rating):
     queue = queue_factory()
@@ -436,7 +631,7 @@ async def test_find_matches_synchronized(queue_factory):
         return []
 
     with mock.patch(
-        "server.matchmaker.matchmaker_queue.make_matches",
+        "server.matchmaker.coordinator.make_matches",
         make_matches
     ):
         queues = [queue_factory(f"Queue{i}") for i in range(5)]
@@ -451,3 +646,120 @@ async def test_find_matches_synchronized(queue_factory):
         await asyncio.gather(*[
             queue.find_matches() for queue in queues
         ])
+
+
+@pytest.mark.asyncio
+async def test_find_matches_in_process(queue_factory, player_factory):
+    matchmaker_queue = queue_factory(rating_type=RatingType.LADDER_1V1)
+    p1 = player_factory("Dostya", ladder_rating=(2200, 150))
+    p2 = player_factory("Brackman", ladder_rating=(1500, 150))
+    p3 = player_factory("Zoidberg", ladder_rating=(1500, 125))
+    s1, s2, s3 = Search([p1]), Search([p2]), Search([p3])
+    for search in (s1, s2, s3):
+        matchmaker_queue.push(search)
+
+    with ProcessPoolExecutor(
+        max_workers=1,
+        mp_context=multiprocessing.get_context("spawn")
+    ) as pool:
+        matchmaker_queue.process_pool = pool
+        await matchmaker_queue.find_matches()
+
+    assert not s1.is_matched
+    assert s1.failed_matching_attempts == 1
+    assert s2.is_matched
+    assert s3.is_matched
+    matchmaker_queue.on_match_found.assert_called_once_with(
+        s2, s3, matchmaker_queue
+    )
+
+
+@pytest.mark.asyncio
+async def test_find_matches_in_process_parallel(queue_factory):
+    # Both calls have to wait for each other, so they must run in parallel
+    barrier = threading.Barrier(2, timeout=5)
+
+    def match_snapshot(*args):
+        barrier.wait()
+        return []
+
+    with mock.patch(
+        "server.matchmaker.coordinator.match_snapshot",
+        match_snapshot
+    ), ThreadPoolExecutor(max_workers=2) as pool:
+        queues = [queue_factory(f"Queue{i}") for i in range(2)]
+        for queue in queues:
+            queue.process_pool = pool
+            queue._queue = {
+                mock.Mock(players=[1]): 1,
+                mock.Mock(players=[2]): 2
+            }
+            queue.find_teams = mock.Mock(return_value=[])
+
+        await asyncio.gather(*[
+            queue.find_matches() for queue in queues
+        ])
+
+
+@pytest.mark.asyncio
+async def test_find_matches_broken_process_pool(queue_factory, player_factory):
+    matchmaker_queue = queue_factory(rating_type=RatingType.LADDER_1V1)
+    s1 = Search([player_factory(ladder_rating=(1500, 150))])
+    s2 = Search([player_factory(ladder_rating=(1500, 150))])
+    matchmaker_queue.push(s1)
+    matchmaker_queue.push(s2)
+    pool = mock.Mock()
+    pool.submit.side_effect = BrokenProcessPool()
+    matchmaker_queue.process_pool = pool
+
+    await matchmaker_queue.find_matches()
+
+    assert matchmaker_queue.process_pool is None
+    assert s1.is_matched
+    assert s2.is_matched
+
+
+@pytest.mark.asyncio
+async def test_team_composition_off_event_loop(queue_factory, player_factory):
+    queue = queue_factory(team_size=3, rating_type=RatingType.LADDER_1V1)
+    queue.push(Search([
+        player_factory(player_id=1, ladder_rating=(1500, 50)),
+        player_factory(player_id=2, ladder_rating=(1500, 50))
+    ]))
+    for i in range(3, 7):
+        queue.push(Search([
+            player_factory(player_id=i, ladder_rating=(1500, 50))
+        ]))
+    threads = []
+
+    def make_teams(*args, **kwargs):
+        threads.append(threading.current_thread())
+        return [], []
+
+    with mock.patch(
+        "server.matchmaker.matchmaker_queue.make_teams",
+        make_teams
+    ):
+        searches = await queue.prepare_searches()
+
+    assert searches == []
+    assert threads and threads[0] is not threading.main_thread()
+
+
+@pytest.mark.parametrize("balance", (False, True))
+def test_find_teams_balance_setting(queue_factory, player_factory, balance):
+    queue = queue_factory(team_size=2, rating_type=RatingType.LADDER_1V1)
+    for i in range(8):
+        queue.push(Search([
+            player_factory(player_id=i + 1, ladder_rating=(1000 + 100 * i, 50))
+        ]))
+
+    with mock.patch.object(config, "MATCHMAKER_BALANCE_TEAMS", balance), \
+            mock.patch(
+                "server.matchmaker.matchmaker_queue.make_teams_from_single",
+                wraps=make_teams_from_single
+            ) as make_teams:
+        teams = queue.find_teams()
+
+    assert len(teams) == 4
+    assert make_teams.call_args[1] == {"balance": balance}
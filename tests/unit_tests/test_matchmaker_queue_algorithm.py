@@ -1,13 +1,16 @@
+import functools
+import itertools
 import logging
 import math
 import random
+from unittest import mock
 
 import pytest
 from hypothesis import given, settings
 from hypothesis import strategies as st
 
 from server import config
-from server.matchmaker import Search, algorithm
+from server.matchmaker import CombinedSearch, Search, algorithm
 from server.rating import RatingType
 
 from .strategies import st_searches_list
@@ -33,8 +36,10 @@ def player_factory(player_factory):
 
 
 def add_graph_edge_weights(graph) -> algorithm.WeightedGraph:
+    # The graph builders compute the quality of many searches at once, which
+    # might differ from `quality_with` in the last bits.
     return {
-        s1: [(s2, s1.quality_with(s2)) for s2 in edges]
+        s1: [(s2, pytest.approx(s1.quality_with(s2))) for s2 in edges]
         for s1, edges in graph.items()
     }
 
@@ -152,6 +157,181 @@ def test_matching_graph_symmetric(
                 assert (search, quality) in graph[other]
 
 
+def make_random_search(player_factory):
+    # Deviations above 250 would give many searches the same `avg_mean`, and
+    # then the order of the searches isn't well defined
+    search = Search([player_factory(
+        random.gauss(1500, 300),
+        random.uniform(50, 240),
+        ladder_games=random.randint(0, 200)
+    )])
+    for _ in range(random.randint(0, 5)):
+        search.register_failed_matching_attempt()
+    return search
+
+
+def edge_dicts(graph):
+    return {
+        search: {other: pytest.approx(quality) for other, quality in edges}
+        for search, edges in graph.items()
+    }
+
+
+def test_incremental_graph_same_as_build_fast(player_factory, caplog):
+    caplog.set_level(logging.INFO)
+    graph = algorithm.IncrementalMatchingGraph()
+    searches = [make_random_search(player_factory) for _ in range(100)]
+
+    for _ in range(5):
+        ranks = graph.build(searches)
+        expected = algorithm._MatchingGraph.build_fast(searches)
+        algorithm._MatchingGraph.remove_isolated(expected)
+
+        assert edge_dicts(ranks) == edge_dicts(expected)
+        for neighbors in ranks.values():
+            qualities = [quality for _, quality in neighbors]
+            assert qualities == sorted(qualities)
+
+        # Some searches are matched or cancelled, others join the queue and
+        # the rest wait longer
+        random.shuffle(searches)
+        searches = searches[20:] + [
+            make_random_search(player_factory)
+            for _ in range(random.randint(0, 50))
+        ]
+        for search in random.sample(searches, 20):
+            search.register_failed_matching_attempt()
+        player = searches[0].players[0]
+        player.ratings[RatingType.LADDER_1V1] = (random.gauss(1500, 300), 100)
+        searches[0].refresh_rating_snapshot()
+
+
+def test_incremental_graph_only_updates_changes(player_factory, caplog):
+    caplog.set_level(logging.INFO)
+    graph = algorithm.IncrementalMatchingGraph()
+    searches = [make_random_search(player_factory) for _ in range(100)]
+    graph.build(searches)
+
+    with mock.patch.object(
+        algorithm, "team_quality", wraps=algorithm.team_quality
+    ) as team_quality:
+        graph.build(searches)
+        assert team_quality.call_count == 0
+
+        # In the middle of the order, so that the window is full on both sides
+        searches.append(Search([player_factory(1500, 100)]))
+        graph.build(searches)
+        # One quality with each search within the window on either side
+        assert team_quality.call_count == 2 * graph._num_to_check
+
+    searches.pop(0)
+    graph.build(searches)
+    assert len(graph) == 100
+    assert searches[0] in graph
+
+
+@pytest.mark.parametrize("queue_size", (300, 1000))
+def test_incremental_graph_work_proportional_to_changes(
+    player_factory,
+    caplog,
+    queue_size
+):
+    caplog.set_level(logging.INFO)
+    graph = algorithm.IncrementalMatchingGraph()
+    searches = [make_random_search(player_factory) for _ in range(queue_size)]
+    graph.build(searches)
+    # The same window size for both queue sizes
+    assert graph._num_to_check == 4
+
+    with mock.patch.object(
+        algorithm, "team_quality", wraps=algorithm.team_quality
+    ) as team_quality, mock.patch.object(
+        graph, "_update_edges", wraps=graph._update_edges
+    ) as update_edges:
+        # 5 searches are matched and 5 others join
+        searches = searches[5:] + [
+            make_random_search(player_factory) for _ in range(5)
+        ]
+        graph.build(searches)
+
+    # Every change touches at most the window on either side of it
+    window = 2 * graph._num_to_check + 1
+    assert 0 < update_edges.call_count <= 10 * window
+    assert 0 < team_quality.call_count <= 10 * window * graph._num_to_check
+
+
+def test_incremental_graph_keeps_teams(player_factory):
+    graph = algorithm.IncrementalMatchingGraph()
+    parties = [
+        Search([player_factory(mean, 64)])
+        for mean in range(1000, 2000, 25)
+    ]
+
+    def make_teams():
+        return [
+            CombinedSearch(*parties[i:i + 2])
+            for i in range(0, len(parties), 2)
+        ]
+
+    graph.build(make_teams())
+    # Teams are built from the parties again on every pop
+    teams = make_teams()
+    with mock.patch.object(
+        algorithm, "team_quality", wraps=algorithm.team_quality
+    ) as team_quality:
+        ranks = graph.build(teams)
+        assert team_quality.call_count == 0
+
+    assert set(ranks) <= set(teams)
+    for edges in ranks.values():
+        assert all(other in teams for other, _ in edges)
+    assert all(team in graph for team in teams)
+
+    # Regrouped parties are a new team
+    parties[0], parties[2] = parties[2], parties[0]
+    graph.build(make_teams())
+    assert len(graph) == 20
+
+
+def test_make_matches_with_graph(player_factory):
+    graph = algorithm.IncrementalMatchingGraph()
+    searches = [
+        Search([player_factory(mean, 64, name=f"p{i}")])
+        for i, mean in enumerate(range(1000, 2000, 25))
+    ]
+
+    matches = algorithm.make_matches(searches, graph=graph)
+
+    assert len(matches) == 20
+    assert len(graph) == 40
+
+
+@pytest.mark.slow
+def test_incremental_graph_benchmark(player_factory, bench, caplog):
+    caplog.set_level(logging.INFO)
+    graph = algorithm.IncrementalMatchingGraph()
+    searches = [make_random_search(player_factory) for _ in range(3000)]
+
+    with bench:
+        algorithm._MatchingGraph.build_fast(searches)
+    rebuild_elapsed = bench.elapsed()
+    graph.build(searches)
+
+    # 1% of the queue changes between pops
+    searches = searches[15:] + [
+        make_random_search(player_factory) for _ in range(15)
+    ]
+    with bench:
+        graph.build(searches)
+    incremental_elapsed = bench.elapsed()
+
+    print(
+        f"build_fast: {rebuild_elapsed:.3f}s, "
+        f"incremental: {incremental_elapsed:.3f}s"
+    )
+    assert incremental_elapsed < rebuild_elapsed
+
+
 @pytest.mark.parametrize("build_func", (
     algorithm._MatchingGraph.build_full,
     algorithm._MatchingGraph.build_fast
@@ -266,6 +446,109 @@ def test_stable_marriage_unmatch(player_factory):
     assert matches[s2] == s3  # quality: 0.96623
 
 
+@pytest.mark.parametrize("build_func", (
+    algorithm._MatchingGraph.build_full,
+    algorithm._MatchingGraph.build_fast
+))
+@given(searches=st_searches_list(max_players=2))
+@settings(deadline=None)
+def test_max_weight_matching_better_than_stable_marriage(
+    request,
+    caplog_context,
+    build_func,
+    searches
+):
+    with caplog_context(request) as caplog:
+        caplog.set_level(logging.INFO)
+
+        ranks = build_func(searches)
+        algorithm._MatchingGraph.remove_isolated(ranks)
+        matches = algorithm.MaximumWeightMatching().find(ranks)
+        stable_matches = algorithm.StableMarriage().find(ranks)
+
+        for search in matches:
+            opponent = matches[search]
+            assert matches[opponent] == search
+            assert search._match_quality_acceptable(
+                opponent, search.quality_with(opponent)
+            )
+
+        # Qualities are rounded for the maximum weight matching
+        assert total_quality(matches) >= \
+            total_quality(stable_matches) - len(searches) * 1e-9
+
+
+def total_quality(matches) -> float:
+    return sum(
+        search.quality_with(opponent) for search, opponent in matches.items()
+    ) / 2
+
+
+def test_max_weight_matching(player_factory):
+    s1 = Search([player_factory(2300, 64, name="p1")])
+    s2 = Search([player_factory(2000, 64, name="p2")])
+    s3 = Search([player_factory(2100, 64, name="p3")])
+    s4 = Search([player_factory(2200, 64, name="p4")])
+    s5 = Search([player_factory(2300, 64, name="p5")])
+    s6 = Search([player_factory(2400, 64, name="p6")])
+
+    searches = [s1, s2, s3, s4, s5, s6]
+    ranks = algorithm._MatchingGraph.build_full(searches)
+
+    matches = algorithm.MaximumWeightMatching().find(ranks)
+
+    # Unlike stable marriage, this finds the most balanced configuration.
+    # Since s1 and s5 have the same rating, they are interchangeable.
+    assert matches[s2] == s3
+    assert {matches[s4], matches[s6]} == {s1, s5}
+
+
+def test_make_matches_with_policy(player_factory):
+    searches = [
+        Search([player_factory(mean, 64, name=f"p{mean}")])
+        for mean in (2000, 2100, 2200, 2300, 2400, 2500)
+    ]
+
+    matches = algorithm.make_matches(searches, "max_weight")
+
+    assert {frozenset(match) for match in matches} == {
+        frozenset(searches[i:i + 2]) for i in (0, 2, 4)
+    }
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("num_searches", (100, 1000, 3000))
+def test_matching_policy_benchmark(player_factory, bench, caplog, num_searches):
+    caplog.set_level(logging.INFO)
+
+    searches = [
+        Search([player_factory(
+            random.gauss(1500, 300),
+            random.uniform(50, 300),
+            ladder_games=random.randint(0, 200)
+        )])
+        for _ in range(num_searches)
+    ]
+    for search in searches:
+        for _ in range(random.randint(0, 5)):
+            search.register_failed_matching_attempt()
+
+    results = {}
+    for name, policy in algorithm.MATCHING_POLICIES.items():
+        with bench:
+            ranks = algorithm._MatchingGraph.build_fast(searches)
+            algorithm._MatchingGraph.remove_isolated(ranks)
+            matches = policy().find(ranks)
+        results[name] = (total_quality(matches), len(matches) // 2)
+        print(
+            f"{num_searches} searches ({name}): {len(matches) // 2} matches,"
+            f" total quality {total_quality(matches):.2f},"
+            f" {bench.elapsed():.3f}s"
+        )
+
+    assert results["max_weight"][0] >= results["stable_marriage"][0]
+
+
 def test_random_newbie_matching_is_symmetric(player_factory):
     s1 = Search([player_factory(1000, 500, name="p1", ladder_games=5)])
     s2 = Search([player_factory(1200, 500, name="p2", ladder_games=5)])
@@ -483,6 +766,26 @@ def test_matchmaker_performance(player_factory, bench, caplog):
     assert bench.elapsed() < 0.5
 
 
+def test_queue_pop_performance(player_factory, bench, caplog):
+    caplog.set_level(logging.INFO)
+    NUM_SEARCHES = 1000
+
+    searches = [
+        Search([player_factory(
+            random.gauss(1500, 300),
+            random.uniform(50, 300),
+            ladder_games=random.randint(0, 50)
+        )])
+        for _ in range(NUM_SEARCHES)
+    ]
+
+    with bench:
+        teams, _ = algorithm.make_teams_from_single(searches, size=2)
+        algorithm.make_matches(teams)
+
+    assert bench.elapsed() < 0.5
+
+
 def test_matchmaker_random_only(player_factory):
     newbie1 = Search([player_factory(1550, 500, ladder_games=1)])
     newbie2 = Search([player_factory(200, 400, ladder_games=9)])
@@ -525,7 +828,9 @@ def test_make_matches_communicates_failed_attempts(player_factory):
 
 @pytest.mark.parametrize("make_teams_func", (
     algorithm.make_teams,
-    algorithm.make_teams_from_single
+    functools.partial(algorithm.make_teams, time_budget=1),
+    algorithm.make_teams_from_single,
+    functools.partial(algorithm.make_teams_from_single, balance=True)
 ))
 @given(
     searches=st_searches_list(max_players=1),
@@ -619,6 +924,78 @@ def test_make_buckets_performance(bench, player_factory):
     assert bench.elapsed() < 0.15
 
 
+def team_gaps(teams):
+    """Differences in total rating between consecutive pairs of teams"""
+    return [
+        abs(team1.team_stats.mu - team2.team_stats.mu)
+        for team1, team2 in zip(teams[::2], teams[1::2])
+    ]
+
+
+@given(values=st.lists(
+    st.floats(min_value=-1000, max_value=3000), min_size=2, max_size=8
+).filter(lambda values: len(values) % 2 == 0))
+def test_exact_split(values):
+    team = algorithm._exact_split(values)
+
+    def gap(team):
+        return abs(math.fsum(values) - 2 * math.fsum(values[i] for i in team))
+
+    assert len(team) == len(values) // 2
+    assert gap(team) <= min(
+        gap(other)
+        for other in itertools.combinations(range(len(values)), len(values) // 2)
+    ) + 1e-6
+
+
+def test_difference_split():
+    values = [1000, 1100, 1250, 1300, 1500, 1550, 1600, 1900, 2000, 2100]
+
+    team = algorithm._difference_split(values)
+
+    assert len(team) == 5
+    total = sum(values[i] for i in team)
+    assert abs(sum(values) - 2 * total) <= 100
+
+
+@pytest.mark.parametrize("size", (2, 3, 4, 5))
+def test_make_teams_single_balanced(player_factory, size):
+    searches = [
+        Search([player_factory(random.gauss(1500, 300), 100, name=f"p{i}")])
+        for i in range(size * 40)
+    ]
+    items = sorted(
+        ((search, algorithm.avg_mean(search)) for search in searches),
+        key=lambda item: item[1]
+    )
+
+    balanced = list(algorithm._balance(items, size))
+    rotated = list(algorithm._distribute(items, size))
+
+    assert sorted(p.id for team in balanced for p in team.players) == \
+        sorted(p.id for s in searches for p in s.players)
+    assert all(len(team.players) == size for team in balanced)
+    assert sum(team_gaps(balanced)) < sum(team_gaps(rotated))
+
+
+@pytest.mark.parametrize("balance", (False, True))
+def test_make_teams_single_performance(bench, player_factory, balance):
+    searches = [
+        Search([player_factory(
+            random.gauss(1500, 300), random.uniform(50, 200), name=f"p{i}"
+        )])
+        for i in range(5000)
+    ]
+
+    with bench:
+        teams, unmatched = algorithm.make_teams_from_single(
+            searches, size=4, balance=balance
+        )
+
+    assert len(teams) * 4 + len(unmatched) == len(searches)
+    assert bench.elapsed() < 1
+
+
 def test_make_teams_1(player_factory):
     teams = [
         [player_factory(name="p1"), player_factory(name="p2"), player_factory(name="p3")],
@@ -0,0 +1,204 @@
+import math
+import random
+from unittest import mock
+
+import pytest
+
+from server.config import config
+from server.matchmaker.arrival_rates import ArrivalRateModel
+from server.matchmaker.simulator import (
+    PlayerFactory,
+    Population,
+    Simulation,
+    arrival_times,
+    load_snapshots,
+    main,
+    percentile,
+    replay
+)
+
+
+def test_percentile():
+    values = [5, 1, 4, 2, 3]
+
+    assert percentile(values, 0) == 1
+    assert percentile(values, 50) == 3
+    assert percentile(values, 95) == 5
+    assert math.isnan(percentile([], 50))
+
+
+def test_arrival_times_follow_hourly_rates():
+    rates = [0] * 24
+    rates[2] = 3600
+    population = Population(arrival_rates=rates)
+
+    times = arrival_times(
+        population, 24 * 3600, start_hour=1, rng=random.Random(1)
+    )
+
+    assert times == sorted(times)
+    # Hour 2 of the day starts one hour into the simulation
+    assert all(3600 <= t < 7200 for t in times)
+    assert len(times) == pytest.approx(3600, rel=0.1)
+
+
+def test_player_factory():
+    population = Population(newbie_ratio=0.5, party_sizes=((1, 1), (2, 1), (4, 1)))
+    factory = PlayerFactory(population, rng=random.Random(1))
+
+    parties = [factory.make_party(max_size=2) for _ in range(200)]
+    players = [player for party in parties for player in party]
+
+    assert {len(party) for party in parties} == {1, 2}
+    assert len({player.id for player in players}) == len(players)
+    newbies = [
+        player for player in players
+        if player.game_count["ladder_1v1"] < config.NEWBIE_MIN_GAMES
+    ]
+    assert len(newbies) == pytest.approx(len(players) / 2, rel=0.25)
+
+
+@pytest.mark.asyncio
+async def test_simulation_report():
+    simulation = Simulation(
+        Population(arrival_rates=[120] * 24, patience=300),
+        duration=3 * 3600,
+        seed=1
+    )
+
+    report = await simulation.run()
+
+    assert report.pops > 0
+    assert len(report.matches_per_pop) == report.pops
+    assert len(report.unmatched_per_pop) == report.pops
+    assert len(report.qualities) == sum(report.matches_per_pop)
+    assert len(report.wait_times) == 2 * sum(report.matches_per_pop)
+    assert all(0 <= wait <= 300 for wait in report.wait_times)
+    assert all(0 < quality <= 1 for quality in report.qualities)
+    assert report.abandoned > 0
+    assert report.summary()["matches"] == len(report.qualities)
+
+
+@pytest.mark.asyncio
+async def test_simulation_teams():
+    simulation = Simulation(
+        Population(party_sizes=((1, 2), (2, 1)), arrival_rates=[240] * 24),
+        duration=3600,
+        team_size=2,
+        policy="max_weight",
+        seed=1
+    )
+
+    report = await simulation.run()
+
+    assert report.qualities
+    assert len(report.wait_times) == 4 * len(report.qualities)
+
+
+@pytest.mark.asyncio
+async def test_early_pops_reduce_wait_times():
+    async def run():
+        simulation = Simulation(
+            Population(arrival_rates=[600] * 24),
+            duration=3 * 3600,
+            seed=1
+        )
+        return await simulation.run()
+
+    with mock.patch.object(config, "QUEUE_POP_TIME_MIN", config.QUEUE_POP_TIME_MAX):
+        on_timer = await run()
+    early = await run()
+
+    assert early.pops > on_timer.pops
+    assert percentile(early.wait_times, 50) < percentile(on_timer.wait_times, 50)
+
+
+@pytest.mark.asyncio
+async def test_simulation_learns_arrival_rates():
+    population = Population(arrival_rates=[60] * 12 + [600] * 12)
+    rates = ArrivalRateModel()
+
+    await Simulation(
+        population, duration=24 * 3600, seed=1, arrival_rates=rates
+    ).run()
+
+    quiet = Simulation(population, start_hour=6, arrival_rates=rates)
+    busy = Simulation(population, start_hour=18, arrival_rates=rates)
+    quiet_rate = rates.rate(quiet.timestamp)
+    busy_rate = rates.rate(busy.timestamp)
+    assert busy_rate > 5 * quiet_rate
+
+    # Right after a restart, a busy queue pops sooner than a quiet one
+    busy_first_pop = busy.queue.timer.time_until_first_pop(busy.timestamp)
+    assert busy_first_pop < config.QUEUE_POP_TIME_MAX / 2
+    assert busy_first_pop < quiet.queue.timer.time_until_first_pop(
+        quiet.timestamp
+    )
+
+
+@pytest.mark.asyncio
+async def test_record_and_replay():
+    simulation = Simulation(
+        Population(arrival_rates=[120] * 24),
+        duration=3600,
+        seed=1,
+        record=True
+    )
+
+    report = await simulation.run()
+    replayed = replay(simulation.snapshots)
+
+    assert len(simulation.snapshots) == report.pops
+    # The recorded pops are matched in the same way again
+    assert replayed.matches_per_pop == report.matches_per_pop
+    assert sorted(replayed.qualities) == pytest.approx(sorted(report.qualities))
+    assert replayed.wait_times == []
+
+
+@pytest.mark.asyncio
+async def test_record_teams():
+    simulation = Simulation(
+        Population(
+            arrival_rates=[240] * 24,
+            party_sizes=((1, 1.), (2, 1.))
+        ),
+        duration=3600,
+        team_size=2,
+        seed=1,
+        record=True
+    )
+
+    report = await simulation.run()
+    replayed = replay(simulation.snapshots)
+
+    assert len(simulation.snapshots) == report.pops
+    assert replayed.matches_per_pop == report.matches_per_pop
+    assert sorted(replayed.qualities) == pytest.approx(sorted(report.qualities))
+
+
+@pytest.mark.asyncio
+async def test_main(tmp_path, capsys):
+    path = str(tmp_path / "snapshots.pkl")
+    args = {
+        "--duration": "1",
+        "--start-hour": "18",
+        "--team-size": "1",
+        "--policy": "stable_marriage",
+        "--seed": "1",
+        "--record": path,
+        "--replay": None,
+        "--rates": None,
+    }
+
+    await main(args)
+    assert "wait_time_p50" in capsys.readouterr().out
+    assert load_snapshots(path)
+
+    rates_path = str(tmp_path / "rates.json")
+    await main({**args, "--record": None, "--rates": rates_path})
+    assert "wait_time_p50" in capsys.readouterr().out
+    await main({**args, "--record": None, "--rates": rates_path})
+    assert "wait_time_p50" in capsys.readouterr().out
+
+    await main({**args, "--record": None, "--replay": path})
+    assert "pop_latency_p50" in capsys.readouterr().out
@@ -0,0 +1,142 @@
+import pickle
+from unittest import mock
+
+import pytest
+
+from server.config import config
+from server.matchmaker import CombinedSearch, Search
+from server.matchmaker.algorithm import IncrementalMatchingGraph, make_matches
+from server.matchmaker.snapshot import SearchSnapshot, match_snapshot
+from server.rating import RatingType
+
+
+@pytest.fixture
+def searches(player_factory):
+    def make(mean, games, player_id):
+        return player_factory(
+            ladder_rating=(mean, 80),
+            ladder_games=games,
+            player_id=player_id,
+        )
+
+    party = Search([make(1500, 100, 1), make(1600, 3, 2)])
+    party.register_failed_matching_attempt()
+    single = Search([make(1400, 100, 3)])
+    combined = CombinedSearch(
+        Search([make(1550, 100, 4)]),
+        Search([make(1450, 100, 5)])
+    )
+    combined.searches[1].register_failed_matching_attempt()
+    combined.searches[1].register_failed_matching_attempt()
+
+    return [party, single, combined]
+
+
+def test_round_trip(searches):
+    snapshot = SearchSnapshot.from_searches(searches, RatingType.LADDER_1V1)
+    copies = pickle.loads(pickle.dumps(snapshot)).to_searches()
+
+    assert len(copies) == len(searches)
+    assert isinstance(copies[2], CombinedSearch)
+    assert len(copies[2].searches) == 2
+    for search, copy in zip(searches, copies):
+        assert [p.id for p in copy.players] == [p.id for p in search.players]
+        assert copy.raw_ratings == search.raw_ratings
+        assert copy.ratings == search.ratings
+        assert copy.has_newbie() == search.has_newbie()
+        assert copy.failed_matching_attempts == search.failed_matching_attempts
+        assert copy.match_threshold == search.match_threshold
+
+
+def test_snapshot_is_compact(searches):
+    snapshot = SearchSnapshot.from_searches(searches, RatingType.LADDER_1V1)
+
+    assert list(snapshot.parties) == [1, 1, 2]
+    assert list(snapshot.party_sizes) == [2, 1, 1, 1]
+    assert list(snapshot.failed_attempts) == [1, 0, 0, 2]
+    assert list(snapshot.player_ids) == [1, 2, 3, 4, 5]
+    assert list(snapshot.game_counts) == [100, 3, 100, 100, 100]
+
+
+def test_match_snapshot(player_factory):
+    searches = [
+        Search([player_factory(
+            ladder_rating=(mean, 64), ladder_games=100, player_id=i
+        )])
+        for i, mean in enumerate((1000, 1900, 1010, 1910))
+    ]
+    expected = {
+        frozenset((searches.index(s1), searches.index(s2)))
+        for s1, s2 in make_matches(searches)
+    }
+    snapshot = SearchSnapshot.from_searches(searches, RatingType.LADDER_1V1)
+
+    pairs = match_snapshot(snapshot)
+
+    assert {frozenset(pair) for pair in pairs} == expected == {
+        frozenset((0, 2)), frozenset((1, 3))
+    }
+
+
+def test_match_snapshot_uses_settings(player_factory):
+    searches = [
+        Search([player_factory(
+            ladder_rating=(1500, 64), ladder_games=5, player_id=i
+        )])
+        for i in range(2)
+    ]
+    with mock.patch.object(config, "NEWBIE_MIN_GAMES", 0):
+        snapshot = SearchSnapshot.from_searches(
+            searches, RatingType.LADDER_1V1
+        )
+
+    # The worker process might have loaded a different configuration
+    with mock.patch.object(config, "NEWBIE_MIN_GAMES", 10), \
+            mock.patch("server.matchmaker.snapshot.make_matches") as matches:
+        matches.return_value = []
+        match_snapshot(snapshot, "max_weight")
+
+        copies, policy, graph = matches.call_args[0]
+        assert policy == "max_weight"
+        assert graph is None
+        assert not any(copy.has_newbie() for copy in copies)
+
+
+def test_match_snapshot_with_graph(player_factory):
+    searches = [
+        Search([player_factory(
+            ladder_rating=(mean, 64), ladder_games=100, player_id=i
+        )])
+        for i, mean in enumerate(range(1000, 2000, 25))
+    ]
+    expected = {
+        frozenset((searches.index(s1), searches.index(s2)))
+        for s1, s2 in make_matches(searches)
+    }
+    graph = IncrementalMatchingGraph()
+    snapshot = SearchSnapshot.from_searches(
+        searches, RatingType.LADDER_1V1, graph
+    )
+    assert len(graph) == len(searches)
+    assert snapshot.edges is not None
+
+    with mock.patch(
+        "server.matchmaker.quality.team_quality"
+    ) as team_quality, mock.patch(
+        "server.matchmaker.algorithm.team_quality", team_quality
+    ):
+        pairs = match_snapshot(pickle.loads(pickle.dumps(snapshot)))
+        # The edges were copied, not computed again
+        team_quality.assert_not_called()
+
+    assert {frozenset(pair) for pair in pairs} == expected
+
+
+def test_small_snapshot_without_graph(searches):
+    graph = IncrementalMatchingGraph()
+    snapshot = SearchSnapshot.from_searches(
+        searches, RatingType.LADDER_1V1, graph
+    )
+
+    assert snapshot.edges is None
+    assert len(graph) == 0
@@ -0,0 +1,113 @@
+import itertools
+
+import pytest
+from hypothesis import given
+from hypothesis import strategies as st
+
+from server.matchmaker.max_weight_matching import (
+    banded_max_weight_matching,
+    bandwidth,
+    max_weight_matching
+)
+
+
+@st.composite
+def st_graphs(draw, max_vertices=9, max_distance=None, weights=None):
+    """Strategy for generating edge lists without duplicate edges"""
+    num_vertices = draw(st.integers(min_value=2, max_value=max_vertices))
+    pairs = [
+        (i, j)
+        for i, j in itertools.combinations(range(num_vertices), 2)
+        if max_distance is None or j - i <= max_distance
+    ]
+    if weights is None:
+        weights = st.one_of(
+            st.integers(min_value=0, max_value=20),
+            st.floats(min_value=0, max_value=1)
+        )
+    return [
+        (i, j, draw(weights))
+        for i, j in draw(st.lists(st.sampled_from(pairs), unique=True))
+    ]
+
+
+def brute_force_weight(edges):
+    """The maximum weight of any matching"""
+    weights = {(i, j): w for i, j, w in edges}
+    vertices = {v for i, j, _ in edges for v in (i, j)}
+
+    def best(free):
+        if not free:
+            return 0
+        v, *rest = sorted(free)
+        return max(
+            [best(set(rest))] + [
+                weights[edge] + best(set(rest) - {u})
+                for u in rest
+                for edge in ((v, u), (u, v))
+                if edge in weights
+            ]
+        )
+
+    return best(vertices)
+
+
+def matching_weight(edges, mate):
+    for v, u in enumerate(mate):
+        if u != -1:
+            assert mate[u] == v
+
+    return sum(
+        w for i, j, w in edges
+        if i < len(mate) and mate[i] == j
+    )
+
+
+@given(edges=st_graphs())
+def test_max_weight_matching(edges):
+    mate = max_weight_matching(edges)
+
+    assert matching_weight(edges, mate) == pytest.approx(
+        brute_force_weight(edges)
+    )
+
+
+@given(edges=st_graphs(max_vertices=10, max_distance=3))
+def test_banded_max_weight_matching(edges):
+    mate = banded_max_weight_matching(edges)
+
+    assert matching_weight(edges, mate) == pytest.approx(
+        brute_force_weight(edges)
+    )
+
+
+@given(edges=st_graphs(
+    max_vertices=30,
+    max_distance=4,
+    weights=st.integers(min_value=0, max_value=10 ** 9)
+))
+def test_algorithms_agree(edges):
+    assert matching_weight(edges, banded_max_weight_matching(edges)) == \
+        matching_weight(edges, max_weight_matching(edges))
+
+
+def test_empty():
+    assert max_weight_matching([]) == []
+    assert banded_max_weight_matching([]) == []
+    assert bandwidth([]) == 0
+
+
+def test_blossom():
+    # The odd cycle 1-2-3 has to be contracted to find the augmenting path
+    # 6-1-2-3-4-5
+    edges = [
+        (1, 2, 8), (1, 3, 9), (2, 3, 10), (3, 4, 7), (1, 6, 5), (4, 5, 6)
+    ]
+
+    mate = max_weight_matching(edges)
+
+    assert mate == [-1, 6, 3, 2, 5, 4, 1]
+
+
+def test_bandwidth():
+    assert bandwidth([(0, 1, 1), (5, 2, 1), (3, 4, 1)]) == 3
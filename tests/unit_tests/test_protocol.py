@@ -1,7 +1,10 @@
 import asyncio
+import base64
 import json
 import struct
+import time
 from socket import socketpair
+from unittest import mock
 
 import pytest
 from hypothesis import example, given, settings
@@ -122,6 +125,66 @@ async def test_QDataStreamProtocol_recv_large_array(protocol, reader):
     assert message == {"some_header": True, "legacy": [str(i) for i in range(1520)]}
 
 
+async def test_QDataStreamProtocol_recv_incomplete_block(protocol, reader):
+    data = QDataStreamProtocol.pack_message('{"some_header": true}')
+    reader.feed_data(data[:-1])
+    reader.feed_eof()
+
+    with pytest.raises(asyncio.IncompleteReadError) as e:
+        await protocol.read_message()
+
+    assert e.value.partial == data[:-1]
+    assert e.value.expected == len(data)
+
+
+async def test_QDataStreamProtocol_recv_many_in_one_chunk(protocol, reader):
+    reader.feed_data(b"".join(
+        QDataStreamProtocol.pack_message(json.dumps({"command": i}))
+        for i in range(100)
+    ))
+    reader.feed_eof()
+
+    for i in range(100):
+        assert await protocol.read_message() == {"command": i}
+
+    with pytest.raises(asyncio.IncompleteReadError):
+        await protocol.read_message()
+
+
+async def test_QDataStreamProtocol_recv_split_message(protocol, reader):
+    data = QDataStreamProtocol.pack_message(
+        json.dumps({"command": "test", "data": "*" * 100_000})
+    )
+
+    async def feed():
+        for i in range(0, len(data), 1000):
+            reader.feed_data(data[i:i + 1000])
+            await asyncio.sleep(0)
+
+    _, message = await asyncio.gather(feed(), protocol.read_message())
+
+    assert message == {"command": "test", "data": "*" * 100_000}
+
+
+async def test_read_qstring_memoryview():
+    data = QDataStreamProtocol.pack_qstring("Hello") + \
+        QDataStreamProtocol.pack_qstring("World")
+
+    pos, msg = QDataStreamProtocol.read_qstring(memoryview(data))
+    assert msg == "Hello"
+
+    pos, msg = QDataStreamProtocol.read_qstring(memoryview(data), pos)
+    assert msg == "World"
+    assert pos == len(data)
+
+
+async def test_read_qstring_malformed():
+    data = QDataStreamProtocol.pack_qstring("Hello")[:-1]
+
+    with pytest.raises(ValueError):
+        QDataStreamProtocol.read_qstring(data)
+
+
 async def test_unpacks_evil_qstring(protocol, reader):
     reader.feed_data(struct.pack("!I", 64))
     reader.feed_data(b"\x00\x00\x004\x00{\x00\"\x00c\x00o\x00m\x00m\x00a\x00n\x00d\x00\"\x00:\x00 \x00\"\x00a\x00s\x00k\x00_\x00s\x00e\x00s\x00s\x00i\x00o\x00n\x00\"\x00}\xff\xff\xff\xff\xff\xff\xff\xff")
@@ -225,3 +288,130 @@ async def test_send_when_disconnected(protocol):
             {"some": "message"},
             {"some": "other message"}
         ])
+
+
+async def test_writes_flushed_once_per_iteration(protocol, socket_pair):
+    _, wsock = socket_pair
+    reader, _ = await asyncio.open_connection(sock=wsock)
+    messages = [{"command": "modvault_info", "uid": i} for i in range(100)]
+
+    with mock.patch.object(
+        protocol.writer, "write", wraps=protocol.writer.write
+    ) as write:
+        for message in messages:
+            protocol.write_message(message)
+        write.assert_not_called()
+
+        await protocol.flush()
+        write.assert_called_once()
+
+    client = QDataStreamProtocol(reader, mock.Mock())
+    for message in messages:
+        assert await client.read_message() == message
+
+
+async def test_flush_now(protocol):
+    with mock.patch.object(
+        protocol.writer, "write", wraps=protocol.writer.write
+    ) as write:
+        protocol.write_message({"command": "pong"})
+        protocol.flush_now()
+        write.assert_called_once_with(
+            QDataStreamProtocol.encode_message({"command": "pong"})
+        )
+
+        # The scheduled flush has nothing left to do
+        await protocol.flush()
+        await asyncio.sleep(0)
+        write.assert_called_once()
+
+
+async def test_flush_when_disconnected(protocol):
+    protocol.write_message({"command": "test"})
+    await protocol.close()
+
+    # Pending writes were flushed when closing
+    await protocol.flush()
+
+
+def legacy_read_qstring(buffer, pos=0):
+    """The implementation of `read_qstring` before it used memoryviews"""
+    chunk = buffer[pos:pos + 4]
+    rest = buffer[pos + 4:]
+    assert len(chunk) == 4
+
+    (size, ) = struct.unpack("!I", chunk)
+    if len(rest) < size:
+        raise ValueError(
+            "Malformed QString: Claims length {} but actually {}. Entire buffer: {}"
+            .format(size, len(rest), base64.b64encode(buffer)))
+    return size + pos + 4, (buffer[pos + 4:pos + 4 + size]).decode("UTF-16BE")
+
+
+def legacy_read_block(data):
+    buffer_pos = 0
+    while len(data[buffer_pos:]) > 4:
+        buffer_pos, msg = legacy_read_qstring(data, buffer_pos)
+        yield msg
+
+
+def time_per_call(func, number):
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    return (time.perf_counter() - start) / number
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("name,block,number", (
+    ("ping", QDataStreamProtocol.pack_qstring("PING"), 100_000),
+    (
+        "army stats",
+        b"".join(
+            QDataStreamProtocol.pack_qstring(json.dumps({
+                "blueprint": f"uel{i:04}",
+                "built": {"count": i, "mass": 1.5 * i},
+                "lost": {"count": 0, "mass": 0}
+            }))
+            for i in range(20_000)
+        ),
+        3
+    )
+))
+async def test_read_block_benchmark(name, block, number):
+    new = time_per_call(
+        lambda: list(QDataStreamProtocol.read_block(block)),
+        number
+    )
+    legacy = time_per_call(lambda: list(legacy_read_block(block)), number)
+
+    print(
+        f"{name} ({len(block)} bytes): {new * 1e6:.1f}us, legacy "
+        f"{legacy * 1e6:.1f}us"
+    )
+    assert list(QDataStreamProtocol.read_block(block)) == \
+        list(legacy_read_block(block))
+
+
+@pytest.mark.slow
+async def test_read_message_benchmark(protocol_factory):
+    """Many small messages that arrive in a single chunk"""
+    protocol = await protocol_factory()
+    data = QDataStreamProtocol.pack_message("PING") * 100_000
+
+    protocol.reader.feed_data(data)
+    start = time.perf_counter()
+    for _ in range(100_000):
+        await protocol.read_message()
+    new = time.perf_counter() - start
+
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    start = time.perf_counter()
+    for _ in range(100_000):
+        (block_length, ) = struct.unpack("!I", await reader.readexactly(4))
+        block = await reader.readexactly(block_length)
+        legacy_read_qstring(block)
+    legacy = time.perf_counter() - start
+
+    print(f"100000 pings: {new:.3f}s, legacy {legacy:.3f}s")
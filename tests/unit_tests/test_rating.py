@@ -25,3 +25,21 @@ def test_key_type(ratings):
 
     assert ratings == {"global": (1500, 500), "ladder_1v1": (1500, 500)}
     assert list(ratings) == ["global", "ladder_1v1"]
+
+
+def test_version_bumped_on_every_change(ratings):
+    def changes(mutate):
+        version = ratings.version
+        mutate()
+        return ratings.version != version
+
+    assert changes(lambda: ratings.__setitem__("global", (1000, 10)))
+    assert changes(lambda: ratings.update({"global": (1100, 10)}))
+    assert changes(lambda: ratings.setdefault(RatingType.TMM_2V2, (900, 10)))
+    assert not changes(lambda: ratings.setdefault("global", (900, 10)))
+    assert changes(lambda: ratings.pop(RatingType.TMM_2V2))
+    assert not changes(lambda: ratings.pop(RatingType.TMM_2V2, None))
+    assert changes(lambda: ratings.__delitem__("global"))
+    assert changes(ratings.popitem)
+    ratings["global"] = (1000, 10)
+    assert changes(ratings.clear)
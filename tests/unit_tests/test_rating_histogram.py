@@ -0,0 +1,44 @@
+import pytest
+
+from server.matchmaker import Search
+from server.matchmaker.rating_histogram import RatingHistogram
+
+
+@pytest.fixture
+def make_search(player_factory):
+    def make(mean, player_id):
+        return Search([
+            player_factory(
+                player_id=player_id, ladder_rating=(mean, 50), ladder_games=100
+            )
+        ])
+    return make
+
+
+def test_histogram(make_search):
+    histogram = RatingHistogram()
+    s1, s2, s3 = make_search(1450, 1), make_search(1499, 2), make_search(-20, 3)
+
+    for search in (s1, s2, s3):
+        histogram.add(search)
+    histogram.add(s1)
+
+    assert len(histogram) == 3
+    assert histogram.to_list() == [(-100, 1), (1400, 2)]
+
+    histogram.remove(s1)
+    histogram.remove(s3)
+    histogram.remove(s3)
+    assert histogram.to_list() == [(1400, 1)]
+
+
+def test_histogram_keeps_band_of_search(make_search):
+    histogram = RatingHistogram()
+    search = make_search(1450, 1)
+    histogram.add(search)
+
+    search.players[0].ratings["ladder_1v1"] = (2000, 50)
+    search.refresh_rating_snapshot()
+    histogram.remove(search)
+
+    assert histogram.to_list() == []
@@ -0,0 +1,193 @@
+import asyncio
+import json
+from socket import socketpair
+from unittest import mock
+
+import pytest
+
+from server.config import config
+from server.protocol import CompressedJsonProtocol, SimpleJsonProtocol
+
+pytestmark = pytest.mark.asyncio
+
+# Large enough to fill up the socket buffers of a client that doesn't read
+FLOOD_SIZE = 16 * 1024 * 1024
+
+
+@pytest.fixture
+def send_queue_config():
+    with mock.patch.object(config, "SEND_QUEUE_MAX_BYTES", 1024), \
+            mock.patch.object(config, "SLOW_CONSUMER_TIMEOUT", 0.5):
+        yield
+
+
+@pytest.fixture
+def socket_pair():
+    """A pair of connected sockets."""
+    return socketpair()
+
+
+@pytest.fixture
+async def protocol(socket_pair, send_queue_config):
+    rsock, _ = socket_pair
+    reader, writer = await asyncio.open_connection(sock=rsock)
+    protocol = SimpleJsonProtocol(reader, writer)
+    yield protocol
+
+    await protocol.close()
+
+
+@pytest.fixture
+def client(socket_pair):
+    """
+    Opens the other end of the connection. Until then, nothing that is sent
+    will be read.
+    """
+    _, wsock = socket_pair
+    writers = []
+
+    async def open_client():
+        reader, writer = await asyncio.open_connection(
+            sock=wsock, limit=2 * FLOOD_SIZE
+        )
+        writers.append(writer)
+        return reader
+
+    yield open_client
+
+    for writer in writers:
+        writer.close()
+
+
+def flood(protocol):
+    protocol.write_raw(SimpleJsonProtocol.encode_message({
+        "command": "flood",
+        "data": "x" * FLOOD_SIZE
+    }))
+    protocol.flush_now()
+
+
+async def read_messages(reader, count):
+    return [json.loads(await reader.readline()) for _ in range(count)]
+
+
+async def test_not_congested(protocol, client):
+    reader = await client()
+    protocol.write_message({"command": "test"})
+    await protocol.flush()
+
+    assert not protocol.is_congested()
+    assert protocol.queued_messages == 0
+    assert protocol.congested_for() is None
+    assert await read_messages(reader, 1) == [{"command": "test"}]
+
+
+async def test_congested_writes_are_coalesced(protocol, client):
+    reader = await client()
+    flood(protocol)
+    assert protocol.is_congested()
+
+    game_1 = {"command": "game_info", "uid": 1, "title": "Old"}
+    game_1_new = {"command": "game_info", "uid": 1, "title": "New"}
+    game_2 = {"command": "game_info", "uid": 2, "title": "Other"}
+    protocol.write_raw(SimpleJsonProtocol.encode_message(game_1), 1)
+    protocol.write_raw(SimpleJsonProtocol.encode_message(game_2), 2)
+    protocol.write_message({"command": "ping"})
+    protocol.write_raw(SimpleJsonProtocol.encode_message(game_1_new), 1)
+    await protocol.flush()
+
+    assert protocol.queued_messages == 3
+    assert protocol.queued_bytes == sum(
+        len(SimpleJsonProtocol.encode_message(msg))
+        for msg in (game_2, {"command": "ping"}, game_1_new)
+    )
+    assert protocol.congested_for() >= 0
+
+    messages = await read_messages(reader, 4)
+    assert messages[0]["command"] == "flood"
+    assert messages[1:] == [game_2, {"command": "ping"}, game_1_new]
+
+    await asyncio.sleep(0)
+    assert not protocol.is_congested()
+    assert protocol.congested_for() is None
+
+
+async def test_send_does_not_wait_for_client(protocol, client):
+    flood(protocol)
+
+    await asyncio.wait_for(protocol.send_message({"command": "test"}), 0.1)
+    assert protocol.queued_messages == 1
+
+    reader = await client()
+    messages = await read_messages(reader, 2)
+    assert messages[1] == {"command": "test"}
+
+
+async def test_drain_waits_for_queue(protocol, client):
+    flood(protocol)
+
+    protocol.write_message({"command": "test"})
+    send = asyncio.ensure_future(protocol.drain())
+    await asyncio.sleep(0.1)
+    assert not send.done()
+    assert protocol.queued_messages == 1
+
+    reader = await client()
+    messages = await read_messages(reader, 2)
+    await send
+
+    assert messages[1] == {"command": "test"}
+    assert protocol.queued_messages == 0
+
+
+async def test_slow_consumer_is_aborted(protocol, client):
+    flood(protocol)
+    protocol.write_message({"command": "test"})
+
+    await asyncio.sleep(0.2)
+    assert protocol.is_connected()
+
+    await asyncio.sleep(0.5)
+    assert not protocol.is_connected()
+    assert protocol.queued_messages == 0
+
+
+async def test_close_writes_queued_messages(protocol, client):
+    flood(protocol)
+    protocol.write_message({"command": "goodbye"})
+
+    close = asyncio.ensure_future(protocol.close())
+    reader = await client()
+    messages = await read_messages(reader, 2)
+    await close
+
+    assert messages[1] == {"command": "goodbye"}
+
+
+async def test_compression_applied_when_dequeued(socket_pair, send_queue_config):
+    rsock, wsock = socket_pair
+    reader, writer = await asyncio.open_connection(sock=rsock)
+    protocol = CompressedJsonProtocol(reader, writer)
+    protocol._negotiate_compression({"methods": ["zlib"]})
+
+    # Queued frames are still plain, so they can be replaced
+    with mock.patch.object(
+        CompressedJsonProtocol,
+        "transport_bytes",
+        new_callable=mock.PropertyMock,
+        return_value=config.SEND_QUEUE_MAX_BYTES
+    ):
+        protocol.write_message({"command": "game_info", "uid": 1})
+        protocol.write_raw(
+            CompressedJsonProtocol.encode_message({"command": "game_info"}), 1
+        )
+        protocol.flush_now()
+
+    assert protocol._queue[1] == CompressedJsonProtocol.encode_message(
+        {"command": "game_info"}
+    )
+    await protocol.drain()
+    assert protocol.queued_messages == 0
+
+    await protocol.close()
+    wsock.close()
@@ -0,0 +1,123 @@
+import functools
+import time
+from unittest import mock
+
+import pytest
+from hypothesis import given
+from hypothesis import strategies as st
+
+from server.matchmaker import Search, algorithm
+from server.matchmaker.team_composition import (
+    TimeBudgetExceeded,
+    compose_teams,
+    compositions,
+    count_teams
+)
+
+
+@pytest.fixture
+def party_factory(player_factory):
+    def make(size, mean=1500):
+        return Search([
+            player_factory(ladder_rating=(mean, 100), ladder_games=100)
+            for _ in range(size)
+        ])
+    return make
+
+
+def most_teams(counts, size):
+    """Try every way of making teams"""
+    @functools.lru_cache(maxsize=None)
+    def search(counts):
+        best = 0
+        for composition in compositions(size):
+            remaining = list(counts)
+            for k in composition:
+                remaining[k - 1] -= 1
+            if min(remaining) >= 0:
+                best = max(best, 1 + search(tuple(remaining)))
+        return best
+
+    return search(tuple(counts.get(k, 0) for k in range(1, size)))
+
+
+def test_compositions():
+    assert compositions(1) == []
+    assert compositions(2) == [(1, 1)]
+    assert compositions(4) == [(3, 1), (2, 2), (2, 1, 1), (1, 1, 1, 1)]
+
+
+@given(
+    size=st.integers(min_value=2, max_value=6),
+    counts=st.lists(st.integers(min_value=0, max_value=5), min_size=5, max_size=5)
+)
+def test_count_teams_is_optimal(size, counts):
+    counts = {k + 1: count for k, count in enumerate(counts[:size - 1])}
+
+    plan = count_teams(counts, size)
+
+    used = {k: 0 for k in counts}
+    for composition, num in plan.items():
+        assert sum(composition) == size
+        for k in composition:
+            used[k] += num
+    assert all(used[k] <= counts[k] for k in counts)
+    assert sum(plan.values()) == most_teams(counts, size)
+
+
+def test_compose_teams_more_than_greedy(party_factory):
+    searches = [party_factory(size) for size in (3, 4, 1, 1, 5, 1)]
+
+    greedy, _ = algorithm.make_teams(searches, 6)
+    teams, unmatched = compose_teams(searches, 6)
+
+    assert len(greedy) == 1
+    assert sorted(len(team.searches) for team in teams) == [2, 3]
+    assert [len(search.players) for search in unmatched] == [3]
+
+
+def test_compose_teams_similar_ratings(party_factory):
+    searches = [
+        party_factory(size, mean)
+        for mean in (1000, 2000)
+        for size in (1, 1, 2, 3, 1)
+    ]
+
+    teams, unmatched = compose_teams(searches, 4)
+
+    assert len(teams) == 4
+    assert unmatched == []
+    for team in teams:
+        means = {search.avg_mean for search in team.searches}
+        assert len(means) == 1
+
+
+def test_compose_teams_full_and_too_large(party_factory):
+    full, too_large = party_factory(2), party_factory(3)
+
+    teams, unmatched = compose_teams([full, too_large], 2)
+
+    assert teams == [full]
+    assert unmatched == [too_large]
+
+
+def test_compose_teams_deadline(party_factory):
+    searches = [party_factory(size) for size in (1, 2, 1, 3)]
+
+    with pytest.raises(TimeBudgetExceeded):
+        compose_teams(searches, 4, deadline=time.perf_counter() - 1)
+
+
+def test_make_teams_time_budget(party_factory, caplog):
+    searches = [party_factory(size) for size in (3, 4, 1, 1, 5, 1)]
+
+    teams, _ = algorithm.make_teams(searches, 6, time_budget=1)
+    assert len(teams) == 2
+
+    with mock.patch(
+        "server.matchmaker.algorithm.compose_teams",
+        side_effect=TimeBudgetExceeded
+    ):
+        teams, _ = algorithm.make_teams(searches, 6, time_budget=1)
+    assert len(teams) == 1
+    assert "making them greedily" in caplog.text
@@ -0,0 +1,425 @@
+import asyncio
+import json
+import os
+import socket
+import stat
+import tempfile
+from unittest import mock
+
+import pytest
+
+from server.protocol import (
+    CompressedJsonProtocol,
+    QDataStreamProtocol,
+    SimpleJsonProtocol
+)
+from server.workers import (
+    CLOSE,
+    CONNECT,
+    DISCONNECT,
+    WRITE,
+    WRITE_KEYED,
+    CoordinatorContext,
+    RemoteProtocol,
+    Worker,
+    WorkerChannel,
+    WorkerPool,
+    pack_ipc,
+    pack_keyed,
+    pack_stats,
+    peer_uid,
+    read_ipc,
+    unpack_keyed,
+    unpack_stats
+)
+
+pytestmark = pytest.mark.asyncio
+
+
+class EchoConnection:
+    """Replies to every `ask` with an `answer`"""
+
+    user_agent = None
+    version = None
+    authenticated = True
+
+    def __init__(self, lost=None):
+        self.protocol = None
+        self.address = None
+        self.lost = lost if lost is not None else []
+
+    async def on_connection_made(self, protocol, address):
+        self.protocol = protocol
+        self.address = address
+
+    async def on_message_received(self, message):
+        if message.get("command") == "ask":
+            self.protocol.write_message({
+                "command": "answer",
+                "seq": message.get("seq")
+            })
+        elif message.get("command") == "quit":
+            await self.protocol.close()
+
+    async def on_connection_lost(self):
+        self.lost.append(self)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def socket_path():
+    with tempfile.TemporaryDirectory() as directory:
+        yield os.path.join(directory, "workers.sock")
+
+
+@pytest.fixture
+async def coordinator(socket_path):
+    lost = []
+    ctx = CoordinatorContext(
+        "TestCoordinator",
+        lambda: EchoConnection(lost),
+        []
+    )
+    ctx.lost = lost
+    await ctx.listen(socket_path)
+
+    yield ctx
+
+    ctx.close()
+
+
+@pytest.fixture
+async def worker(coordinator, socket_path):
+    port = free_port()
+    worker = Worker(socket_path, [
+        ("127.0.0.1", port, QDataStreamProtocol),
+    ])
+    await worker.start()
+    worker.port = port
+
+    yield worker
+
+    await worker.shutdown()
+
+
+async def open_client(port, protocol_class=QDataStreamProtocol):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    return protocol_class(reader, writer)
+
+
+async def test_ipc_frames():
+    reader = asyncio.StreamReader()
+    reader.feed_data(
+        pack_ipc(CONNECT, 1, b'["127.0.0.1",1234,"QDataStreamProtocol"]') +
+        pack_ipc(DISCONNECT, 2**32 - 1)
+    )
+
+    kind, conn_id, payload = await read_ipc(reader)
+    assert (kind, conn_id) == (CONNECT, 1)
+    assert json.loads(payload) == ["127.0.0.1", 1234, "QDataStreamProtocol"]
+
+    assert await read_ipc(reader) == (DISCONNECT, 2**32 - 1, b"")
+
+
+async def test_ipc_payloads():
+    for stats in ((0, 0, 0, None), (1000, 200, 3, 4.5)):
+        assert unpack_stats(pack_stats(stats)) == stats
+
+    key, data = unpack_keyed(pack_keyed(("player_info", 1), b"{}\n"))
+    assert key == b'["player_info",1]'
+    assert data == b"{}\n"
+
+
+async def test_socket_permissions(coordinator, socket_path):
+    assert stat.S_IMODE(os.stat(socket_path).st_mode) == 0o600
+
+    _, writer = await asyncio.open_unix_connection(socket_path)
+    assert peer_uid(writer.get_extra_info("socket")) == os.getuid()
+    writer.close()
+
+
+async def test_foreign_worker_refused(coordinator, socket_path):
+    with mock.patch("server.workers.peer_uid", return_value=os.getuid() + 1):
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+
+        assert await reader.read() == b""
+    writer.close()
+
+
+async def test_remote_protocol_writes_frames():
+    writer = mock.Mock()
+    writer.is_closing.return_value = False
+    protocol = RemoteProtocol(WorkerChannel(mock.Mock(), writer), 7)
+
+    protocol.write_message({"command": "a"})
+    protocol.write_message({"command": "b"})
+    protocol.flush_now()
+    writer.write.assert_called_once_with(
+        pack_ipc(WRITE, 7, b'{"command":"a"}\n{"command":"b"}\n')
+    )
+
+    writer.reset_mock()
+    protocol.write_message({"command": "a"})
+    protocol.write_raw(b'{"command":"b"}\n', ("b", 1))
+    protocol.flush_now()
+    assert writer.write.call_args_list == [
+        mock.call(pack_ipc(WRITE, 7, b'{"command":"a"}\n')),
+        mock.call(pack_ipc(
+            WRITE_KEYED, 7, pack_keyed(("b", 1), b'{"command":"b"}\n')
+        ))
+    ]
+
+    writer.reset_mock()
+    await protocol.close()
+    writer.write.assert_called_once_with(pack_ipc(CLOSE, 7))
+    assert not protocol.is_connected()
+
+
+async def test_remote_protocol_read():
+    protocol = RemoteProtocol(WorkerChannel(mock.Mock(), mock.Mock()), 0)
+    protocol.feed_raw_message(b'{"command":"hello"}')
+    protocol.feed_eof()
+
+    assert await protocol.read_message() == {"command": "hello"}
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            await protocol.read_message()
+    assert not protocol.is_connected()
+
+
+async def test_remote_protocol_decodes_with_client_protocol():
+    protocol = RemoteProtocol(
+        WorkerChannel(mock.Mock(), mock.Mock()),
+        0,
+        client_protocol=QDataStreamProtocol
+    )
+    block = QDataStreamProtocol.pack_message('{"command":"hello"}', "legacy")
+    protocol.feed_raw_message(block[4:])
+
+    assert await protocol.read_message() == {
+        "command": "hello",
+        "legacy": ["legacy"]
+    }
+
+
+async def test_worker_forwards_raw_messages(coordinator, worker):
+    client = await open_client(worker.port)
+
+    with mock.patch.object(
+        QDataStreamProtocol,
+        "decode_message",
+        wraps=QDataStreamProtocol.decode_message
+    ) as decode_message:
+        await client.send_message({"command": "ask", "seq": 1})
+        answer = await client.read_raw_message()
+
+    # Only the coordinator parses the message, the worker forwards the block
+    # as it was read
+    decode_message.assert_called_once()
+    assert QDataStreamProtocol.decode_message(answer) == {
+        "command": "answer",
+        "seq": 1
+    }
+    proto, = coordinator.connections.values()
+    assert proto.client_protocol is QDataStreamProtocol
+
+    await client.close()
+
+
+async def test_reframe():
+    payload = b'{"command":"a"}\n{"command":"b"}\n'
+    for protocol_class in (
+        QDataStreamProtocol, SimpleJsonProtocol, CompressedJsonProtocol
+    ):
+        protocol = mock.Mock(spec=protocol_class)
+        protocol.encode_json = protocol_class.encode_json
+
+        assert Worker._reframe(protocol, payload) == (
+            protocol_class.encode_message({"command": "a"}) +
+            protocol_class.encode_message({"command": "b"})
+        )
+
+
+async def test_relay_messages(coordinator, worker):
+    client = await open_client(worker.port)
+
+    await client.send_message({"command": "ask", "seq": 1})
+    assert await client.read_message() == {"command": "answer", "seq": 1}
+
+    (conn, proto), = coordinator.connections.items()
+    assert isinstance(proto, RemoteProtocol)
+    assert conn.address.host == "127.0.0.1"
+
+    # Broadcasts are encoded once by the coordinator
+    coordinator.write_broadcast({"command": "game_info", "games": []})
+    assert await client.read_message() == {"command": "game_info", "games": []}
+
+    await client.close()
+    for _ in range(100):
+        if coordinator.lost:
+            break
+        await asyncio.sleep(0.01)
+    assert coordinator.lost == [conn]
+    assert coordinator.connections == {}
+
+
+async def test_coordinator_closes_client(coordinator, worker):
+    client = await open_client(worker.port)
+
+    await client.send_message({"command": "quit"})
+    with pytest.raises(asyncio.IncompleteReadError):
+        await client.read_message()
+
+
+async def test_clients_dropped_when_worker_exits(coordinator, worker):
+    client = await open_client(worker.port)
+    await client.send_message({"command": "ask"})
+    await client.read_message()
+
+    await worker.shutdown()
+    for _ in range(100):
+        if coordinator.lost:
+            break
+        await asyncio.sleep(0.01)
+
+    assert len(coordinator.lost) == 1
+
+
+async def test_remote_protocol_stats():
+    protocol = RemoteProtocol(WorkerChannel(mock.Mock(), mock.Mock()), 0)
+    assert protocol.congested_for() is None
+
+    protocol.remote_stats = (1000, 200, 3, 4.5)
+
+    assert protocol.transport_bytes == 1000
+    assert protocol.queued_bytes == 200
+    assert protocol.queued_messages == 3
+    assert protocol.congested_for() == 4.5
+    assert protocol.is_congested()
+
+    protocol.remote_stats = (1000, 0, 0, None)
+    assert not protocol.is_congested()
+
+
+async def test_worker_reports_stats(coordinator, worker):
+    client = await open_client(worker.port)
+    await client.send_message({"command": "ask"})
+    await client.read_message()
+
+    worker_proto, = worker._protocols.values()
+    proto, = coordinator.connections.values()
+
+    async def wait_for_stats(queued_bytes):
+        for _ in range(300):
+            if proto.queued_bytes == queued_bytes:
+                return
+            await asyncio.sleep(0.01)
+        assert proto.queued_bytes == queued_bytes
+
+    with mock.patch("server.workers.STATS_INTERVAL", 0.01):
+        worker_proto._queued_bytes = 100
+        await wait_for_stats(100)
+
+        worker_proto._queued_bytes = 0
+        await wait_for_stats(0)
+
+    await client.close()
+
+
+async def test_worker_coalesces_keyed_writes(coordinator, worker):
+    client = await open_client(worker.port)
+    await client.send_message({"command": "ask"})
+    await client.read_message()
+
+    worker_proto, = worker._protocols.values()
+    proto, = coordinator.connections.values()
+
+    with mock.patch.object(worker_proto, "is_congested", return_value=True), \
+            mock.patch.object(worker_proto, "_start_drain"):
+        for seq in range(3):
+            proto.write_message({"command": "ask", "seq": seq})
+            proto.write_raw(
+                proto.encode_message({"command": "info", "seq": seq}),
+                ("info", 1)
+            )
+        await proto.flush()
+        for _ in range(100):
+            if worker_proto.queued_messages == 4:
+                break
+            await asyncio.sleep(0.01)
+
+        assert worker_proto.queued_messages == 4
+        assert list(worker_proto._queue.values())[-1] == (
+            QDataStreamProtocol.encode_message({"command": "info", "seq": 2})
+        )
+        worker_proto._clear_queue()
+
+    await client.close()
+
+
+@pytest.mark.slow
+async def test_connections_spread_over_workers(coordinator, socket_path):
+    port = free_port()
+    pool = WorkerPool(
+        2, socket_path, [("127.0.0.1", port, QDataStreamProtocol)]
+    )
+    pool.start()
+    clients = []
+    channels = set()
+    try:
+        # Keep connecting until both workers are listening and the kernel has
+        # given each of them a client
+        for _ in range(1000):
+            try:
+                client = await open_client(port)
+            except OSError:
+                await asyncio.sleep(0.01)
+                continue
+            clients.append(client)
+            await client.send_message({"command": "ask", "seq": len(clients)})
+            assert await client.read_message() == {
+                "command": "answer",
+                "seq": len(clients)
+            }
+
+            channels = {
+                proto.writer.channel
+                for proto in coordinator.connections.values()
+            }
+            if len(channels) == 2:
+                break
+            await asyncio.sleep(0.01)
+
+        assert len(channels) == 2
+    finally:
+        for client in clients:
+            await client.close()
+        pool.shutdown()
+
+
+async def test_worker_pool_restarts_workers(coordinator, socket_path, caplog):
+    pool = WorkerPool(
+        1, socket_path, [("127.0.0.1", free_port(), QDataStreamProtocol)]
+    )
+    pool.RESTART_DELAY = 0
+    pool.start()
+    try:
+        process, = pool.processes
+        process.kill()
+        for _ in range(300):
+            if pool.processes[0] is not process:
+                break
+            await asyncio.sleep(0.01)
+
+        assert pool.processes[0] is not process
+        assert pool.processes[0].is_alive()
+        assert "exited with code" in caplog.text
+    finally:
+        pool.shutdown()
+
+    assert not pool.processes[0].is_alive()